@@ -0,0 +1,360 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import Logger
+import smtplib
+import threading
+from time import perf_counter, time
+from typing import Callable
+
+from async_smtp import AsyncSMTP
+from delivery_report import DeliveryReport
+from email_content import EmailContent
+from email_sender import EmailSender
+from journal import SendJournal
+from metrics import Metrics
+from rate_controller import RateController, get_smtp_code, is_throttled
+from sending_account import SendingAccount
+from smtp_pool import MAX_IDLE_TIME, PooledSMTP
+from smtp_protocol import STAGE_MAIL, STAGE_SENT, DeliveryUnknownError
+from suppression import SuppressionIndex
+
+
+class AsyncEmailSender(EmailSender):
+    """
+    EmailSender whose deliveries run as coroutines on an asyncio event loop in a single background thread, so that many
+        SMTP sessions can be in flight without one OS thread per connection. Batching, progress and reporting are
+        inherited, only the delivery itself differs. The outcomes are written to the journal, the delivery report and
+        the suppression index by a thread of their own, in order, so that the event loop never waits for the disk
+    """
+    def __init__(self, logger: Logger, project_path: str, event_details: dict[str], accounts: list[str],
+                 total_emails: int, progress_bar_len: int, max_in_flight: int,
+                 make_rate_controller: Callable[[], RateController], max_connections: int,
+                 max_messages_per_connection: int = 100, journal: SendJournal = None, max_attempts: int = 5,
+                 report: DeliveryReport = None, metrics: Metrics = None,
+                 smtp_host: str = None, smtp_port: int = None, smtp_starttls: bool = None,
+                 max_recipients_per_message: int = 1, share_with: 'AsyncEmailSender' = None,
+                 draw_progress: Callable[[], None] = None, suppression: SuppressionIndex = None,
+                 render: bool = True):
+        """
+        :param logger: Reuse the same configured logger
+        :param project_path: Path of the project directory
+        :param event_details: Dictionary of all necessary details of the event
+        :param accounts: Email accounts where the emails are going to be sent from, each email is sent from one of them
+        :param total_emails: Total number of emails to be sent, used in progress bar
+        :param progress_bar_len: Number of characters in the live progress bar
+        :param max_in_flight: Maximum number of emails being sent concurrently
+        :param make_rate_controller: Function making the adaptive rate and concurrency limiter of one account
+        :param max_connections: Maximum number of SMTP sessions of each account open at the same time
+        :param max_messages_per_connection: Number of emails sent over one SMTP session before it's replaced
+        :param journal: On-disk journal where the outcome of every email is recorded as soon as it's known, or None
+        :param max_attempts: Number of attempts of an email that keeps failing transiently before it's marked as failed
+        :param report: Report the outcome of every email is appended to as soon as it's known, or None
+        :param metrics: Metrics the sending process is recorded in, or None to keep them internal
+        :param smtp_host: SMTP server the emails are sent through, or None for Gmail's
+        :param smtp_port: Port of the SMTP server, or None for the default
+        :param smtp_starttls: Whether to use STARTTLS, or None for the default
+        :param max_recipients_per_message: Maximum number of consecutive emails with the same body sent in one SMTP
+            transaction, as BCC, 1 to send every email separately
+        :param share_with: Sender of another event whose accounts and event loop are used instead of new ones, it must
+            be closed after this one, or None
+        :param draw_progress: Function drawing one progress bar for every event sent together, called instead of
+            drawing the bar of this sender, or None
+        :param suppression: Index the recipients refused permanently by the server are added to, so that no event
+            emails them again, or None
+        :param render: Whether the sender builds the emails it sends. A drain sends the emails of a spool as they were
+            written, so it loads no attachments and builds no templates
+        """
+        self.max_connections = max_connections  # Used by make_pool, called by the constructor of EmailSender
+        super().__init__(logger=logger, executor=None, project_path=project_path, event_details=event_details,
+                         accounts=accounts, total_emails=total_emails, progress_bar_len=progress_bar_len,
+                         max_in_flight=max_in_flight, make_rate_controller=make_rate_controller,
+                         max_messages_per_connection=max_messages_per_connection, journal=journal,
+                         max_attempts=max_attempts, report=report, metrics=metrics, smtp_host=smtp_host,
+                         smtp_port=smtp_port, smtp_starttls=smtp_starttls,
+                         max_recipients_per_message=max_recipients_per_message, share_with=share_with,
+                         draw_progress=draw_progress, suppression=suppression, render=render)
+        self.record_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='record-writer')
+        if share_with is not None:  # The sessions of the accounts belong to the event loop of the sender they are from
+            self.open_smtps = share_with.open_smtps
+            self.loop = share_with.loop
+            self.loop_thread = share_with.loop_thread
+            return
+        self.open_smtps = set()  # Every open session, idle or not, only used in the event loop
+
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name='async-email-sender', daemon=True)
+        self.loop_thread.start()
+
+    def make_pool(self, account: SendingAccount) -> asyncio.LifoQueue:
+        """
+        :param account: Account the sessions are logged in to
+        :return: Sessions of the account not used by any coroutine, only used in the event loop. None is a free slot for
+            opening a new session, and being LIFO, idle open sessions are reused before new ones are opened
+        """
+        idle_smtps = asyncio.LifoQueue()
+        for _ in range(self.max_connections):
+            idle_smtps.put_nowait(None)
+        return idle_smtps
+
+    def warm_up(self) -> None:
+        """
+        Opens and logs in SMTP sessions ahead of the first email, concurrently, as many for each account as its initial
+            concurrency, and leaves them idle. A session that fails to open is only logged, it will be opened again when
+            it's needed
+        :return: None
+        """
+        asyncio.run_coroutine_threadsafe(self.warm_up_async(), self.loop).result()
+
+    async def warm_up_async(self) -> None:
+        """
+        :return: None
+        """
+        async def open_one(account: SendingAccount) -> None:
+            await self.release_async_smtp(account, await self.get_async_smtp(account), sent=False)
+
+        opens = [open_one(account) for account in self.accounts
+                 for _ in range(min(int(account.rate_controller.concurrency), self.max_connections))]
+        for result in await asyncio.gather(*opens, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.logger.warning(f'Failed to open SMTP session ahead of sending: {result}')
+
+    def schedule_attempt(self, group: list[EmailContent], outcomes: list[Future]) -> None:
+        """
+        Runs one attempt to send the group as a coroutine on the event loop, can be called from any thread
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :param outcomes: Future of every email, resolved once it's sent or has failed for good
+        :return: None
+        """
+        asyncio.run_coroutine_threadsafe(self.run_attempt_async(group, outcomes), self.loop)
+
+    async def run_attempt_async(self, group: list[EmailContent], outcomes: list[Future]) -> None:
+        """
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :param outcomes: Future of every email
+        :return: None
+        """
+        self.on_attempt_done(group, outcomes, await self.send_one_async(group))
+
+    def record_success(self, email_content: EmailContent) -> None:
+        """
+        Hands the records of the email to the record writer thread
+        :param email_content: EmailContent object of the email that was sent
+        :return: None
+        """
+        self.record_writer.submit(self.write_record, super().record_success, email_content)
+
+    def record_failure(self, email_content: EmailContent, e: Exception) -> None:
+        """
+        Hands the records of the email to the record writer thread
+        :param email_content: EmailContent object of the email that failed
+        :param e: Exception the last attempt failed with
+        :return: None
+        """
+        self.record_writer.submit(self.write_record, super().record_failure, email_content, e)
+
+    def write_record(self, record: Callable[..., None], email_content: EmailContent, *args: Exception) -> None:
+        """
+        Runs in the record writer thread, where an error would otherwise go unnoticed
+        :param record: record_success or record_failure of EmailSender
+        :param email_content: EmailContent object of the email
+        :param args: Exception the email failed with, for record_failure
+        :return: None
+        """
+        try:
+            record(email_content, *args)
+        except Exception as e:
+            self.logger.error(f'Failed to record the outcome of the email to {email_content.email}: {e}')
+
+    def retry_later(self, delay: float, retry: Callable[[], None]) -> None:
+        """
+        Waits for the next attempt on the event loop rather than on the retry queue thread
+        :param delay: Seconds to wait before the next attempt
+        :param retry: Function scheduling the next attempt
+        :return: None
+        """
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, retry)
+
+    async def get_async_smtp(self, account: SendingAccount) -> PooledSMTP:
+        """
+        Takes the most recently used idle session of the account, checking it with a NOOP if it has been idle for too
+            long, or opens a new one if a slot is free, otherwise waits for a session to be released
+        :param account: Account the session is logged in to
+        :return: Logged in session, owned by the caller until it's released or discarded
+        """
+        conn = await account.pool.get()
+        while conn is not None:
+            if time() - conn.last_used <= MAX_IDLE_TIME:
+                return conn
+            try:
+                if (await conn.smtp.noop())[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, OSError):  # Closed by the server, or a half-dead socket
+                pass
+            await self.discard_async_smtp(account, conn)
+            conn = await account.pool.get()
+
+        smtp = AsyncSMTP(self.smtp_server, self.smtp_port)
+        try:
+            with self.metrics.timer('smtp_phase_seconds', phase='connect'):
+                await smtp.connect()
+            if self.smtp_starttls:
+                with self.metrics.timer('smtp_phase_seconds', phase='starttls'):
+                    await smtp.starttls()  # Transport layer security, ensures secure communication
+            with self.metrics.timer('smtp_phase_seconds', phase='login'):
+                await smtp.login(account.address, account.password)
+        except Exception:
+            await smtp.close()
+            account.pool.put_nowait(None)
+            raise
+
+        conn = PooledSMTP(smtp)
+        self.open_smtps.add(conn)
+        live = self.smtp_stats.on_created()
+        self.logger.info(f'SMTP connection with id {conn.conn_id} started, number of live connections: {live}',
+                         extra={'smtp_id': conn.conn_id})
+        return conn
+
+    async def release_async_smtp(self, account: SendingAccount, conn: PooledSMTP, sent: bool = True) -> None:
+        """
+        Returns a usable session to the idle queue of its account, or recycles it if it has sent its maximum number of
+            messages
+        :param account: Account the session is logged in to
+        :param conn: Session owned by the caller
+        :param sent: Whether a message was sent while it was owned
+        :return: None
+        """
+        conn.last_used = time()
+        conn.num_messages += sent
+        if conn.num_messages < self.max_messages_per_connection:
+            account.pool.put_nowait(conn)
+            return
+
+        self.open_smtps.discard(conn)
+        account.pool.put_nowait(None)
+        await self.quit_async_smtp(conn, recycled=True)
+
+    async def discard_async_smtp(self, account: SendingAccount, conn: PooledSMTP) -> None:
+        """
+        Closes a session that failed, freeing its slot for a new one
+        :param account: Account the session is logged in to
+        :param conn: Session owned by the caller
+        :return: None
+        """
+        await conn.smtp.close()
+        self.open_smtps.discard(conn)
+        account.pool.put_nowait(None)
+        live = self.smtp_stats.on_closed(failed=True)
+        self.logger.info(f'Disconnected SMTP connection with id {conn.conn_id} stopped, remaining: {live}',
+                         extra={'smtp_id': conn.conn_id})
+
+    async def quit_async_smtp(self, conn: PooledSMTP, recycled: bool = False) -> None:
+        """
+        Quits a healthy session
+        :param conn: Session that is no longer in the idle queue
+        :param recycled: Whether the session is closed because it reached the maximum number of messages
+        :return: None
+        """
+        try:
+            await conn.smtp.quit()
+            live = self.smtp_stats.on_closed(recycled=recycled)
+            self.logger.info(f'SMTP connection with id {conn.conn_id} stopped, remaining: {live}',
+                             extra={'smtp_id': conn.conn_id})
+        except smtplib.SMTPServerDisconnected:
+            live = self.smtp_stats.on_closed(failed=True)
+            self.logger.error(f"SMTP server connection with id {conn.conn_id} doesn't exist when trying to stop the "
+                              f"connection, remaining: {live}", extra={'smtp_id': conn.conn_id})
+
+    async def send_one_async(self, group: list[EmailContent]) -> list[Exception | None]:
+        """
+        Makes one attempt to send a group of emails with the same body from their account, in one SMTP transaction,
+            once the rate controller of the account allows it
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :return: For every email, None if successful, the exception the attempt failed with if not successful
+        """
+        account = group[0].account
+        start = None
+        try:
+            msg = self.make_message(group)
+            await account.rate_controller.acquire_async()
+            start = perf_counter()
+            conn_id, refused = await self.deliver_async(account, [email_content.email for email_content in group], msg)
+        except Exception as e:
+            latency = None if start is None else perf_counter() - start
+            errors = self.finish_attempt(group, None, latency, {}, e)
+            if start is not None:
+                account.rate_controller.release(throttled=any(is_throttled(err) for err in errors if err is not None))
+            return errors
+
+        errors = self.finish_attempt(group, conn_id, perf_counter() - start, refused)
+        account.rate_controller.release(throttled=any(is_throttled(e) for e in errors if e is not None))
+        return errors
+
+    async def deliver_async(self, account: SendingAccount, emails: list[str],
+                            msg: bytes) -> tuple[int, dict[str, tuple[int, bytes]]]:
+        """
+        Send one email over a pooled session of the account. A session closed by the server before it accepted
+            MAIL FROM, such as after being idle, is replaced once and the email is sent again right away. If the
+            session is lost after the whole email was written, the server may have accepted it, so the email fails
+            with DeliveryUnknownError instead of being retried
+        :param account: Account the email is sent from
+        :param emails: Addresses of the recipients
+        :param msg: The full email
+        :return: Id of the session the email was sent with, and the reply of the server to every recipient it refused
+            while accepting the others
+        """
+        for attempt in range(2):
+            conn = await self.get_async_smtp(account)
+            try:
+                with self.metrics.timer('smtp_phase_seconds', phase='data'):
+                    refused = await conn.smtp.sendmail(account.address, emails, msg)
+            except smtplib.SMTPServerDisconnected as e:
+                stage = conn.smtp.stage
+                await self.discard_async_smtp(account, conn)
+                if stage == STAGE_SENT:
+                    raise DeliveryUnknownError(f'Connection lost before the server replied to the message, it may '
+                                               f'have been delivered: {e}') from e
+                if attempt == 1 or stage != STAGE_MAIL:  # A transaction the server started is retried later
+                    raise
+                continue
+            except smtplib.SMTPException as e:  # The server refused the email, the session is usable unless it's a 421
+                if get_smtp_code(e) == 421:
+                    await self.discard_async_smtp(account, conn)
+                else:
+                    await self.release_async_smtp(account, conn, sent=False)
+                raise
+            except Exception:
+                await self.discard_async_smtp(account, conn)
+                raise
+
+            await self.release_async_smtp(account, conn)
+            return conn.conn_id, refused
+
+    def close(self) -> None:
+        """
+        Stops retrying, quits every SMTP session unless they belong to the sender they are shared with, and waits for
+            the outcomes still being written. Does nothing if it's already closed
+        :return: None
+        """
+        if self.closed:
+            return
+        super().close()
+        self.record_writer.shutdown()
+
+    def close_connections(self) -> None:
+        """
+        Quits every SMTP session and stops the event loop
+        :return: None
+        """
+        asyncio.run_coroutine_threadsafe(self.quit_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+    async def quit_all(self) -> None:
+        """
+        Quits every open SMTP session concurrently
+        :return: None
+        """
+        conns = list(self.open_smtps)
+        self.open_smtps.clear()
+        await asyncio.gather(*(self.quit_async_smtp(conn) for conn in conns))
@@ -0,0 +1,254 @@
+import asyncio
+import base64
+import smtplib
+import socket
+import ssl
+
+from message_template import Message
+from smtp_protocol import STAGE_ENVELOPE, STAGE_MAIL, STAGE_SENT, check_envelope, encode_envelope, iter_data
+
+
+class AsyncSMTP:
+    """
+    Minimal asyncio SMTP client, implementing only what the sender needs: EHLO, STARTTLS, AUTH PLAIN, sending a message
+        and QUIT. The envelope of a message is sent in one write if the server supports PIPELINING, and the message is
+        written in chunks. Errors are raised as the smtplib exceptions, so that both sending engines handle them the
+        same way, and 'stage' tells how far the transaction of the last message got, as in PipeliningSMTP
+    """
+    def __init__(self, host: str, port: int, timeout: float = 60):
+        """
+        :param host: Address of the SMTP server
+        :param port: Port of the SMTP server
+        :param timeout: Seconds to wait for any single reply of the server
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.esmtp_features = {}
+        self.stage = STAGE_MAIL
+
+    async def connect(self) -> None:
+        """
+        Opens the connection, reads the greeting of the server and introduces the client with EHLO
+        :return: None
+        """
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise smtplib.SMTPConnectError(-1, f'Connection to {self.host}:{self.port} failed: {e}')
+
+        code, msg = await self.get_reply()
+        if code != 220:
+            await self.close()
+            raise smtplib.SMTPConnectError(code, msg)
+        await self.ehlo()
+
+    async def ehlo(self) -> None:
+        """
+        Sends EHLO and records the extensions advertised by the server
+        :return: None
+        """
+        code, msg = await self.command(f'EHLO {socket.getfqdn()}')
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, msg)
+
+        self.esmtp_features = {}
+        for line in msg.decode('ascii', 'replace').split('\n')[1:]:
+            feature, _, params = line.partition(' ')
+            self.esmtp_features[feature.lower()] = params
+
+    async def starttls(self) -> None:
+        """
+        Upgrades the connection to TLS, after which the client has to introduce itself again
+        :return: None
+        """
+        if 'starttls' not in self.esmtp_features:
+            raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server')
+
+        code, msg = await self.command('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, msg)
+        await self.writer.start_tls(ssl.create_default_context(), server_hostname=self.host)
+        await self.ehlo()
+
+    async def login(self, user: str, password: str) -> None:
+        """
+        Authenticates with AUTH PLAIN
+        :param user: Username, the email address for Gmail
+        :param password: Password of the account
+        :return: None
+        """
+        token = base64.b64encode(f'\0{user}\0{password}'.encode()).decode('ascii')
+        code, msg = await self.command(f'AUTH PLAIN {token}')
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, msg)
+
+    async def sendmail(self, from_addr: str, to_addrs: str | list[str],
+                       msg: str | bytes | Message) -> dict[str, tuple[int, bytes]]:
+        """
+        Sends one message through the MAIL FROM, RCPT TO and DATA commands
+        :param from_addr: Envelope sender
+        :param to_addrs: Envelope recipient or recipients
+        :param msg: The message, either a string of ASCII characters, bytes, or segments from MessageTemplate.assemble
+        :return: Reply of the server to every recipient it refused, as smtplib.SMTP.sendmail. If it refused all of them,
+            SMTPRecipientsRefused is raised instead
+        """
+        self.stage = STAGE_MAIL
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if 'pipelining' in self.esmtp_features:
+            return await self.sendmail_pipelined(from_addr, to_addrs, msg)
+
+        code, resp = await self.command(f'MAIL FROM:<{from_addr}>')
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        self.stage = STAGE_ENVELOPE
+
+        refused = {}
+        for to_addr in to_addrs:
+            code, resp = await self.command(f'RCPT TO:<{to_addr}>')
+            if code not in (250, 251):
+                refused[to_addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = await self.command('DATA')
+        if code != 354:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, resp)
+
+        await self.write_data(msg)
+        code, resp = await self.get_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    async def sendmail_pipelined(self, from_addr: str, to_addrs: list[str],
+                                 msg: str | bytes | Message) -> dict[str, tuple[int, bytes]]:
+        """
+        Sends one message with the MAIL FROM, RCPT TO and DATA commands written at once, as allowed by the PIPELINING
+            extension (RFC 2920), so that the envelope costs one round trip
+        :param from_addr: Envelope sender
+        :param to_addrs: Envelope recipients
+        :param msg: The message, either a string of ASCII characters, bytes, or segments from MessageTemplate.assemble
+        :return: Reply of the server to every recipient it refused
+        """
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected('Please run connect() first')
+        self.writer.write(encode_envelope(from_addr, to_addrs))
+        replies = []
+        for _ in range(len(to_addrs) + 2):
+            replies.append(await self.get_reply())
+            if len(replies) == 1 and replies[0][0] == 250:
+                self.stage = STAGE_ENVELOPE
+
+        error, refused = check_envelope(from_addr, to_addrs, replies)
+        if error is not None:
+            if replies[-1][0] == 354:  # The server accepted DATA although the envelope failed, end the empty message
+                self.writer.write(b'.\r\n')
+                await self.get_reply()
+            await self.rset()
+            raise error
+
+        await self.write_data(msg)
+        code, resp = await self.get_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    async def write_data(self, msg: str | bytes | Message) -> None:
+        """
+        Writes a message after the server accepted DATA, waiting for each chunk to be flushed before the next, so that
+            a large attachment isn't buffered whole in the transport of every session
+        :param msg: The message, either a string of ASCII characters, bytes, or segments from MessageTemplate.assemble
+        :return: None
+        """
+        try:
+            for chunk in iter_data(msg):
+                self.writer.write(chunk)
+                await self.writer.drain()
+        except (OSError, ssl.SSLError) as e:
+            await self.close()
+            raise smtplib.SMTPServerDisconnected(f'Connection lost: {e!r}')
+        self.stage = STAGE_SENT
+
+    async def noop(self) -> tuple[int, bytes]:
+        """
+        :return: Reply of the server to NOOP
+        """
+        return await self.command('NOOP')
+
+    async def rset(self) -> None:
+        """
+        Aborts the current mail transaction, ignoring a dead connection as the caller is already failing
+        :return: None
+        """
+        try:
+            await self.command('RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def quit(self) -> None:
+        """
+        Sends QUIT and closes the connection
+        :return: None
+        """
+        try:
+            await self.command('QUIT')
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        """
+        Closes the connection without saying goodbye to the server
+        :return: None
+        """
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+        self.reader = None
+        self.writer = None
+
+    async def command(self, line: str) -> tuple[int, bytes]:
+        """
+        :param line: Command to send, without the line ending
+        :return: Reply code and message of the server
+        """
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected('Please run connect() first')
+        self.writer.write(line.encode('ascii') + b'\r\n')
+        return await self.get_reply()
+
+    async def get_reply(self) -> tuple[int, bytes]:
+        """
+        Reads a possibly multiline reply of the server
+        :return: Reply code and message, where the lines of a multiline reply are joined by newlines
+        """
+        lines = []
+        try:
+            await self.writer.drain()
+            while True:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+                if not line:
+                    await self.close()
+                    raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+                lines.append(line[4:].strip(b' \t\r\n'))
+                if line[3:4] != b'-':
+                    break
+            code = int(line[:3])
+        except smtplib.SMTPServerDisconnected:
+            raise
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            await self.close()
+            raise smtplib.SMTPServerDisconnected(f'Connection lost: {e!r}')
+
+        return code, b'\n'.join(lines)
+
@@ -0,0 +1,101 @@
+import base64
+import hashlib
+import mimetypes
+import mmap
+import os
+
+CACHE_DIR = '.cache'  # Folder of the attachments folder where the encoded attachments are kept
+LINE_LEN = 76  # Characters per line of base64, as written by the email package
+CHUNK_LINES = 1024  # Lines of base64 encoded at once when an attachment is first encoded
+
+
+class Attachment:
+    """
+    A file attached to the emails of an event, base64 encoded once into a cache file named after the hash of its content
+        and memory mapped. 'encoded' is a view of the mapped file, so the emails of every worker share the same pages
+        and sending an email doesn't copy the attachment, it's written to the socket in chunks straight from the cache.
+        Images are embedded inline, the first one with the Content-ID 'image' referenced by the bodies as 'cid:image',
+        the others with their file name. Other files, such as PDF schedules, are regular attachments
+    """
+    def __init__(self, attachments_path: str, filename: str, content_id: str | None):
+        """
+        :param attachments_path: Path of the attachments folder
+        :param filename: Name of the file in the attachments folder
+        :param content_id: Content-ID of an inline image, or None for a regular attachment
+        """
+        self.filename = filename
+        self.content_id = content_id
+        self.content_type = Attachment.guess_type(filename)
+
+        with open(os.path.join(attachments_path, filename), 'rb') as file:
+            self.size = os.fstat(file.fileno()).st_size
+            source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+            try:
+                self.digest = hashlib.sha256(source).hexdigest()
+                self.cache_path = os.path.join(attachments_path, CACHE_DIR, f'{self.digest}.b64')
+                if not os.path.exists(self.cache_path):
+                    Attachment.encode(source, self.cache_path)
+            finally:
+                if isinstance(source, mmap.mmap):
+                    source.close()
+
+        self.encoded = memoryview(b'')
+        if os.path.getsize(self.cache_path):
+            with open(self.cache_path, 'rb') as file:
+                self.encoded = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @staticmethod
+    def guess_type(filename: str) -> str:
+        """
+        :param filename: Name of the file
+        :return: MIME type of the file guessed from its extension, 'application/octet-stream' if it's unknown
+        """
+        content_type, encoding = mimetypes.guess_type(filename)
+        if content_type is None or encoding is not None:  # A compressed file is sent as it is
+            return 'application/octet-stream'
+        return content_type
+
+    @staticmethod
+    def encode(source: bytes | mmap.mmap, cache_path: str) -> None:
+        """
+        Base64 encodes a file into the cache as sent on the wire: lines of 76 characters ending with CRLF. The file is
+            encoded a chunk at a time and renamed into place once complete, so that runs encoding the same file at the
+            same time don't read a partial file
+        :param source: Content of the file
+        :param cache_path: Path of the cache file
+        :return: None
+        """
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        chunk_size = LINE_LEN // 4 * 3 * CHUNK_LINES  # Bytes encoded into whole lines
+        with open(tmp_path, 'wb') as file:
+            for start in range(0, len(source), chunk_size):
+                encoded = base64.b64encode(source[start:start + chunk_size])
+                file.write(b''.join(encoded[i:i + LINE_LEN] + b'\r\n' for i in range(0, len(encoded), LINE_LEN)))
+        os.replace(tmp_path, cache_path)
+
+    def is_inline(self) -> bool:
+        """
+        :return: Whether the attachment is an image embedded in the body
+        """
+        return self.content_id is not None
+
+
+def load_attachments(attachments_path: str, attachment: str | list[str] | None) -> list[Attachment]:
+    """
+    :param attachments_path: Path of the attachments folder
+    :param attachment: The 'attachment' field of the event: a file name, a list of file names, or None
+    :return: The attachments of the event, in the given order
+    """
+    if attachment is None:
+        return []
+    filenames = [attachment] if isinstance(attachment, str) else attachment
+
+    attachments = []
+    for filename in filenames:
+        content_id = None
+        if Attachment.guess_type(filename).startswith('image/'):
+            # The first image keeps the Content-ID of the single image events used to have
+            content_id = 'image' if not any(a.is_inline() for a in attachments) else filename
+        attachments.append(Attachment(attachments_path, filename, content_id))
+    return attachments
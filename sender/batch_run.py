@@ -0,0 +1,296 @@
+import argparse
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from time import time
+from typing import Any, Callable
+
+from email_content import EmailContent
+from database import Database
+from fair_scheduler import FairScheduler
+from input_reader import InputReader
+from metrics import Metrics, MetricsExporter
+from pipeline import Pipeline
+from preflight import Preflight
+from run_setup import event_path, make_email_sender, open_journal, open_report, write_excel_reports
+from suppression import SuppressionIndex
+import utils
+
+
+class EventRun:
+    """
+    One event of a batch run, with what is kept separate between the events: its rows, journal, sender, delivery
+        report, metrics and log lines
+    """
+    def __init__(self, event_key: str, event_details: dict[str], logger: logging.Logger):
+        """
+        :param event_key: Event key identifier of the event
+        :param event_details: Dictionary of all necessary details of the event
+        :param logger: Logger of the event, from utils.get_event_logger
+        """
+        self.key = event_key
+        self.details = event_details
+        self.logger = logger
+        self.db = None
+        self.journal = None
+        self.delivered_row_ids = set()
+        self.no_of_emails = 0
+        self.email_sender = None
+        self.report = None
+        self.metrics = Metrics()
+        self.pipeline = None
+
+
+class BatchProgress:
+    """
+    One progress bar for all the events of a batch run, redrawn by the sender of any event, as the bars of the events
+        would otherwise overwrite each other on the same line
+    """
+    def __init__(self, runs: list[EventRun], progress_bar_len: int):
+        """
+        :param runs: Events with emails left to send, each with its sender once sending starts
+        :param progress_bar_len: Number of characters in the live progress bar
+        """
+        self.runs = runs
+        self.progress_bar_len = progress_bar_len
+        self.lock = threading.Lock()
+        self.start_time = time()
+
+    def draw(self) -> None:
+        """
+        Redraws the progress bar with the emails sent by every event, can be called from any thread
+        :return: None
+        """
+        with self.lock:
+            total_emails = sum(run.no_of_emails for run in self.runs)
+            emails_sent = sum(run.email_sender.emails_sent for run in self.runs)
+            num_emails_attempted = sum(run.email_sender.num_emails_attempted for run in self.runs)
+            stars = int(emails_sent / total_emails * self.progress_bar_len)
+            dashes = self.progress_bar_len - stars
+
+            prediction_of_remaining = ((total_emails - num_emails_attempted) * (time() - self.start_time)
+                                       / max(num_emails_attempted, 1))
+            predicted_mins, predicted_secs = map(int, divmod(prediction_of_remaining, 60))
+
+            events = ', '.join(f'{run.key} {run.email_sender.emails_sent}/{run.no_of_emails}' for run in self.runs)
+            print(f"\rProgress: {'*' * stars}{'-' * dashes} {emails_sent}/{total_emails} emails sent ({events}). "
+                  f"Time remaining {predicted_mins} minutes and {predicted_secs} seconds", end='')
+
+
+def render_rows(get_email_contents: Callable, event_details: dict[str],
+                data: list[tuple[Any, ...]]) -> list[EmailContent]:
+    """
+    :param get_email_contents: Email contents getter of the event, from utils.select_function
+    :param event_details: Dictionary of all necessary details of the event
+    :param data: Batch of rows from the database
+    :return: EmailContent object of every row
+    """
+    return get_email_contents(data, event_details['cols'], event_details['body'])
+
+
+def run_batch(args: argparse.Namespace, project_path: str, suppression: SuppressionIndex, suppressed: set[str] | None,
+              database_factory: Callable[..., Database] = Database, itersize: int = 1000) -> None:
+    """
+    Sends the emails of several events in one run. The events share the database connection and the accounts, with
+        their SMTP connections and rate limits, so that together they stay within the limits of the accounts instead of
+        each run competing for them. Their batches are interleaved fairly by FairScheduler, and each event keeps its own
+        journal entries, delivery report, metrics and log lines, while one progress bar shows all of them. As in a
+        single event run, the tables are opened while the accounts are chosen, and the senders are made and logged in
+        while the run is confirmed
+    :param args: Command line options, from InputReader.get_args
+    :param project_path: Path of the project directory
+    :param suppression: Index the recipients refused permanently are added to
+    :param suppressed: Addresses of the suppression index that are not emailed, or None to email every row
+    :param database_factory: Function opening the source of the rows, called with the arguments of Database
+    :param itersize: Number of rows fetched per network round trip by the server-side cursors
+    :return: None
+    """
+    try:
+        events = InputReader.get_events_input(project_path, args.events)
+        for event_details in events.values():
+            utils.check_event_details_validity(event_details)
+    except FileNotFoundError as e:
+        sys.exit(str(e))
+
+    logger = utils.get_logger(f'Batch of {len(events)} events', log_path=args.log_file, log_format=args.log_format,
+                              success_sample_rate=args.log_success_sample_rate)
+    all_runs = [EventRun(event_key, event_details, utils.get_event_logger(logger, event_key, event_details['name']))
+                for event_key, event_details in events.items()]
+    runs = []  # Events with emails left to send
+    preflight = Preflight()
+    executor = ThreadPoolExecutor(max_workers=args.max_workers)
+
+    def open_tables() -> None:
+        # The first event opens the database connection, the others read their tables with their own cursors on it
+        for run in all_runs:
+            run.db = database_factory(
+                logger=run.logger,
+                cols=run.details['cols'],
+                project_path=project_path,
+                table_name=run.details['table_name'],
+                grouping_requirement=run.details['grouping_requirement'],
+                itersize=itersize,
+                conn=all_runs[0].db.conn if run is not all_runs[0] else None,
+                suppressed=suppressed,
+                dedup=args.dedup
+            )
+            run.journal = open_journal(args, run.details['table_name'])
+            run.delivered_row_ids = run.journal.delivered_row_ids() if args.resume else set()
+            run.no_of_emails = run.db.count_remaining(run.delivered_row_ids)
+
+    try:
+        if args.spool is not None or args.drain is not None:
+            raise ValueError('--spool and --drain take a single event, given with --event')
+        if args.event is not None:
+            raise ValueError('--event and --events can not be used together')
+        for run in all_runs:
+            utils.check_body_validity(run.details)
+
+        # The accounts are shared, so the events must be sent by the same engine
+        engines = {run.details['engine'] for run in all_runs} - {None}
+        if args.engine is None and len(engines) > 1:
+            raise ValueError(f'The events use different engines: {', '.join(sorted(engines))}, choose one with '
+                             f'--engine')
+        engine = args.engine or next(iter(engines), None) or 'threaded'
+        logger.info(f'Batch run of the events {', '.join(events)} using the {engine} sending engine')
+
+        preflight.start('databases', open_tables)
+        accounts = InputReader.get_accounts_input(os.path.join(project_path, 'email_details'), args.accounts)
+        preflight.result('databases')
+
+        for run in all_runs:
+            if run.db.length == 0:
+                print(f'{run.key}: No emails found, table is empty')
+                run.logger.info('No emails found, table is empty')
+            elif run.no_of_emails <= 0:
+                print(f'{run.key}: All emails have already been delivered')
+                run.logger.info('All emails have already been delivered')
+            else:
+                if run.no_of_emails < run.db.length:
+                    run.logger.info(f'Resuming, skipping {run.db.length - run.no_of_emails} already delivered emails')
+                print(f'{run.key}: {run.no_of_emails} email{'s' if run.no_of_emails != 1 else ''}')
+                runs.append(run)
+        if not runs:
+            raise AttributeError('No emails left to send in any of the events')
+
+        # The first sender creates the accounts, the others are closed before it, as their emails use its connections
+        progress = BatchProgress(runs, progress_bar_len=30)
+
+        def make_senders() -> None:
+            for run in runs:
+                run.email_sender = make_email_sender(
+                    args, engine, logger=run.logger, project_path=project_path, event_details=run.details,
+                    accounts=accounts, total_emails=run.no_of_emails, progress_bar_len=progress.progress_bar_len,
+                    executor=executor, journal=run.journal, metrics=run.metrics, suppression=suppression,
+                    max_recipients_per_message=args.max_recipients_per_message, rate_logger=logger,
+                    share_with=runs[0].email_sender if run is not runs[0] else None, draw_progress=progress.draw)
+            preflight.start('smtp warm-up', runs[0].email_sender.warm_up)
+
+        preflight.start('email senders', make_senders)
+        if args.render_processes > 0:
+            # Imported here so that the multiprocessing machinery is only loaded when it's used
+            from render_pool import make_render_pool, render_batch
+            preflight.start('render processes', lambda: make_render_pool(args.render_processes))
+
+        no_of_emails = sum(run.no_of_emails for run in runs)
+        confirm = 'yes' if args.yes else utils.get_confirmation(no_of_emails, 's' if no_of_emails != 1 else '')
+        if confirm != 'yes':
+            print('Emails not sent')
+            logger.info('Email sending terminated, emails not sent')
+            return
+
+        print('Sending emails...')
+        logger.info('Starting email sending process')
+        start_time = progress.start_time = time()
+        preflight.result('email senders')
+        render_executor = preflight.result('render processes') if args.render_processes > 0 else None
+        queue_depth = args.queue_depth if render_executor is None else max(args.queue_depth, 2 * args.render_processes)
+
+        with ExitStack() as stack:
+            # Exited in reverse order: the pipelines, then the senders, the one the accounts belong to last, then the
+            # metrics exporters, so that their last snapshot includes the closed connections
+            for run in runs:
+                run.report = open_report(args, run.key)
+                run.email_sender.report = run.report
+                run.logger.info(f'Writing the delivery report to {run.report.path}')
+                if args.metrics_file is not None:
+                    metrics_path = event_path(args.metrics_file, run.key)
+                    stack.enter_context(MetricsExporter(logger=run.logger, metrics=run.metrics, path=metrics_path,
+                                                        export_format=args.metrics_format,
+                                                        interval=args.metrics_interval))
+            for run in runs:
+                stack.enter_context(run.email_sender)
+            for run in runs:
+                if render_executor is not None:
+                    render = partial(render_batch, run.details['email_sender'], run.details['cols'],
+                                     run.details['body'])
+                else:
+                    render = partial(render_rows, utils.select_function(run.details['email_sender']), run.details)
+                run.pipeline = stack.enter_context(Pipeline(
+                    logger=run.logger,
+                    batches=run.db.iter_batches(batch_size=args.batch_size),
+                    render=render,
+                    queue_depth=queue_depth,
+                    skip_row_ids=run.delivered_row_ids,
+                    metrics=run.metrics,
+                    render_executor=render_executor,
+                    suppressed=None if run.db.filters_rows() else suppressed,
+                    dedup=not run.db.filters_rows() and args.dedup
+                ))
+
+            email_senders = {run.key: run.email_sender for run in runs}
+            for event_key, email_contents in FairScheduler({run.key: run.pipeline for run in runs}):
+                email_senders[event_key].send_emails(email_contents=email_contents)
+            for run in runs:
+                run.email_sender.wait()
+
+        print()
+        for run in runs:
+            run.report.close()
+            if args.excel_report != 'none':
+                write_excel_reports(args, run.report, run.key)
+                run.logger.info('Successfully written Excel email reports')
+
+            num_batches = run.email_sender.batch_no
+            batch_suffix = '' if num_batches == 1 else 'es'
+            print(f'{run.key}: {run.email_sender.emails_sent}/{run.no_of_emails} emails sent in {num_batches} '
+                  f'batch{batch_suffix}')
+            run.logger.info(f'{run.email_sender.emails_sent}/{run.no_of_emails} emails sent successfully in '
+                            f'{num_batches} batch{batch_suffix}')
+
+        mins, secs = divmod(time() - start_time, 60)
+        mins, secs = int(mins), round(secs, 2)
+        print(f'Events sent, time taken: {mins} minutes and {secs} seconds')
+        logger.info(f'{len(runs)} events sent, time taken: {mins} minutes and {secs} seconds')
+
+    except FileNotFoundError as e:  # Already starts with 'Error:'
+        utils.terminate(logger, str(e))
+
+    except Exception as e:
+        utils.terminate(logger, f'Error: {str(e)}')
+
+    finally:
+        # Waits for the steps still running in the background. The senders and databases sharing the accounts and the
+        # connection of the first event are closed before it
+        preflight.shutdown()
+        preflight.log_timings(logger)
+        for run in reversed(all_runs):
+            if run.email_sender is not None:
+                run.email_sender.close()
+        executor.shutdown()
+        render_executor = preflight.result_if_done('render processes')
+        if render_executor is not None:
+            render_executor.shutdown(cancel_futures=True)
+        for run in reversed(all_runs):
+            if run.db is not None:
+                run.db.stop()
+            if run.journal is not None:
+                run.journal.close()
+            if run.report is not None:
+                run.report.close()
+        logger.info('Database connection closed')
+        logger.info('Finished batch run')
@@ -0,0 +1,184 @@
+import argparse
+import asyncio
+import random
+import threading
+
+
+class FakeSMTPServer:
+    """
+    Local SMTP server that accepts every email without delivering it, for benchmarking the sender without emailing
+        anyone. It can add latency to every email and refuse a fraction of them with a throttling reply, a permanent
+        error or a dropped connection. It advertises PIPELINING unless disabled, to compare both ways of sending the
+        envelope. It doesn't support TLS, so the sender must run with --no-starttls
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, throttle_rate: float = 0.0,
+                 error_rate: float = 0.0, disconnect_rate: float = 0.0, seed: int = None, pipelining: bool = True,
+                 rcpt_replies: dict[str, bytes] = None):
+        """
+        :param host: Address to listen on
+        :param port: Port to listen on, or 0 for any free port
+        :param latency: Seconds the server waits before accepting each email, as a real server does while queuing it
+        :param throttle_rate: Fraction of recipients refused with '450', a transient throttling reply
+        :param error_rate: Fraction of recipients refused with '550', a permanent error
+        :param disconnect_rate: Fraction of emails after which the connection is dropped without a reply
+        :param seed: Seed of the random choices, or None
+        :param pipelining: Whether to advertise the PIPELINING extension. Commands are always read one line at a time,
+            so pipelined commands are answered in order
+        :param rcpt_replies: Reply to RCPT TO of some addresses, such as b'550 5.1.1 No such user', given to them every
+            time instead of a random one, or None
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.pipelining = pipelining
+        self.rcpt_replies = rcpt_replies or {}
+        self.random = random.Random(seed)
+
+        self.num_connections = 0
+        self.num_commands = 0
+        self.num_messages = 0
+        self.num_recipients = 0
+        self.num_bytes = 0
+        self.num_throttled = 0
+        self.num_errors = 0
+        self.num_disconnects = 0
+
+        self.server = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fake-smtp-server', daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def start(self) -> None:
+        """
+        Starts listening in a background thread, 'port' is the actual port once this returns
+        :return: None
+        """
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.handle, self.host, self.port), self.loop).result()
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: Counters of what the server received and refused
+        """
+        return {'connections': self.num_connections, 'commands': self.num_commands, 'messages': self.num_messages,
+                'recipients': self.num_recipients, 'bytes': self.num_bytes,
+                'throttled': self.num_throttled, 'errors': self.num_errors, 'disconnects': self.num_disconnects}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serves one SMTP session
+        :param reader: Stream of the client's commands
+        :param writer: Stream of the server's replies
+        :return: None
+        """
+        self.num_connections += 1
+        extensions = b'250-fake.smtp\r\n250-8BITMIME\r\n' + (b'250-PIPELINING\r\n' if self.pipelining else b'')
+        num_recipients = 0  # Recipients accepted in the current transaction
+        writer.write(b'220 fake.smtp ESMTP ready\r\n')
+        try:
+            while line := await reader.readline():
+                self.num_commands += 1
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    writer.write(extensions + b'250 AUTH PLAIN\r\n')
+                elif command == b'AUTH':
+                    writer.write(b'235 2.7.0 Authentication successful\r\n')
+                elif command == b'RCPT':
+                    address = line[line.find(b'<') + 1:line.rfind(b'>')].decode('ascii', 'replace')
+                    draw = self.random.random()
+                    if address in self.rcpt_replies:
+                        num_recipients += self.rcpt_replies[address].startswith(b'2')
+                        writer.write(self.rcpt_replies[address] + b'\r\n')
+                    elif draw < self.throttle_rate:
+                        self.num_throttled += 1
+                        writer.write(b'450 4.2.1 Rate limited, try again later\r\n')
+                    elif draw < self.throttle_rate + self.error_rate:
+                        self.num_errors += 1
+                        writer.write(b'550 5.1.1 No such user\r\n')
+                    else:
+                        num_recipients += 1
+                        writer.write(b'250 2.1.5 OK\r\n')
+                elif command == b'DATA' and num_recipients == 0:
+                    writer.write(b'554 5.5.1 No valid recipients\r\n')
+                elif command == b'DATA':
+                    writer.write(b'354 Go ahead\r\n')
+                    await writer.drain()
+                    size = 0
+                    while (data_line := await reader.readline()) not in (b'.\r\n', b''):
+                        size += len(data_line)
+                    if self.random.random() < self.disconnect_rate:
+                        self.num_disconnects += 1
+                        break
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    self.num_messages += 1
+                    self.num_recipients += num_recipients
+                    self.num_bytes += size
+                    num_recipients = 0
+                    writer.write(b'250 2.0.0 OK queued\r\n')
+                elif command == b'STAR':
+                    writer.write(b'454 4.7.0 TLS not available\r\n')
+                elif command == b'QUIT':
+                    writer.write(b'221 2.0.0 Bye\r\n')
+                    await writer.drain()
+                    break
+                else:  # HELO, MAIL, RSET and NOOP
+                    if command in (b'MAIL', b'RSET'):
+                        num_recipients = 0
+                    writer.write(b'250 2.0.0 OK\r\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def stop(self) -> None:
+        """
+        Stops listening and the background thread. The server is closed in its event loop, as closing it from another
+            thread races with the sessions that are ending
+        :return: None
+        """
+        async def close() -> None:
+            self.server.close()
+            await self.server.wait_closed()
+
+        if self.server is not None:
+            asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local SMTP server that accepts emails without delivering them')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every email')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of recipients refused with '450'")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of recipients refused with '550'")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='Fraction of emails followed by a drop')
+    parser.add_argument('--no-pipelining', action='store_true', help="Don't advertise the PIPELINING extension")
+    args = parser.parse_args()
+
+    with FakeSMTPServer(args.host, args.port, args.latency, args.throttle_rate, args.error_rate,
+                        args.disconnect_rate, pipelining=not args.no_pipelining) as server:
+        print(f'Fake SMTP server listening on {args.host}:{server.port}, press Ctrl+C to stop')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            print(f'\n{server.stats()}')
+
+
+if __name__ == '__main__':
+    main()
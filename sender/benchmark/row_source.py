@@ -0,0 +1,68 @@
+import logging
+from typing import Any, Collection, Iterator
+
+
+class SyntheticDatabase:
+    """
+    Stand-in for Database that generates the rows of the table in memory instead of reading them from PostgreSQL, so
+        that the sender can be benchmarked without a database. Takes the same arguments as Database, plus the number of
+        rows, and provides what main uses: 'length', count_remaining, iter_batches, filters_rows and stop
+    """
+    def __init__(self, logger: logging.Logger, cols: list[str], project_path: str, table_name: str,
+                 grouping_requirement: str, itersize: int = 2000, conn=None, suppressed: Collection[str] = None,
+                 dedup: bool = False, num_rows: int = 1000):
+        """
+        :param logger: Reuse the same configured logger
+        :param cols: Columns of the rows, 'email' is filled with a unique address and the others with placeholder text
+        :param project_path: Unused, Database reads the connection details from it
+        :param table_name: Name of the table, only used in the values of the rows
+        :param grouping_requirement: Must be None, grouped events need real groups
+        :param itersize: Unused, the rows are generated one batch at a time
+        :param conn: Unused, there is no connection to share
+        :param suppressed: Unused, the Pipeline skips the emails of suppressed addresses instead
+        :param dedup: Unused, every generated address is unique
+        :param num_rows: Number of rows of the table
+        """
+        if grouping_requirement is not None:
+            raise ValueError('The synthetic row source does not support grouping requirements')
+
+        self.logger = logger
+        self.cols = cols
+        self.table_name = table_name
+        self.length = num_rows
+        self.conn = None
+
+    def make_row(self, row_id: int) -> tuple[Any, ...]:
+        """
+        :param row_id: id of the row, from 1
+        :return: Values of the columns followed by the id
+        """
+        return tuple(f'recipient{row_id}@example.com' if col == 'email' else f'{col} {row_id}'
+                     for col in self.cols) + (row_id,)
+
+    def iter_batches(self, batch_size: int) -> Iterator[list[tuple[Any, ...]]]:
+        """
+        :param batch_size: Length of the batch
+        :return: Generator of the batches, each row has the columns followed by the id of the row
+        """
+        for start in range(1, self.length + 1, batch_size):
+            yield [self.make_row(row_id) for row_id in range(start, min(start + batch_size, self.length + 1))]
+
+    def count_remaining(self, skip_row_ids: Collection[int]) -> int:
+        """
+        :param skip_row_ids: ids of the rows whose email must not be sent again
+        :return: Number of emails to be sent without those rows
+        """
+        return self.length - sum(1 <= row_id <= self.length for row_id in skip_row_ids)
+
+    def filters_rows(self) -> bool:
+        """
+        :return: False, the rows of suppressed addresses are generated like the others
+        """
+        return False
+
+    def stop(self) -> None:
+        """
+        Nothing to close
+        :return: None
+        """
@@ -0,0 +1,149 @@
+import argparse
+from datetime import datetime, timezone
+from itertools import product
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+from benchmark.fake_smtp import FakeSMTPServer
+
+SENDER_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_PATH = os.path.dirname(SENDER_PATH)
+
+
+def int_list(text: str) -> list[int]:
+    """
+    :param text: Comma separated integers
+    :return: The integers
+    """
+    return [int(value) for value in text.split(',')]
+
+
+def make_project(path: str) -> None:
+    """
+    Creates a project directory with a benchmark event, a copy of the example event with its attachment, and an
+        account for the fake SMTP server
+    :param path: Path of the project directory
+    :return: None
+    """
+    with open(os.path.join(REPO_PATH, 'events', 'example', 'example.yaml')) as file:
+        event_details = yaml.safe_load(file)
+    event_details['name'] = 'Benchmark'
+
+    os.makedirs(os.path.join(path, 'events', 'benchmark'))
+    with open(os.path.join(path, 'events', 'benchmark', 'benchmark.yaml'), 'w') as file:
+        yaml.safe_dump(event_details, file)
+
+    os.makedirs(os.path.join(path, 'email_details'))
+    with open(os.path.join(path, 'email_details', 'email_details_benchmark.yaml'), 'w') as file:
+        yaml.safe_dump({'email': 'benchmark@example.com', 'password': 'benchmark'}, file)
+
+    shutil.copytree(os.path.join(REPO_PATH, 'attachments'), os.path.join(path, 'attachments'))
+
+
+def git_commit() -> str | None:
+    """
+    :return: Commit the benchmarked code is at, or None if it isn't in a git repository
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_once(project_path: str, run_path: str, rows: int, engine: str, max_workers: int, batch_size: int,
+             smtp_port: int, rate: float) -> dict:
+    """
+    Runs the sender once in its own process
+    :param project_path: Path of the project directory made by make_project
+    :param run_path: Empty directory the run writes its report and log to
+    :param rows: Number of emails
+    :param engine: 'threaded' or 'async'
+    :param max_workers: Sending threads of the threaded engine, and SMTP sessions of the async engine
+    :param batch_size: Number of emails per batch
+    :param smtp_port: Port of the fake SMTP server
+    :param rate: Upper bound of the sending rate, high enough not to limit the run
+    :return: Measurements of the run
+    """
+    result_path = os.path.join(run_path, 'result.json')
+    command = [
+        sys.executable, '-m', 'benchmark.run_once', '--project-path', project_path, '--rows', str(rows),
+        '--result', result_path, '--event', 'benchmark', '--accounts', 'benchmark', '--engine', engine,
+        '--max-workers', str(max_workers), '--max-connections', str(max_workers), '--batch-size', str(batch_size),
+        '--smtp-host', '127.0.0.1', '--smtp-port', str(smtp_port), '--no-starttls', '--initial-rate', str(rate),
+        '--max-rate', str(rate)
+    ]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SENDER_PATH, os.environ.get('PYTHONPATH')])))
+    subprocess.run(command, cwd=run_path, env=env, stdout=subprocess.DEVNULL, check=True)
+    with open(result_path) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the sender end to end against a local fake SMTP server and '
+                                                 'a synthetic row source')
+    parser.add_argument('--sizes', type=int_list, default=[1000, 10000, 100000],
+                        help='Comma separated numbers of recipients (default: 1000,10000,100000)')
+    parser.add_argument('--workers', type=int_list, default=[10, 20, 40],
+                        help='Comma separated values of --max-workers (default: 10,20,40)')
+    parser.add_argument('--batch-sizes', type=int_list, default=[40, 200],
+                        help='Comma separated values of --batch-size (default: 40,200)')
+    parser.add_argument('--engines', default='threaded', help='Comma separated engines (default: threaded)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds the fake SMTP server takes to accept each email (default: 0.005)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="Fraction of recipients the fake SMTP server refuses with '450' (default: 0)")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of recipients the fake SMTP server refuses with '550' (default: 0)")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0,
+                        help='Fraction of emails after which the fake SMTP server drops the connection (default: 0)')
+    parser.add_argument('--no-pipelining', action='store_true',
+                        help="Don't advertise PIPELINING from the fake SMTP server, so that the sender sends every "
+                             "envelope command separately")
+    parser.add_argument('--rate', type=float, default=100000,
+                        help='Upper bound of the sending rate, so that the rate controller does not cap the '
+                             'throughput (default: 100000)')
+    parser.add_argument('--output', default='benchmark_results.jsonl',
+                        help='JSON lines file the results are appended to (default: benchmark_results.jsonl)')
+    args = parser.parse_args()
+
+    run_info = {'commit': git_commit(), 'started_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(), 'platform': platform.platform()}
+    server_config = {'latency': args.latency, 'throttle_rate': args.throttle_rate, 'error_rate': args.error_rate,
+                     'disconnect_rate': args.disconnect_rate, 'pipelining': not args.no_pipelining}
+
+    with tempfile.TemporaryDirectory(prefix='sender-benchmark-') as tmp_path:
+        project_path = os.path.join(tmp_path, 'project')
+        make_project(project_path)
+
+        configs = product(args.engines.split(','), args.sizes, args.workers, args.batch_sizes)
+        for run_no, (engine, rows, max_workers, batch_size) in enumerate(configs):
+            run_path = os.path.join(tmp_path, f'run_{run_no}')
+            os.makedirs(run_path)
+
+            # A new server for every run, so that its counters are those of the run
+            with FakeSMTPServer(**server_config) as server:
+                result = run_once(project_path, run_path, rows, engine, max_workers, batch_size, server.port,
+                                  args.rate)
+                server_stats = server.stats()
+
+            record = run_info | {'engine': engine, 'max_workers': max_workers, 'batch_size': batch_size,
+                                 'smtp_server': server_config | server_stats} | result
+            with open(args.output, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+
+            p99 = 'n/a' if result['latency_p99'] is None else f'{result['latency_p99'] * 1000:.1f} ms'
+            print(f'{engine:8} rows={rows:<7} workers={max_workers:<3} batch={batch_size:<4} '
+                  f'{result['emails_per_second']:8.1f} emails/s  p99 {p99}  peak RSS {result['peak_rss_mb']:.0f} MB  '
+                  f'CPU {result['cpu_user_seconds'] + result['cpu_system_seconds']:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
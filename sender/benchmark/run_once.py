@@ -0,0 +1,71 @@
+import argparse
+import csv
+from functools import partial
+import json
+import resource
+import sys
+from time import perf_counter
+
+from benchmark.row_source import SyntheticDatabase
+
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    """
+    :param values: Sorted values
+    :param fraction: Fraction of the values below the percentile, between 0 and 1
+    :return: The percentile by the nearest rank method, or None if there are no values
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+def main():
+    """
+    Runs the sender end to end once, in the current directory, against a synthetic row source and an SMTP server that
+        is already running, and writes the measurements as JSON. Meant to be run in its own process by benchmark.run, so
+        that the peak memory and CPU time are those of this run only
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Run the sender once for the benchmark')
+    parser.add_argument('--project-path', required=True)
+    parser.add_argument('--rows', type=int, required=True)
+    parser.add_argument('--result', required=True, help='JSON file the measurements are written to')
+    args, sender_argv = parser.parse_known_args()
+
+    import main as sender_main  # Imported here so that the import time is part of the measured CPU time
+
+    start = perf_counter()
+    # The log and the suppression index of the run stay in the current directory, so that the addresses refused by the
+    # fake server aren't suppressed in the next runs
+    sender_main.main(sender_argv + ['--project-path', args.project_path, '--yes', '--journal-path', 'send_journal.db',
+                                    '--log-file', 'email_sender.log', '--suppression-path', 'suppression.db'],
+                     database_factory=partial(SyntheticDatabase, num_rows=args.rows))
+    wall_seconds = perf_counter() - start
+
+    latencies, num_sent = [], 0
+    with open('delivery_report.csv', newline='') as file:
+        for record in csv.DictReader(file):
+            num_sent += record['status'] == 'sent'
+            if record['latency']:
+                latencies.append(float(record['latency']))
+    latencies.sort()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result = {
+        'rows': args.rows,
+        'sent': num_sent,
+        'wall_seconds': wall_seconds,
+        'emails_per_second': num_sent / wall_seconds,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99),
+        'peak_rss_mb': usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024),  # Bytes on macOS
+        'cpu_user_seconds': usage.ru_utime,
+        'cpu_system_seconds': usage.ru_stime
+    }
+    with open(args.result, 'w') as file:
+        json.dump(result, file)
+
+
+if __name__ == '__main__':
+    main()
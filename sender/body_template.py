@@ -0,0 +1,71 @@
+from functools import lru_cache
+from string import Formatter
+from typing import Any, Callable
+
+
+class BodyTemplate:
+    """
+    An email body compiled once into its literal chunks and the indices of the values that go between them, so that
+        personalising it for a recipient is a single join over the row instead of re-parsing the whole template with
+        str.format. Uses the same placeholder syntax as str.format, with '{{' and '}}' for literal braces
+    """
+    def __init__(self, body: str, names: list[str]):
+        """
+        :param body: Email template with placeholders such as {first_name}
+        :param names: Names of the values of a row, in order, usually the columns of the SQL table
+        """
+        self.names = names
+        self.literals = ['']  # One more literal than slots, the chunks around and between the placeholders
+        self.slots = []  # Index in the row of the value of each placeholder
+        self.converters = []  # Turns the value of each placeholder into a string
+        self.placeholders = set()
+
+        for literal, field, format_spec, conversion in Formatter().parse(body):
+            self.literals[-1] += literal
+            if field is None:
+                continue
+
+            name = field.split('.', 1)[0].split('[', 1)[0]
+            if name not in names:
+                raise ValueError(f"Email body placeholder '{{{field}}}' is not one of the columns: {', '.join(names)}")
+
+            self.placeholders.add(name)
+            self.slots.append(names.index(name))
+            self.converters.append(self.make_converter(name, field, format_spec, conversion))
+            self.literals.append('')
+
+    @staticmethod
+    def make_converter(name: str, field: str, format_spec: str, conversion: str | None) -> Callable[[Any], str]:
+        """
+        :param name: Name of the value
+        :param field: Full field of the placeholder, possibly with attribute or index access
+        :param format_spec: Format specification of the placeholder, possibly empty
+        :param conversion: Conversion of the placeholder, 'r', 's', 'a' or None
+        :return: Function turning the value into the string str.format would have produced
+        """
+        if field == name and not format_spec and conversion is None:
+            return str
+
+        placeholder = '{' + field + ('' if conversion is None else '!' + conversion) + ':' + format_spec + '}'
+        return lambda value: placeholder.format(**{name: value})
+
+    def render(self, row: tuple[Any, ...]) -> str:
+        """
+        :param row: Values in the order of 'names'
+        :return: The personalised body
+        """
+        parts = [None] * (2 * len(self.slots) + 1)
+        parts[::2] = self.literals
+        parts[1::2] = [convert(row[slot]) for slot, convert in zip(self.slots, self.converters)]
+        return ''.join(parts)
+
+
+@lru_cache
+def compile_body(body: str, names: tuple[str, ...]) -> BodyTemplate:
+    """
+    Compiles an email body, only once for the same body and names
+    :param body: Email template with placeholders such as {first_name}
+    :param names: Names of the values of a row, in order
+    :return: The compiled template
+    """
+    return BodyTemplate(body, list(names))
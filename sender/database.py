@@ -1,19 +1,28 @@
 import logging
 import os
-from typing import Any
+from itertools import count
+from typing import Any, Collection, Iterator
 import yaml
-import psycopg2
 
 
 class Database:
-    def __init__(self, logger: logging.Logger, cols: list[str], project_path: str, table_name: str, grouping_requirement: str):
+    cursor_ids = count()  # Server-side cursors need a name that is unique within the connection, which can be shared
+
+    def __init__(self, logger: logging.Logger, cols: list[str], project_path: str, table_name: str, grouping_requirement: str,
+                 itersize: int = 2000, conn=None, suppressed: Collection[str] = None, dedup: bool = False):
         """
         :param logger: Reuse the same configured logger
         :param cols: Columns of the SQL table to be used in the emails
         :param project_path: Path of the project directory
         :param table_name: Name of the SQL table, used to retrieve table size
+        :param grouping_requirement: Column whose groups must not be split between batches, or None
+        :param itersize: Number of rows fetched per network round trip by the server-side cursors
+        :param conn: Connection of the Database of another event to share, which stays open when this one is stopped, or
+            None to open a new connection
+        :param suppressed: Normalised addresses whose rows are left out, from SuppressionIndex, or None
+        :param dedup: Whether to leave out the rows of an address but the first, so that nobody is emailed twice
         """
-        db_details = self.read_db_details(project_path)
+        import psycopg2  # Only imported once a database is needed, importing it is a large part of the startup time
 
         self.logger = logger
         self.cols = cols
@@ -21,9 +30,18 @@ class Database:
         self.grouping_requirement = grouping_requirement
         self.conn = None
         self.cur = None
-        self.groups = None
-        self.group_idx = 0
-        self.idx = 0
+        self.itersize = itersize
+        self.owns_conn = conn is None
+        self.suppressed = suppressed
+        self.dedup = dedup
+        if conn is not None:
+            self.conn = conn
+            self.cur = self.conn.cursor()
+            self.load_suppressed()
+            self.length = self.get_len()
+            return
+
+        db_details = self.read_db_details(project_path)
         try:
             self.conn = psycopg2.connect(
                 host=db_details['host'],
@@ -35,15 +53,19 @@ class Database:
             raise RuntimeError('SQL table not found')
 
         self.cur = self.conn.cursor()
+        self.load_suppressed()
         self.length = self.get_len()
 
-    def execute(self, query: str) -> list[tuple[Any, ...]]:
+    def execute(self, query: str, params: tuple[Any, ...] = None) -> list[tuple[Any, ...]]:
         """
         :param query: Query to be executed
+        :param params: Values bound to the %s placeholders of the query, or None if there are none
         :return: Return value of the query as a matrix
         """
+        import psycopg2
+
         try:
-            self.cur.execute(query)
+            self.cur.execute(query, params)
             return self.cur.fetchall()
         except psycopg2.errors.UndefinedTable as e:
             raise RuntimeError(f'SQL query failed: {str(e)}')
@@ -55,7 +77,7 @@ class Database:
         """
         if self.cur is not None:
             self.cur.close()
-        if self.conn is not None:
+        if self.conn is not None and self.owns_conn:
             self.conn.close()
 
     def read_db_details(self, project_path: str) -> dict[str, str]:
@@ -80,38 +102,150 @@ class Database:
 
         return db_details
 
+    def load_suppressed(self) -> None:
+        """
+        Copies the suppressed addresses into a temporary table of the connection, which the queries anti-join against.
+            Events sharing the connection share the table
+        :return: None
+        """
+        if not self.suppressed or 'email' not in self.cols:
+            return
+        from psycopg2.extras import execute_values
+
+        self.cur.execute('CREATE TEMPORARY TABLE IF NOT EXISTS suppressed_emails (email TEXT PRIMARY KEY);')
+        execute_values(self.cur, 'INSERT INTO suppressed_emails (email) VALUES %s ON CONFLICT DO NOTHING;',
+                       [(email,) for email in self.suppressed], page_size=1000)
+        self.cur.execute('ANALYZE suppressed_emails;')
+
+    def filter_conditions(self) -> dict[str, str]:
+        """
+        :return: Anti-join leaving out the rows of suppressed addresses and, with dedup, the one leaving out every row
+            of an address but the one with the smallest id, by what they leave out. Addresses are compared stripped and
+            in lower case. Tables without an email column are left as they are
+        """
+        if 'email' not in self.cols:
+            return {}
+        conditions = {}
+        if self.suppressed:
+            conditions['suppressed'] = ('NOT EXISTS (SELECT 1 FROM suppressed_emails s '
+                                        'WHERE s.email = lower(trim(r.email)))')
+        if self.dedup:
+            conditions['duplicate'] = 'r.first_of_address'
+        return conditions
+
+    def source(self) -> str:
+        """
+        With dedup, the first row of each address is marked once by a window over the table, rather than by looking
+            for an earlier row of the same address for every row, which is quadratic
+        :return: What the queries select from, aliased as 'r' by them
+        """
+        if 'email' not in self.cols or not self.dedup:
+            return self.table_name
+        return (f'(SELECT *, row_number() OVER (PARTITION BY lower(trim(email)) ORDER BY id) = 1 AS first_of_address '
+                f'FROM {self.table_name})')
+
+    def row_filter(self) -> str:
+        """
+        Leaves out the rows of suppressed and duplicate addresses, so that those rows are never fetched nor rendered
+        :return: Condition on the rows of the table, aliased as 'r', or 'TRUE'
+        """
+        return ' AND '.join(self.filter_conditions().values()) or 'TRUE'
+
+    def read_filter(self) -> str:
+        """
+        :return: Condition on the rows read by iter_rows. With a grouping requirement every row is read, as the emails
+            of the other members of a group are built from it, the Pipeline skips their emails instead
+        """
+        return self.row_filter() if self.grouping_requirement is None else 'TRUE'
+
+    def filters_rows(self) -> bool:
+        """
+        :return: Whether iter_batches already leaves out the rows of suppressed and duplicate addresses, otherwise the
+            Pipeline skips their emails
+        """
+        return self.read_filter() != 'TRUE' or not (self.suppressed or self.dedup)
+
     def get_len(self):
         """
-        :return: Number of rows in the table, which is the same as number of emails to be sent
+        :return: Number of rows in the table, without those of suppressed or duplicate addresses, which is the same as
+            number of emails to be sent
         """
-        return self.execute(f'SELECT COUNT(*) FROM {self.table_name}')[0][0]
+        conditions = self.filter_conditions()
+        counts = ''.join(f', COUNT(*) FILTER (WHERE NOT {condition})' for condition in conditions.values())
+        total, length, *num_left_out = self.execute(f'SELECT COUNT(*), COUNT(*) FILTER (WHERE {self.row_filter()})'
+                                                    f'{counts} FROM {self.source()} AS r')[0]
+        for reason, num_rows in zip(conditions, num_left_out):
+            if num_rows:
+                self.logger.info(f'Leaving out {num_rows} rows of {self.table_name} with {reason} addresses')
+        if len(conditions) > 1 and total > length:  # A row can be left out by both
+            self.logger.info(f'Leaving out {total - length} of the {total} rows of {self.table_name} in total')
+        return length
 
-    def get_data(self, batch_size: int = None) -> tuple[list[tuple[Any, ...]], bool]:
+    def count_remaining(self, skip_row_ids: Collection[int]) -> int:
         """
-        Reads SQL table for data
-        :param batch_size: Length of the batch, or None for no pagination
-        :return: A matrix of the data and an index to continue from
+        :param skip_row_ids: ids of the rows whose email must not be sent again, such as those already delivered
+        :return: Number of emails to be sent without those rows. Only the rows that aren't left out anyway count, so
+            that a row delivered and then suppressed isn't subtracted twice
         """
-        if batch_size is None:  # If no pagination, return the whole table
-            return self.execute(f'SELECT {','.join(self.cols)} FROM {self.table_name};'), False
+        if not skip_row_ids:
+            return self.length
+        num_skipped = self.execute(f'SELECT COUNT(*) FROM {self.source()} AS r WHERE id = ANY(%s) AND '
+                                   f'{self.row_filter()}', (list(skip_row_ids),))[0][0]
+        return self.length - num_skipped
 
-        if self.grouping_requirement is None:  # If pagination and no grouping requirements, return the requested part
-            self.idx += batch_size
-            return (self.execute(
-                f'SELECT {','.join(self.cols)} FROM {self.table_name} LIMIT {batch_size} OFFSET {self.idx - batch_size};'),
-                    self.idx < self.length)
+    def iter_rows(self, itersize: int = None, cols: list[str] = None) -> Iterator[tuple[Any, ...]]:
+        """
+        Streams the SQL table through a server-side cursor, so only 'itersize' rows are held in memory at a time. Rows
+            are ordered by the grouping requirement if there is one, then by id
+        :param itersize: Number of rows fetched per network round trip, or None to use the default of the database
+        :param cols: Columns to select, or None to use the columns of the event followed by the id of the row
+        :return: Generator of the rows of the table
+        """
+        import psycopg2
 
-        # If pagination and a grouping requirement, ensure that one group isn't split by retrieving group by group
-        if self.groups is None:
-            groups = self.execute(f'SELECT DISTINCT {self.grouping_requirement} FROM {self.table_name};')
-            self.groups = [elem[0] for elem in groups]
+        cols = self.cols + ['id'] if cols is None else cols
+        order_by = 'id' if self.grouping_requirement is None else f'{self.grouping_requirement}, id'
+        read_filter = self.read_filter()
+        source = self.table_name if read_filter == 'TRUE' else self.source()
+
+        cur = self.conn.cursor(name=f'{self.table_name}_{next(self.cursor_ids)}')
+        cur.itersize = self.itersize if itersize is None else itersize
+        try:
+            cur.execute(f'SELECT {','.join(cols)} FROM {source} AS r WHERE {read_filter} '
+                        f'ORDER BY {order_by};')
+            yield from cur
+        except psycopg2.errors.UndefinedTable as e:
+            raise RuntimeError(f'SQL query failed: {str(e)}')
+        finally:
+            cur.close()
 
-        data = []
-        for group in self.groups[self.group_idx:]:
-            self.group_idx += 1
-            data.extend(
-                self.execute(f"SELECT {','.join(self.cols)} FROM {self.table_name} WHERE {self.grouping_requirement} = '{group}';"))
-            if len(data) >= batch_size:
-                break
+    def iter_batches(self, batch_size: int) -> Iterator[list[tuple[Any, ...]]]:
+        """
+        Streams the SQL table in batches of at least 'batch_size' rows. If there is a grouping requirement, batches are
+            cut at group boundaries so that one group is never split, otherwise they are exactly 'batch_size' long. Each
+            row has the columns of the event followed by the id of the row
+        :param batch_size: Length of the batch
+        :return: Generator of the batches, the last of which may be shorter
+        """
+        if self.grouping_requirement is None:
+            batch = []
+            for row in self.iter_rows():
+                batch.append(row)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            return
 
-        return data, self.group_idx < len(self.groups)
+        # Select the group as an extra first column, used to find the group boundaries and then stripped
+        batch = []
+        group = None
+        for row in self.iter_rows(cols=[self.grouping_requirement] + self.cols + ['id']):
+            if row[0] != group and len(batch) >= batch_size:
+                yield batch
+                batch = []
+            group = row[0]
+            batch.append(row[1:])
+        if batch:
+            yield batch
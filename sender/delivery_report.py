@@ -0,0 +1,128 @@
+import csv
+import json
+import smtplib
+import threading
+from typing import TYPE_CHECKING
+
+from sending_account import QuotaExceededError
+from smtp_protocol import DeliveryUnknownError
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+FIELDS = ['email', 'status', 'smtp_code', 'latency', 'connection_id', 'attempts', 'phase', 'error', 'account']
+
+
+def get_failure_phase(e: Exception) -> str:
+    """
+    :param e: Exception the last attempt to send an email failed with
+    :return: Step at which the email failed: 'rcpt' if the server refused the recipient, 'mail' if it refused the
+        sender, 'data' if it refused the message, 'unknown' if the connection was lost before it replied to the
+        message, 'auth' if the account couldn't log in, 'connection' if the connection failed or was lost before the
+        message was sent, 'quota' if no account had any quota left, and 'other' for errors in the email itself
+    """
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return 'rcpt'
+    if isinstance(e, smtplib.SMTPSenderRefused):
+        return 'mail'
+    if isinstance(e, smtplib.SMTPDataError):
+        return 'data'
+    if isinstance(e, DeliveryUnknownError):
+        return 'unknown'
+    if isinstance(e, smtplib.SMTPAuthenticationError):
+        return 'auth'
+    if isinstance(e, QuotaExceededError):
+        return 'quota'
+    if isinstance(e, OSError):  # Includes the other smtplib exceptions, raised while connecting or by a lost connection
+        return 'connection'
+    return 'other'
+
+
+class DeliveryReport:
+    """
+    Report of the outcome of every email, appended one line per result as the results arrive. The file is line
+        buffered, so it's complete up to the last result even if the process is killed, and no result is kept in memory
+    """
+    def __init__(self, path: str, report_format: str = 'csv'):
+        """
+        :param path: Path of the report file, overwritten if it exists
+        :param report_format: 'csv' or 'jsonl'
+        """
+        if report_format not in ('csv', 'jsonl'):
+            raise ValueError(f"Report format must be 'csv' or 'jsonl', not '{report_format}'")
+
+        self.path = path
+        self.report_format = report_format
+        self.lock = threading.Lock()
+        self.file = open(path, 'w', buffering=1, newline='' if report_format == 'csv' else None, encoding='utf-8')
+        if report_format == 'csv':
+            self.writer = csv.writer(self.file, lineterminator='\n')
+            self.writer.writerow(FIELDS)
+
+    def record(self, email: str, status: str, smtp_code: int | None, latency: float | None, conn_id: int | None,
+               attempts: int, phase: str = None, error: str = None, account: str = None) -> None:
+        """
+        Appends the outcome of one email
+        :param email: Address of the recipient
+        :param status: 'sent' or 'failed'
+        :param smtp_code: Reply code of the server to the last attempt, or None if there was no reply
+        :param latency: Seconds the last attempt took, or None if it failed before reaching the server
+        :param conn_id: Id of the SMTP connection of the last attempt, or None if there was none
+        :param attempts: Number of attempts made to send the email
+        :param phase: Step at which the email failed, from get_failure_phase, or None if the email was sent
+        :param error: Reason of the final failure, or None if the email was sent
+        :param account: Address the email was sent from, or None if it wasn't assigned to an account
+        :return: None
+        """
+        values = [email, status, smtp_code, None if latency is None else round(latency, 4), conn_id, attempts, phase,
+                  error, account]
+        with self.lock:
+            if self.report_format == 'csv':
+                self.writer.writerow(values)
+            else:
+                self.file.write(json.dumps(dict(zip(FIELDS, values))) + '\n')
+
+    def read(self) -> 'pd.DataFrame':
+        """
+        :return: Every record of the report, read back from the file
+        """
+        import pandas as pd  # Only imported when an Excel report is written, importing it is slow
+
+        if self.report_format == 'csv':
+            return pd.read_csv(self.path, dtype={'smtp_code': 'Int64', 'connection_id': 'Int64'})
+        return pd.read_json(self.path, lines=True, dtype={'smtp_code': 'Int64', 'connection_id': 'Int64'})
+
+    def write_excel(self, path: str) -> None:
+        """
+        Converts the whole report to one Excel file
+        :param path: Path of the Excel file
+        :return: None
+        """
+        report = self.read()
+        report.index = range(1, len(report) + 1)
+        report.index.name = 'num'
+        report.to_excel(path)
+
+    def write_legacy_excel(self, prefix: str = '') -> None:
+        """
+        Writes the report in the original layout: 2 Excel files, one containing all successful emails, and one all
+            failed emails
+        :param prefix: Prefix of the file names, to tell apart the reports of the events of a batch run
+        :return: None
+        """
+        import pandas as pd
+
+        report = self.read()
+        for status, name in (('sent', 'successful_emails'), ('failed', 'failed_emails')):
+            series = pd.Series(report.loc[report['status'] == status, 'email'].tolist(), name=name, dtype=object)
+            series.index = range(1, len(series) + 1)
+            series.index.name = 'num'
+            series.to_excel(f'{prefix}{name}.xlsx')
+
+    def close(self) -> None:
+        """
+        Close the report file
+        :return: None
+        """
+        with self.lock:
+            self.file.close()
@@ -2,6 +2,23 @@ class EmailContent:
     """
     A class containing information about a single email: the email address and the personalised email contents
     """
-    def __init__(self, email=None, body=None):
+    def __init__(self, email=None, body=None, row_id=None):
         self.email = email
         self.body = body
+        self.row_id = row_id  # id of the SQL row the email was built from, used by the send journal
+        self.attempts = 0  # Number of attempts made to send the email
+        self.conn_id = None  # Id of the SMTP connection the last attempt was sent with, None if it failed
+        self.latency = None  # Seconds the last attempt spent on the SMTP connection
+        self.account = None  # SendingAccount the email is sent from, kept across its retries
+        self.part = None  # html part serialised ahead by a render process, in place of the body
+        self.message = None  # The full email read back from a spool, a view of it ready for DATA, in place of the body
+        self.spool_account = None  # Name of the account the email was spooled for
+
+    def shared_content(self) -> str | bytes | list[memoryview]:
+        """
+        :return: What must be identical for emails to be sent as one, the full email, the body or its serialised html
+            part
+        """
+        if self.message is not None:
+            return self.message
+        return self.part if self.part is not None else self.body
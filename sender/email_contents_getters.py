@@ -1,37 +1,44 @@
+from body_template import compile_body
 from email_content import EmailContent
 
-from typing import Any
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Iterable, Iterator
 
+FAMILIES_BODY_NAMES = ('receiver', 'parents_table', 'children_table')  # Placeholders of the body of families emails
 
-def default_getter(data: list[tuple[Any, ...]], cols: list[str], body: str):
+
+def default_getter(data: Iterable[tuple[Any, ...]], cols: list[str], body: str) -> Iterator[EmailContent]:
     """
-    Default email contents list builder. Takes only first_name, and personalises that to the email template
-    :param data: Data from SQL table
+    Default email contents builder. Personalises the email template with the columns it uses, such as first_name. A
+        template without placeholders is rendered once and the same body is shared by every email
+    :param data: Data from SQL table, consumed row by row as it streams in. Each row has the values of 'cols' followed by
+        the id of the row
     :param cols: Columns of the SQL data
-    :param body: Email template on which the personalised email will be built on
-    :return: List of the EmailContent objects
+    :param body: Email template on which the personalised email will be built on, compiled once per event
+    :return: Generator of the EmailContent objects
     """
-    email_contents = []
+    template = compile_body(body, tuple(cols))
+    email_idx = cols.index('email')
+    shared_body = template.render(()) if not template.placeholders else None
 
     for row in data:
-        values = {cols[i]: row[i] for i in range(len(cols))}
-
-        curr_body = body.format(**values)
-
-        email_contents.append(EmailContent(
-            email=values['email'],
-            body=curr_body
-        ))
-
-    return email_contents
+        yield EmailContent(
+            email=row[email_idx],
+            body=shared_body if shared_body is not None else template.render(row),
+            row_id=row[-1]
+        )
 
 
-def families(data: list[tuple[Any, ...]], _, body: str) -> list[EmailContent]:
+def families(data: Iterable[tuple[Any, ...]], _, body: str) -> Iterator[EmailContent]:
     """
-    EmailContent list builder for ISC Families emails
-    :param data: Data from SQL table
-    :param body: Email template on which the personalised email will be built on
-    :return: List of the EmailContent objects
+    EmailContent builder for ISC Families emails. Families are streamed one at a time, so only the largest family is
+        ever held in memory and the emails of a family are yielded as soon as its last row arrives. If the template
+        doesn't use the receiver's name, the members of a family share one body, rendered once
+    :param data: Data from SQL table, ordered by family_id so that the rows of a family are contiguous. Each row ends
+        with the id of the row
+    :param body: Email template on which the personalised email will be built on, compiled once per event
+    :return: Generator of the EmailContent objects
     """
     def generate_table(lst: list[tuple[Any, ...]], tag_start: str = '', tag_end: str = '') -> str:
         """
@@ -43,7 +50,7 @@ def families(data: list[tuple[Any, ...]], _, body: str) -> list[EmailContent]:
         """
         table = []
         for member in lst:
-            first_name, last_name, email, subject, college = member
+            first_name, last_name, email, subject, college, _ = member
             table.append(f'''<tr>
                 <td>{tag_start}{first_name} {last_name}{tag_end}</td>
                 <td>{tag_start}{email}{tag_end}</td>
@@ -53,49 +60,30 @@ def families(data: list[tuple[Any, ...]], _, body: str) -> list[EmailContent]:
 
         return ''.join(table)
 
-    def add_to_email_contents(lst: list[str], body: str) -> None:
-        """
-        Adds to the list email_contents
-        :param lst: List of members to add, either the parents or the children
-        :param body: Almost personalised email. Only missing the name part in 'Dear {first_name}'
-        :return: None. Modifies 'email_contents' in-place
-        """
-        for member in lst:
-            first_name = member[0]
-            email = member[2]
-            email_contents.append(EmailContent(
-                email=email,
-                body=body.format(receiver=first_name)
+    template = compile_body(body, FAMILIES_BODY_NAMES)
+
+    for family_id, rows in groupby(data, key=itemgetter(0)):
+        family = {'parent': [], 'child': []}
+        for _, first_name, last_name, email, subject, college, member, row_id in rows:
+            family[member].append((
+                first_name,
+                last_name,
+                email,
+                subject,
+                college,
+                row_id
             ))
 
-    families = {}
+        parents_table = generate_table(family['parent'], '<b>', '</b>')
+        children_table = generate_table(family['child'])
+        shared_body = None
+        if 'receiver' not in template.placeholders:
+            shared_body = template.render((None, parents_table, children_table))
 
-    for row in data:
-        family_id, first_name, last_name, email, subject, college, member = row
-
-        if family_id not in families:
-            families[family_id] = {'parent': [], 'child': []}
-
-        families[family_id][member].append((
-            first_name,
-            last_name,
-            email,
-            subject,
-            college
-        ))
-
-    email_contents = []
-    for family_id in families:
-        parents_table = generate_table(families[family_id]['parent'], '<b>', '</b>')
-        children_table = generate_table(families[family_id]['child'])
-
-        curr_body = body.format(
-            receiver='{receiver}',
-            parents_table=parents_table,
-            children_table=children_table
-        )
-
-        add_to_email_contents(families[family_id]['parent'], curr_body)
-        add_to_email_contents(families[family_id]['child'], curr_body)
-
-    return email_contents
+        for first_name, _, email, _, _, row_id in family['parent'] + family['child']:
+            yield EmailContent(
+                email=email,
+                body=shared_body if shared_body is not None else template.render((first_name, parents_table,
+                                                                                   children_table)),
+                row_id=row_id
+            )
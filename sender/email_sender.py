@@ -1,232 +1,712 @@
 from logging import Logger
 import os
-from time import time
+from time import perf_counter, time
+from typing import Any, Callable, Iterable, Iterator
 import smtplib
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-import pandas as pd
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 import yaml
 
+from attachments import load_attachments
+from delivery_report import DeliveryReport, get_failure_phase
 from email_content import EmailContent
+from journal import SendJournal
+from message_template import UNDISCLOSED_RECIPIENTS, Message, MessageTemplate
+from metrics import Metrics
+from pipelining_smtp import PipeliningSMTP
+from rate_controller import RateController, get_smtp_code, is_throttled
+from retry_queue import RetryQueue, backoff_delay, is_transient
+from sending_account import QuotaExceededError, SendingAccount, pick_account
+from smtp_pool import PoolStats, SMTPPool
+from smtp_protocol import STAGE_MAIL, STAGE_SENT, DeliveryUnknownError
+from spool import SpoolWriter
+from structured_log import flush_logs
+from suppression import SuppressionIndex, is_bounce
+
+
+class Batch:
+    """
+    Bookkeeping of one batch whose emails are in flight, used to log the batch once its last email has been sent
+    """
+    def __init__(self, batch_no: int):
+        self.batch_no = batch_no
+        self.start_time = time()
+        self.num_submitted = 0
+        self.num_done = 0
+        self.num_successful = 0
+        self.all_submitted = False
+
+    def is_complete(self) -> bool:
+        return self.all_submitted and self.num_done == self.num_submitted
 
 
 class EmailSender:
+    smtp_server = 'smtp.gmail.com'  # Gmail's SMTP server address
+    smtp_port = 587
+    smtp_starttls = True  # Only disabled for local stand-in servers that don't support TLS
+    retry_base_delay = 1  # Seconds before the second attempt of an email that failed transiently, doubled every attempt
+    retry_max_delay = 60
+    progress_interval = 0.2  # Seconds between two redraws of the progress bar
+
     def __init__(self, logger: Logger, executor: ThreadPoolExecutor, project_path: str, event_details: dict[str],
-                 account: str, total_emails: int, progress_bar_len: int):
+                 accounts: list[str], total_emails: int, progress_bar_len: int, max_in_flight: int,
+                 make_rate_controller: Callable[[], RateController], max_messages_per_connection: int = 100,
+                 journal: SendJournal = None, max_attempts: int = 5, report: DeliveryReport = None,
+                 metrics: Metrics = None, smtp_host: str = None, smtp_port: int = None, smtp_starttls: bool = None,
+                 max_recipients_per_message: int = 1, share_with: 'EmailSender' = None,
+                 draw_progress: Callable[[], None] = None, suppression: SuppressionIndex = None,
+                 render: bool = True):
         """
         :param logger: Reuse the same configured logger
-        :param executor: ThreadPoolExecutor to be used to execute threads
+        :param executor: ThreadPoolExecutor to be used to execute threads, or None for engines that don't use threads
         :param project_path: Path of the project directory
         :param event_details: Dictionary of all necessary details of the event
-        :param account: Email account where the emails are going to be sent from
+        :param accounts: Email accounts where the emails are going to be sent from, each email is sent from one of them
         :param total_emails: Total number of emails to be sent, used in progress bar
         :param progress_bar_len: Number of characters in the live progress bar
+        :param max_in_flight: Maximum number of emails submitted to the executor and not yet sent, bounds the memory
+            used by queued emails while keeping the workers busy across batch boundaries
+        :param make_rate_controller: Function making the adaptive rate and concurrency limiter of one account, since
+            the SMTP server limits the rate of each account separately
+        :param max_messages_per_connection: Number of emails sent over one SMTP connection before it's replaced
+        :param journal: On-disk journal where the outcome of every email is recorded as soon as it's known, or None
+        :param max_attempts: Number of attempts of an email that keeps failing transiently before it's marked as failed
+        :param report: Report the outcome of every email is appended to as soon as it's known, or None
+        :param metrics: Metrics the sending process is recorded in, or None to keep them internal
+        :param smtp_host: SMTP server the emails are sent through, or None for Gmail's
+        :param smtp_port: Port of the SMTP server, or None for the default
+        :param smtp_starttls: Whether to use STARTTLS, or None for the default
+        :param max_recipients_per_message: Maximum number of consecutive emails with the same body sent in one SMTP
+            transaction, as BCC, 1 to send every email separately
+        :param share_with: Sender of another event whose accounts, with their SMTP connections and rate limits, are
+            used instead of new ones, so that several events are sent together within the limits of the accounts. It
+            must be closed after this one, or None
+        :param draw_progress: Function drawing one progress bar for every event sent together, called instead of
+            drawing the bar of this sender, or None
+        :param suppression: Index the recipients refused permanently by the server are added to, so that no event
+            emails them again, or None
+        :param render: Whether the sender builds the emails it sends. A drain sends the emails of a spool as they were
+            written, so it loads no attachments and builds no templates
         """
         self.logger = logger
+        self.share_with = share_with
+        self.draw_progress = draw_progress
         self.executor = executor
-        self.thread_local = threading.local()
+        if smtp_host is not None:
+            self.smtp_server = smtp_host
+        if smtp_port is not None:
+            self.smtp_port = smtp_port
+        if smtp_starttls is not None:
+            self.smtp_starttls = smtp_starttls
         self.project_path = project_path
         self.event_details = event_details
-        self.account = account
-        self.emails_sent = 0  # Modified, but is only used by main thread
+        self.emails_sent = 0  # Modified, guarded by progress_cond
         self.total_emails = total_emails
         self.batch_no = 0  # Modified, but is only used by main branch
-        self.email_details = self.get_email_details()
+        self.max_in_flight = max_in_flight
         self.progress_bar_len = progress_bar_len
         self.start_time = time()
 
-        self.img = None
-        self.make_img()
-
-        self.num_emails_attempted = 0  # Modified, but is only used in main thread
+        # Encoded once into the cache of the attachments folder, and shared by the templates of every account
+        self.attachments = None
+        if render:
+            self.attachments = load_attachments(os.path.join(project_path, 'attachments'), event_details['attachment'])
+
+        self.num_emails_attempted = 0  # Modified, guarded by progress_cond
+        self.num_in_flight = 0  # Modified, guarded by progress_cond
+        self.num_waiting_retry = 0  # In flight emails waiting for their next attempt, modified, guarded by progress_cond
+        self.progress_cond = threading.Condition()
+        self.last_progress_draw = 0.0  # Modified, guarded by progress_cond
+
+        self.journal = journal
+        self.suppression = suppression
+        self.report = report
+        self.max_attempts = max_attempts
+        self.max_recipients_per_message = max_recipients_per_message
+        self.retry_queue = RetryQueue(logger)
+        self.closed = False
+
+        self.max_messages_per_connection = max_messages_per_connection
+        if share_with is None:
+            self.smtp_stats = PoolStats()  # Shared by the connections of every account
+            self.accounts = [self.make_account(account, make_rate_controller()) for account in accounts]
+        else:
+            self.smtp_stats = share_with.smtp_stats
+            self.accounts = share_with.accounts
+        # The subject and attachments are those of the event, so the templates are never shared
+        self.message_templates = {}
+        if render:
+            self.message_templates = {account.name: MessageTemplate(account.address, event_details['subject'],
+                                                                    self.attachments) for account in self.accounts}
+
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.add_collector(self.collect_metrics)
 
-        self.successful_emails = []  # Modified, not thread safe
-        self.failed_emails = []  # Modified, not thread safe
-
-        self.successful_emails_lock = threading.Lock()
-        self.failed_emails_lock = threading.Lock()
-
-        self.active_smtp_conns = set()  # Modified, not thread safe
-        self.active_smtp_conns_lock = threading.Lock()
+    def __enter__(self):
+        self.start_time = time()  # The sender may have been created and warmed up well before the sending starts
+        return self
 
-        self.smtp_count = 0  # Modified, not thread safe
-        self.smtp_count_lock = threading.Lock()
+    def make_account(self, name: str, rate_controller: RateController) -> SendingAccount:
+        """
+        :param name: Name of the account, as in its email_details_<name>.yaml file
+        :param rate_controller: Adaptive rate and concurrency limiter of the account
+        :return: The account, with its own SMTP connections, and the emails it sent in the last 24 hours counted against
+            its daily quota
+        """
+        email_details = self.get_email_details(name)
+        sent_today = 0
+        if self.journal is not None and email_details.get('daily_quota') is not None:
+            sent_today = self.journal.count_sent_since(email_details['email'], time() - 24 * 60 * 60)
+        account = SendingAccount(name, email_details, rate_controller, sent_today)
+        account.pool = self.make_pool(account)
+        if account.daily_quota is not None:
+            self.logger.info(f'Account {account.address} sent {sent_today} emails in the last 24 hours, '
+                             f'{account.remaining_quota} left of its daily quota')
+        return account
+
+    def make_pool(self, account: SendingAccount) -> SMTPPool:
+        """
+        :param account: Account the connections are logged in to
+        :return: Pool of the SMTP connections of the account
+        """
+        return SMTPPool(logger=self.logger, connect=partial(self.connect, account),
+                        max_messages=self.max_messages_per_connection, stats=self.smtp_stats)
 
-        self.failed_smtp_count = 0  # Modified, not thread safe
-        self.failed_smtp_count_lock = threading.Lock()
+    def warm_up(self) -> None:
+        """
+        Opens and logs in SMTP connections ahead of the first email, concurrently, as many for each account as its
+            initial concurrency, and leaves them idle in the pools. A connection that fails to open is only logged, it
+            will be opened again when it's needed
+        :return: None
+        """
+        def open_one(pool: SMTPPool) -> None:
+            pool.checkin(pool.checkout(), sent=False)
 
-    def __enter__(self):
-        return self
+        futures = [self.executor.submit(open_one, account.pool) for account in self.accounts
+                   for _ in range(int(account.rate_controller.concurrency))]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                self.logger.warning(f'Failed to open SMTP connection ahead of sending: {e}')
 
-    def send_emails(self, email_contents: list[EmailContent]) -> None:
+    def send_emails(self, email_contents: Iterable[EmailContent]) -> None:
         """
-        Sends all the emails given a list of EmailContent objects
-        :param email_contents: List of EmailContent objects that govern the emails that will be sent
+        Submits all the emails of a batch given EmailContent objects, without waiting for the batch to be sent so that
+            the workers stay busy while the next batch is fetched and rendered. Only blocks while 'max_in_flight' emails
+            are outstanding, not counting the ones waiting to be retried. The batch is logged once its last email has
+            been sent
+        :param email_contents: EmailContent objects that govern the emails that will be sent, submitted as they are
+            rendered
         :return: None
         """
         self.batch_no += 1
-        batch_start_time = time()
-
-        futures = [self.executor.submit(self.send_one, email_content) for email_content in email_contents]
+        batch = Batch(self.batch_no)
 
-        num_successful_emails = 0
-        for future in as_completed(futures):
-            num_successful_emails += future.result()
-            self.num_emails_attempted += 1
+        for group in self.group_shared(email_contents):
+            with self.progress_cond:
+                self.progress_cond.wait_for(lambda: self.num_in_flight - self.num_waiting_retry < self.max_in_flight)
+                self.num_in_flight += len(group)
+                batch.num_submitted += len(group)
 
-            # Update progress bar
-            stars = int((self.emails_sent + num_successful_emails) / self.total_emails * self.progress_bar_len)
-            dashes = self.progress_bar_len - stars
+            for future in self.submit(group):
+                future.add_done_callback(partial(self.on_sent, batch))
 
-            prediction_of_remaining = (self.total_emails - self.num_emails_attempted) * (time() - self.start_time) / self.num_emails_attempted
-            predicted_mins, predicted_secs = map(int, divmod(prediction_of_remaining, 60))
+        with self.progress_cond:
+            batch.all_submitted = True
+            if batch.is_complete():
+                self.log_batch(batch)
 
-            print(f"\rBatch number {self.batch_no}, Progress: {'*' * stars}{'-' * dashes} "
-                  f"{self.emails_sent + num_successful_emails}/{self.total_emails} emails sent. Time remaining "
-                  f"{predicted_mins} minutes and {predicted_secs} seconds", end='')
+    def group_shared(self, email_contents: Iterable[EmailContent]) -> Iterator[list[EmailContent]]:
+        """
+        Groups consecutive emails with the same body, up to 'max_recipients_per_message' per group, so that each group
+            is sent in one SMTP transaction. Only emails rendered one after the other are compared, which is where the
+            getters put the emails sharing a body, such as those of a family or of an event whose body has no
+            placeholders
+        :param email_contents: EmailContent objects, in the order they were rendered
+        :return: Generator of the groups, each of one email if 'max_recipients_per_message' is 1
+        """
+        if self.max_recipients_per_message == 1:
+            for email_content in email_contents:
+                yield [email_content]
+            return
+
+        group, group_content = [], None
+        for email_content in email_contents:
+            content = email_content.shared_content()
+            if group and (len(group) == self.max_recipients_per_message or
+                          (content is not group_content and content != group_content)):
+                yield group
+                group = []
+            group.append(email_content)
+            group_content = content
+        if group:
+            yield group
+
+    def submit(self, group: list[EmailContent]) -> list[Future]:
+        """
+        Assigns a group of emails with the same body to an account and schedules its first attempt. Attempts that fail
+            transiently are retried from the same account with an exponential backoff while the other emails keep being
+            sent, only for the recipients that failed
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :return: Future of every email of the group, whose result is 1 if it was eventually sent successfully and 0 if
+            not
+        """
+        outcomes = [Future() for _ in group]
+        try:
+            if group[0].spool_account is not None:  # Sent from the account it was spooled for, within its quota
+                account = self.get_account(group[0].spool_account)
+                account.assign(len(group))
+            else:
+                account = pick_account(self.accounts, len(group))
+        except QuotaExceededError as e:
+            for email_content, outcome in zip(group, outcomes):
+                self.logger.error(f'Failed to send email to {email_content.email}: {e}',
+                                  extra=self.log_fields(email_content, 'failed'))
+                self.record_failure(email_content, e)
+                outcome.set_result(0)
+            return outcomes
+
+        for email_content in group:
+            email_content.account = account
+        self.schedule_attempt(group, outcomes)
+        return outcomes
+
+    def get_account(self, name: str) -> SendingAccount:
+        """
+        :param name: Name of the account, as in its email_details_<name>.yaml file
+        :return: The account of the sender with that name
+        """
+        for account in self.accounts:
+            if account.name == name:
+                return account
+        raise ValueError(f'Account {name} is not one of the accounts of the sender')
 
-        mins, secs = divmod(time() - batch_start_time, 60)
-        mins, secs = int(mins), round(secs, 2)
-        self.logger.info(
-            f'Batch number {self.batch_no} sent. {num_successful_emails}/{len(email_contents)} sent successfully in '
-            f'{mins} minutes and {secs} seconds')
+    def spool_emails(self, email_contents: Iterable[EmailContent], spool: SpoolWriter) -> int:
+        """
+        Renders the emails to a spool instead of sending them: every group of emails with the same body is assigned to
+            an account and appended to the spool as it would be sent. Daily quotas aren't checked, the emails aren't
+            sent today, they are checked when the spool is drained
+        :param email_contents: EmailContent objects that govern the emails that will be spooled
+        :param spool: Spool the emails are appended to
+        :return: Number of emails spooled
+        """
+        num_emails = 0
+        for group in self.group_shared(email_contents):
+            account = pick_account(self.accounts, len(group), use_quota=False)
+            for email_content in group:
+                email_content.account = account
+            spool.append(self.make_message(group), account.name, group)
+            num_emails += len(group)
+        return num_emails
+
+    def schedule_attempt(self, group: list[EmailContent], outcomes: list[Future]) -> None:
+        """
+        Runs one attempt to send the group on a worker thread
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :param outcomes: Future of every email, resolved once it's sent or has failed for good
+        :return: None
+        """
+        self.executor.submit(self.run_attempt, group, outcomes)
 
-        self.emails_sent += num_successful_emails
+    def run_attempt(self, group: list[EmailContent], outcomes: list[Future]) -> None:
+        """
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :param outcomes: Future of every email
+        :return: None
+        """
+        self.on_attempt_done(group, outcomes, self.send_one(group))
 
-    def get_smtp(self, new_attempt=False) -> smtplib.SMTP:
+    def on_attempt_done(self, group: list[EmailContent], outcomes: list[Future],
+                        errors: list[Exception | None]) -> None:
+        """
+        Resolves the future of every email of the group, or schedules another attempt for the emails that failed
+            transiently and have attempts left
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :param outcomes: Future of every email
+        :param errors: Exception the attempt failed with for every email, or None if it was sent
+        :return: None
         """
-        Retrieves the SMTP server connection object for the current thread from the thread local storage,
-            self.thread_local object. If it's the first time for the thread that this function is called, retrieve the
-            server connection object
-        :return: SMTP object corresponding to the current thread
+        attempts = group[0].attempts + 1  # The emails of a group are always attempted together
+        delay = backoff_delay(attempts, self.retry_base_delay, self.retry_max_delay)
+        retry_group, retry_outcomes = [], []
+        for email_content, outcome, error in zip(group, outcomes, errors):
+            email_content.attempts = attempts
+            self.metrics.inc('attempts_total', result='sent' if error is None else 'error')
+            if error is None:
+                # Formatted by the log writer thread, and not at all if the line isn't sampled
+                self.logger.info('Email to %s sent successfully with SMTP id: %s', email_content.email,
+                                 email_content.conn_id, extra=self.log_fields(email_content, 'sent'))
+                self.record_success(email_content)
+                outcome.set_result(1)
+            elif is_transient(error) and attempts < self.max_attempts:
+                self.logger.warning(f'Attempt {attempts} to send email to {email_content.email} failed: {error}, '
+                                    f'retrying in {delay:.1f} seconds', extra=self.log_fields(email_content, 'retry'))
+                retry_group.append(email_content)
+                retry_outcomes.append(outcome)
+            else:
+                self.fail(email_content, outcome, error)
+
+        if not retry_group:
+            return
+        self.metrics.inc('retries_total', len(retry_group))
+        with self.progress_cond:
+            self.num_waiting_retry += len(retry_group)
+            self.progress_cond.notify_all()
+        self.retry_later(delay, partial(self.retry, retry_group, retry_outcomes))
+
+    def retry_later(self, delay: float, retry: Callable[[], None]) -> None:
         """
-        if new_attempt or not hasattr(self.thread_local, 'smtp'):
-            if new_attempt and hasattr(self.thread_local, 'smtp'):
-                self.thread_local.smtp.quit()
-                with self.smtp_count_lock:
-                    self.smtp_count -= 1
-                    self.logger.info(f'Disconnected SMTP connection with id {id(self.thread_local.smtp)} stopped, remaining: {self.smtp_count}')
-                with self.failed_smtp_count_lock:
-                    self.failed_smtp_count += 1
+        :param delay: Seconds to wait before the next attempt
+        :param retry: Function scheduling the next attempt
+        :return: None
+        """
+        self.retry_queue.call_later(delay, retry)
 
-            smtp_server = 'smtp.gmail.com'  # Gmail's SMTP server address
-            smtp_port = 587
+    def retry(self, group: list[EmailContent], outcomes: list[Future]) -> None:
+        """
+        Schedules the next attempt of a group of emails that was waiting to be retried
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :param outcomes: Future of every email
+        :return: None
+        """
+        with self.progress_cond:
+            self.num_waiting_retry -= len(group)
+        try:
+            self.schedule_attempt(group, outcomes)
+        except Exception as e:  # Such as the executor already shut down, the emails are failed so that wait returns
+            for email_content, outcome in zip(group, outcomes):
+                self.fail(email_content, outcome, e)
 
-            smtp = smtplib.SMTP(smtp_server, smtp_port)  # Connection to Gmail SMTP server
-            smtp.starttls()  # Transport layer security, ensures secure communication
-            smtp.login(self.email_details['email'], self.email_details['password'])
-            self.thread_local.smtp = smtp
+    def fail(self, email_content: EmailContent, outcome: Future, error: Exception) -> None:
+        """
+        Marks an email as failed for good, after its last attempt
+        :param email_content: EmailContent object of the email
+        :param outcome: Future of the email
+        :param error: Exception the email failed with
+        :return: None
+        """
+        self.logger.error(f'Failed to send email to {email_content.email} after {email_content.attempts} '
+                          f'attempt{'s' if email_content.attempts != 1 else ''}: {error}',
+                          extra=self.log_fields(email_content, 'failed'))
+        self.record_failure(email_content, error)
+        outcome.set_result(0)
 
-            with self.active_smtp_conns_lock:
-                self.active_smtp_conns.add(smtp)
+    def on_sent(self, batch: Batch, future: Future) -> None:
+        """
+        Callback of the future of an email, once it's sent or has failed for good: updates the counters and the
+            progress bar, and logs the batch if this was its last email
+        :param batch: Batch the email belongs to
+        :param future: Finished future, whose result is 1 if the email was sent successfully and 0 if not
+        :return: None
+        """
+        with self.progress_cond:
+            successful = future.result()
+            self.num_in_flight -= 1
+            self.num_emails_attempted += 1
+            self.emails_sent += successful
+            batch.num_done += 1
+            batch.num_successful += successful
 
-            with self.smtp_count_lock:
-                self.smtp_count += 1
-                self.logger.info(f'SMTP connection with id {id(smtp)} started, number of live connections: {self.smtp_count}')
+            # Redraw the progress bar at most every 'progress_interval' seconds, and for the last email
+            now = time()
+            if now - self.last_progress_draw >= self.progress_interval or self.num_emails_attempted == self.total_emails:
+                self.last_progress_draw = now
+                self.draw_progress_bar(batch.batch_no, now)
 
-        return self.thread_local.smtp
+            if batch.is_complete():
+                self.log_batch(batch)
+            self.progress_cond.notify_all()
 
-    def send_one(self, email_content: EmailContent) -> int:
+    def draw_progress_bar(self, batch_no: int, now: float) -> None:
         """
-        Connect to Gmail SMTP server and send one email
-        :param email_content: An EmailContent object containing information about the email, namely address and the body
-        :return: 1 if successful, 0 if not successful
+        Redraws the progress bar, must be called with progress_cond held
+        :param batch_no: Number of the batch of the last email
+        :param now: Current time
+        :return: None
         """
-        smtp = None
-        try:
-            smtp = self.get_smtp()
+        if self.draw_progress is not None:
+            self.draw_progress()
+            return
 
-            try:
-                smtp.noop()
-            except smtplib.SMTPException:
-                smtp = self.get_smtp(new_attempt=True)
+        stars = int(self.emails_sent / self.total_emails * self.progress_bar_len)
+        dashes = self.progress_bar_len - stars
 
-            msg = MIMEMultipart()
-            msg['From'] = self.email_details['email']
-            msg['To'] = email_content.email
-            msg['Subject'] = self.event_details['subject']
-            msg.attach(MIMEText(email_content.body, 'html'))
-            if self.img is not None:
-                msg.attach(self.img)
+        prediction_of_remaining = (self.total_emails - self.num_emails_attempted) * (now - self.start_time) / self.num_emails_attempted
+        predicted_mins, predicted_secs = map(int, divmod(prediction_of_remaining, 60))
 
-            smtp.sendmail(self.email_details['email'], email_content.email, msg.as_string())
-            self.logger.info(f'Email to {email_content.email} sent successfully with SMTP id: {id(smtp)}')
+        print(f"\rBatch number {batch_no}, Progress: {'*' * stars}{'-' * dashes} "
+              f"{self.emails_sent}/{self.total_emails} emails sent. Time remaining "
+              f"{predicted_mins} minutes and {predicted_secs} seconds", end='')
 
-            with self.successful_emails_lock:
-                self.successful_emails.append(email_content.email)
-            return 1
+    def log_batch(self, batch: Batch) -> None:
+        """
+        :param batch: Batch whose emails have all been sent
+        :return: None
+        """
+        elapsed = time() - batch.start_time
+        emails_per_second = batch.num_done / elapsed if elapsed > 0 else 0.0
+        self.metrics.set_gauge('batch_emails_per_second', emails_per_second)
+        self.metrics.observe('batch_seconds', elapsed)
 
-        except Exception as e:
-            self.logger.error(f'Failed to send email to {email_content.email} using smtp connection {id(smtp) if smtp is not None else 'None'}: {e}')
-            with self.failed_emails_lock:
-                self.failed_emails.append(email_content.email)
-            return 0
+        mins, secs = divmod(elapsed, 60)
+        mins, secs = int(mins), round(secs, 2)
+        self.logger.info(
+            f'Batch number {batch.batch_no} sent. {batch.num_successful}/{batch.num_submitted} sent successfully in '
+            f'{mins} minutes and {secs} seconds, {emails_per_second:.1f} emails per second')
 
-    def make_img(self) -> None:
+    def collect_metrics(self, metrics: Metrics) -> None:
+        """
+        Copies the counters of the sender, its connections and the rate controllers of its accounts into the metrics
+        :param metrics: Metrics of the sending process
+        :return: None
+        """
+        with self.progress_cond:
+            metrics.set_counter('emails_total', self.emails_sent, status='sent')
+            metrics.set_counter('emails_total', self.num_emails_attempted - self.emails_sent, status='failed')
+            metrics.set_gauge('emails_remaining', self.total_emails - self.num_emails_attempted)
+            metrics.set_gauge('emails_in_flight', self.num_in_flight - self.num_waiting_retry)
+            metrics.set_gauge('emails_waiting_retry', self.num_waiting_retry)
+            elapsed = time() - self.start_time
+            metrics.set_gauge('emails_per_second', self.num_emails_attempted / elapsed if elapsed > 0 else 0.0)
+
+        metrics.set_counter('smtp_connections_created_total', self.smtp_stats.created)
+        metrics.set_counter('smtp_connections_recycled_total', self.smtp_stats.recycled)
+        metrics.set_counter('smtp_connections_failed_total', self.smtp_stats.failed)
+        metrics.set_gauge('smtp_connections_live', self.smtp_stats.live)
+        for account in self.accounts:
+            metrics.set_counter('account_emails_assigned_total', account.num_assigned, account=account.address)
+            metrics.set_gauge('send_rate_limit', account.rate_controller.rate, account=account.address)
+            metrics.set_gauge('send_concurrency_limit', account.rate_controller.concurrency, account=account.address)
+            metrics.set_counter('smtp_throttles_total', account.rate_controller.num_throttles, account=account.address)
+
+    def wait(self) -> None:
         """
-        Retrieve the attachment as a usable object or None if there is no attachment
-        :return: MIMEImage object if the email contains an attachment
+        Blocks until every submitted email has been sent
+        :return: None
         """
-        if self.event_details['attachment'] is not None:
-            with open(os.path.join(self.project_path, 'attachments', self.event_details['attachment']), 'rb') as file:
-                # Use MIMEImage to ensure the image isn't an attachment but is embedded inline
-                img = MIMEImage(file.read())
+        with self.progress_cond:
+            self.progress_cond.wait_for(lambda: self.num_in_flight == 0)
 
-                # Define the content-id of the image (cid:image)
-                img.add_header('Content-ID', '<image>')
+    def connect(self, account: SendingAccount) -> smtplib.SMTP:
+        """
+        Opens and logs in a new SMTP connection, used by the pool of an account when it has no usable idle connection
+        :param account: Account the connection is logged in to
+        :return: Logged in SMTP object
+        """
+        with self.metrics.timer('smtp_phase_seconds', phase='connect'):
+            smtp = PipeliningSMTP(self.smtp_server, self.smtp_port)  # Connection to Gmail SMTP server
+        try:
+            if self.smtp_starttls:
+                with self.metrics.timer('smtp_phase_seconds', phase='starttls'):
+                    smtp.starttls()  # Transport layer security, ensures secure communication
+            with self.metrics.timer('smtp_phase_seconds', phase='login'):
+                smtp.login(account.address, account.password)
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    def send_one(self, group: list[EmailContent]) -> list[Exception | None]:
+        """
+        Makes one attempt to send a group of emails with the same body from their account, in one SMTP transaction,
+            once the rate controller of the account allows it
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :return: For every email, None if successful, the exception the attempt failed with if not successful
+        """
+        account = group[0].account
+        start = None
+        try:
+            msg = self.make_message(group)
+            account.rate_controller.acquire()
+            start = perf_counter()
+            conn_id, refused = self.deliver(account, [email_content.email for email_content in group], msg)
+        except Exception as e:
+            latency = None if start is None else perf_counter() - start
+            errors = self.finish_attempt(group, None, latency, {}, e)
+            if start is not None:
+                account.rate_controller.release(throttled=any(is_throttled(err) for err in errors if err is not None))
+            return errors
+
+        errors = self.finish_attempt(group, conn_id, perf_counter() - start, refused)
+        account.rate_controller.release(throttled=any(is_throttled(e) for e in errors if e is not None))
+        return errors
+
+    def finish_attempt(self, group: list[EmailContent], conn_id: int | None, latency: float | None,
+                       refused: dict[str, tuple[int, bytes]], error: Exception = None) -> list[Exception | None]:
+        """
+        Records the connection and latency of an attempt in the emails of the group, and works out the outcome of each
+        :param group: EmailContent objects of the emails sent in one SMTP transaction
+        :param conn_id: Id of the connection the emails were sent with, or None if there was none
+        :param latency: Seconds the attempt spent on the connection, or None if it failed before reaching it
+        :param refused: Reply of the server to every recipient it refused while accepting the others
+        :param error: Exception the whole attempt failed with, or None
+        :return: For every email, None if successful, the exception the attempt failed with if not successful
+        """
+        if isinstance(error, smtplib.SMTPRecipientsRefused) and all(
+                email_content.email in error.recipients for email_content in group):
+            # Every recipient was refused, each is judged by its own reply rather than by that of the first one
+            refused, error = error.recipients, None
+
+        errors = []
+        for email_content in group:
+            email_content.conn_id = conn_id
+            email_content.latency = latency
+            if error is not None:
+                errors.append(error)
+            elif email_content.email in refused:
+                errors.append(smtplib.SMTPRecipientsRefused({email_content.email: refused[email_content.email]}))
+            else:
+                errors.append(None)
+        return errors
+
+    @staticmethod
+    def log_fields(email_content: EmailContent, outcome: str) -> dict[str, Any]:
+        """
+        :param email_content: EmailContent object of the email the line is about
+        :param outcome: 'sent', 'retry' or 'failed', lines of emails sent successfully may be sampled out of the log
+        :return: Structured fields of the line, given to the logger as 'extra'
+        """
+        account = email_content.account.address if email_content.account is not None else None
+        return {'recipient': email_content.email, 'smtp_id': email_content.conn_id, 'latency': email_content.latency,
+                'outcome': outcome, 'attempts': email_content.attempts, 'account': account}
 
-                # Display it inline
-                img.add_header('Content-Disposition', 'inline', filename=self.event_details['attachment'])
-            self.img = img
+    def record_success(self, email_content: EmailContent) -> None:
+        """
+        :param email_content: EmailContent object of the email that was sent
+        :return: None
+        """
+        address = email_content.account.address
+        if self.journal is not None:
+            self.journal.record(email_content.row_id, email_content.email, 'sent', email_content.attempts,
+                                account=address)
+        if self.report is not None:
+            self.report.record(email_content.email, 'sent', 250, email_content.latency, email_content.conn_id,
+                               email_content.attempts, account=address)
+
+    def record_failure(self, email_content: EmailContent, e: Exception) -> None:
+        """
+        :param email_content: EmailContent object of the email that failed
+        :param e: Exception the last attempt failed with
+        :return: None
+        """
+        address = email_content.account.address if email_content.account is not None else None
+        if self.journal is not None:
+            self.journal.record(email_content.row_id, email_content.email, 'failed', email_content.attempts, str(e),
+                                account=address)
+        if self.report is not None:
+            self.report.record(email_content.email, 'failed', get_smtp_code(e), email_content.latency,
+                               email_content.conn_id, email_content.attempts, get_failure_phase(e), str(e),
+                               account=address)
+        if self.suppression is not None and is_bounce(e):
+            self.suppression.add([email_content.email], 'bounce', self.event_details['table_name'])
+
+    def deliver(self, account: SendingAccount, emails: list[str],
+                msg: bytes) -> tuple[int, dict[str, tuple[int, bytes]]]:
+        """
+        Send one email over a connection checked out of the pool of the account. A connection closed by the server
+            before it accepted MAIL FROM, such as after being idle, is replaced once and the email is sent again right
+            away. If the connection is lost after the whole email was written, the server may have accepted it, so the
+            email fails with DeliveryUnknownError instead of being retried
+        :param account: Account the email is sent from
+        :param emails: Addresses of the recipients
+        :param msg: The full email
+        :return: Id of the connection the email was sent with, and the reply of the server to every recipient it refused
+            while accepting the others
+        """
+        for attempt in range(2):
+            conn = account.pool.checkout()
+            try:
+                with self.metrics.timer('smtp_phase_seconds', phase='data'):
+                    refused = conn.smtp.sendmail(account.address, emails, msg)
+            except smtplib.SMTPServerDisconnected as e:
+                stage = conn.smtp.stage
+                account.pool.discard(conn)
+                if stage == STAGE_SENT:
+                    raise DeliveryUnknownError(f'Connection lost before the server replied to the message, it may '
+                                               f'have been delivered: {e}') from e
+                if attempt == 1 or stage != STAGE_MAIL:  # A transaction the server started is retried later
+                    raise
+                continue
+            except smtplib.SMTPException as e:  # The server refused the email, the connection is usable unless it's a 421
+                if get_smtp_code(e) == 421:
+                    account.pool.discard(conn)
+                else:
+                    account.pool.checkin(conn, sent=False)
+                raise
+            except Exception:
+                account.pool.discard(conn)
+                raise
+
+            account.pool.checkin(conn)
+            return conn.conn_id, refused
+
+    def make_message(self, group: list[EmailContent]) -> bytes | Message:
+        """
+        Builds the full email, with the headers, the html body and the attachments, from the pre-serialised
+            template of its account, and from the html part if it was already serialised by a render process. An email
+            to several recipients has them all as BCC and an undisclosed 'To' header. An email read back from a spool
+            is already complete
+        :param group: EmailContent objects of the emails sent in one SMTP transaction, all with the same body
+        :return: The email as bytes, or in segments sharing the attachments of the template, ready to be sent
+        """
+        email_content = group[0]
+        if email_content.message is not None:
+            return email_content.message
+        to_addr = email_content.email if len(group) == 1 else UNDISCLOSED_RECIPIENTS
+        message_template = self.message_templates[email_content.account.name]
+        if email_content.part is not None:
+            return message_template.assemble(to_addr, email_content.part)
+        return message_template.render(to_addr, email_content.body)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        for smtp in self.active_smtp_conns:
-            try:
-                smtp.quit()
-                with self.smtp_count_lock:
-                    self.smtp_count -= 1
-                    self.logger.info(f'SMTP connection with id {id(smtp)} stopped, remaining: {self.smtp_count}')
-            except smtplib.SMTPServerDisconnected:
-                self.logger.error(f"A thread's SMTP server connection with id {id(smtp)} doesn't exist when trying to stop the connection")
-        self.logger.info(f'Number of failed and restarted SMTP connections: {self.failed_smtp_count}')
-        self.write_excel_report()
+        self.wait()
+        self.close()
+        if self.share_with is not None:  # Logged by the sender the accounts belong to
+            flush_logs(self.logger)
+            return
+        self.logger.info(f'SMTP connections {self.smtp_stats}')
+        for account in self.accounts:
+            self.logger.info(f'Account {account.address}: {account.num_assigned} emails assigned, final sending '
+                             f'{account.rate_controller}')
+        flush_logs(self.logger)
+
+    def close(self) -> None:
+        """
+        Stops retrying and quits every SMTP connection, unless they belong to the sender they are shared with, also used
+            when the sender was warmed up but never used. Does nothing if it's already closed
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.retry_queue.stop()
+        if self.share_with is None:
+            self.close_connections()
+
+    def close_connections(self) -> None:
+        """
+        Quits every SMTP connection of the pools of the accounts
+        :return: None
+        """
+        for account in self.accounts:
+            account.pool.close_all()
 
-    def get_email_details(self) -> dict[str]:
+    def get_email_details(self, account: str) -> dict[str]:
         """
-        Retrieve the details of the email where emails are sent from
-        :return: Dictionary of the email's address and password
+        Retrieve the details of an email where emails are sent from
+        :param account: Name of the account
+        :return: Dictionary of the email's address and password, and optionally its weight and daily quota
         """
         try:
             with open(os.path.join(self.project_path, 'email_details',
-                                   f'email_details_{self.account}.yaml'), 'r') as file:
+                                   f'email_details_{account}.yaml'), 'r') as file:
                 email_details = yaml.safe_load(file)
         except FileNotFoundError:
-            raise FileNotFoundError(f'emails_details_{self.account}.yaml file not found, emails not sent')
+            raise FileNotFoundError(f'emails_details_{account}.yaml file not found, emails not sent')
 
-        if set(email_details.keys()) != {'email', 'password'}:
+        if not {'email', 'password'} <= set(email_details.keys()) <= {'email', 'password', 'weight', 'daily_quota'}:
             raise ValueError('Emails not sent, email details reading failed due to invalid format')
 
         return email_details
-
-    def write_excel_report(self):
-        """
-        Writes 2 Excel files, one containing all successful emails, and one all failed emails
-        :return: None
-        """
-        try:
-            series_successful = pd.Series(self.successful_emails, name='successful_emails')
-            series_successful.index = range(1, len(self.successful_emails) + 1)
-            series_successful.index.name = 'num'
-            series_successful.to_excel('successful_emails.xlsx')
-
-            series_failed = pd.Series(self.failed_emails, name='failed_emails')
-            series_failed.index = range(1, len(self.failed_emails) + 1)
-            series_failed.index.name = 'num'
-            series_failed.to_excel('failed_emails.xlsx')
-
-            self.logger.info('Successfully written Excel email reports')
-        except Exception as e:
-            raise RuntimeError(f'Error: Excel report writing unsuccessful: {e}')
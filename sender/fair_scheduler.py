@@ -0,0 +1,32 @@
+from typing import Iterable, Iterator
+
+from email_content import EmailContent
+
+
+class FairScheduler:
+    """
+    Interleaves the rendered batches of the events of a batch run, which share the accounts and their rate limits. The
+        next batch is always taken from the event that has been given the fewest emails so far, so that the events get
+        the same share of the sending rate whatever the sizes of their batches, until they run out of emails
+    """
+    def __init__(self, streams: dict[str, Iterable[list[EmailContent]]]):
+        """
+        :param streams: Event key identifier of every event to its rendered batches, such as its Pipeline
+        """
+        self.streams = streams
+        self.num_emails = dict.fromkeys(streams, 0)  # Emails given to each event so far
+
+    def __iter__(self) -> Iterator[tuple[str, list[EmailContent]]]:
+        """
+        :return: Generator of the batches, with the event key identifier of their event. Ties go to the event listed
+            first
+        """
+        iterators = {event_key: iter(stream) for event_key, stream in self.streams.items()}
+        while iterators:
+            event_key = min(iterators, key=self.num_emails.get)
+            email_contents = next(iterators[event_key], None)
+            if email_contents is None:
+                del iterators[event_key]
+                continue
+            self.num_emails[event_key] += len(email_contents)
+            yield event_key, email_contents
@@ -1,8 +1,119 @@
+import argparse
+import fnmatch
 import os
+from typing import Callable
 import yaml
 
 
 class InputReader:
+    @staticmethod
+    def get_args(argv: list[str] = None) -> argparse.Namespace:
+        """
+        Reads the command line options that tune the sending process
+        :param argv: Options to parse, or None to read them from the command line
+        :return: Namespace of the parsed options
+        """
+        parser = argparse.ArgumentParser(description='Send the personalised emails of an event')
+        parser.add_argument('--batch-size', type=int, default=40,
+                            help='Minimum number of emails per batch, groups are never split (default: 40)')
+        parser.add_argument('--max-workers', type=int, default=20,
+                            help='Maximum number of sending threads of the threaded engine (default: 20)')
+        parser.add_argument('--initial-rate', type=float, default=10,
+                            help='Emails per second at the start, adapted to the replies of the server (default: 10)')
+        parser.add_argument('--max-rate', type=float, default=100,
+                            help='Upper bound of the adaptive rate in emails per second (default: 100)')
+        parser.add_argument('--queue-depth', type=int, default=4,
+                            help='Maximum number of batches fetched and rendered ahead of sending (default: 4)')
+        parser.add_argument('--render-processes', type=int, default=0,
+                            help='Processes rendering and serialising the emails in parallel, for runs limited by the '
+                                 'CPU rather than the SMTP server, 0 to render in a thread of the sending process '
+                                 '(default: 0)')
+        parser.add_argument('--engine', choices=['threaded', 'async'], default=None,
+                            help="Sending engine, overrides the event's 'engine' field (default: threaded)")
+        parser.add_argument('--max-connections', type=int, default=20,
+                            help='Maximum number of concurrent SMTP sessions of the async engine (default: 20)')
+        parser.add_argument('--max-messages-per-connection', type=int, default=100,
+                            help='Number of emails sent over one SMTP connection before it is replaced (default: 100)')
+        parser.add_argument('--max-recipients-per-message', type=int, default=1,
+                            help='Maximum number of consecutive emails with the same body, such as when the body has '
+                                 'no placeholders, sent as one email with every recipient as BCC (default: 1, every '
+                                 'email is sent separately)')
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help='Attempts of an email that keeps failing transiently, such as on 4xx replies or '
+                                 'dropped connections, before it is marked as failed (default: 5)')
+        parser.add_argument('--report-format', choices=['csv', 'jsonl'], default='csv',
+                            help='Format of the delivery report written as the results arrive (default: csv)')
+        parser.add_argument('--excel-report', choices=['none', 'full', 'legacy'], default='none',
+                            help="Excel conversion of the delivery report at the end of the run: 'full' for one file "
+                                 "with every field, 'legacy' for successful_emails.xlsx and failed_emails.xlsx "
+                                 "(default: none)")
+        parser.add_argument('--metrics-file', default=None,
+                            help='File a snapshot of the sending metrics is written to periodically (default: none)')
+        parser.add_argument('--metrics-format', choices=['prometheus', 'json'], default='prometheus',
+                            help='Format of the metrics file (default: prometheus)')
+        parser.add_argument('--metrics-interval', type=float, default=10,
+                            help='Seconds between two snapshots of the metrics file (default: 10)')
+        parser.add_argument('--log-file', default=None,
+                            help='File the log is appended to (default: email_sender.log next to main.py)')
+        parser.add_argument('--log-format', choices=['text', 'json'], default='text',
+                            help="Format of the log: 'json' writes one object per line with the recipient, SMTP id, "
+                                 "latency and outcome of every email as fields (default: text)")
+        parser.add_argument('--log-success-sample-rate', type=float, default=1.0,
+                            help='Fraction of the lines of successfully sent emails written to the log, failures are '
+                                 'always written (default: 1)')
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip the emails the send journal records as delivered by a previous run of the event')
+        parser.add_argument('--project-path', default=None,
+                            help='Path of the project directory, with the events and email_details folders')
+        parser.add_argument('--event', default=None,
+                            help='Event key identifier of the event, instead of asking for it')
+        parser.add_argument('--events', type=InputReader.split_names, default=None,
+                            help="Comma separated event keys, or patterns such as 'freshers_*', sent together in one "
+                                 "batch run that shares the database connection, the SMTP connections and the rate "
+                                 "limits between them")
+        parser.add_argument('--accounts', '--account', type=InputReader.split_names, default=None,
+                            help='Comma separated accounts the emails are sent from, shared by weighted round robin, '
+                                 'instead of asking for them')
+        spool = parser.add_mutually_exclusive_group()
+        spool.add_argument('--spool', default=None, metavar='DIR',
+                           help='Render every email to a spool directory instead of sending it, to be sent later with '
+                                '--drain')
+        spool.add_argument('--drain', default=None, metavar='DIR',
+                           help='Send the emails of a spool directory as they were rendered, with the event and '
+                                'accounts it was rendered for, instead of asking for them. The emails delivered since '
+                                'the spool was written, such as by an earlier drain of it, are skipped')
+        parser.add_argument('--yes', action='store_true',
+                            help='Send without asking for confirmation')
+        parser.add_argument('--smtp-host', default=None,
+                            help='SMTP server the emails are sent through (default: smtp.gmail.com)')
+        parser.add_argument('--smtp-port', type=int, default=None,
+                            help='Port of the SMTP server (default: 587)')
+        parser.add_argument('--no-starttls', action='store_true',
+                            help='Send without STARTTLS, only for local SMTP servers such as the benchmark stand-in')
+        parser.add_argument('--journal-path', default=None,
+                            help='SQLite file of the send journal (default: send_journal.db next to main.py)')
+        parser.add_argument('--suppression-path', default=None,
+                            help='SQLite file of the suppression index of the addresses never emailed again, shared '
+                                 'by every event (default: suppression.db next to main.py)')
+        parser.add_argument('--suppress', action='append', default=[], metavar='FILE',
+                            help='Adds the addresses of a file to the suppression index before sending: an opt-out '
+                                 'list with one address per line (.txt), or the delivery report of a previous run, '
+                                 'whose recipients refused with a 550 to 553 reply to RCPT TO are added. Can be '
+                                 'repeated')
+        parser.add_argument('--no-suppression', action='store_true',
+                            help='Email every row, including those of suppressed addresses')
+        parser.add_argument('--dedup', action='store_true',
+                            help='Email an address in several rows of the table only once, from its first row')
+        return parser.parse_args(argv)
+
+    @staticmethod
+    def split_names(text: str) -> list[str]:
+        """
+        :param text: Comma separated names, such as account names
+        :return: The names, without duplicates, in the given order
+        """
+        return list(dict.fromkeys(name.strip() for name in text.split(',') if name.strip()))
+
     @staticmethod
     def get_events(events_path: str) -> set[str]:
         """
@@ -21,33 +132,48 @@ class InputReader:
                    file.startswith('email_details_') and file != 'email_details_example.yaml')
 
     @staticmethod
-    def get_input(project_path: str) -> tuple[dict[str], str]:
+    def get_input(project_path: str, on_event: Callable[[dict[str]], None] = None, event_key: str = None,
+                  accounts: list[str] = None) -> tuple[dict[str], list[str]]:
         """
-        Reads user inputs on the event and email to send from
+        Reads user inputs on the event and emails to send from
         :param project_path: Path of the project directory
+        :param on_event: Function called with the event details as soon as they are read, before the accounts are asked
+            for, or None
+        :param event_key: Event key identifier given on the command line, or None to ask for it
+        :param accounts: Accounts given on the command line, or None to ask for them
         :return: event_details: dictionary containing all the necessary details of the event, as defined in the event's
-            yaml file, account: the email account where the emails are going to be sent from
+            yaml file, accounts: the email accounts where the emails are going to be sent from
         """
         events_path = os.path.join(project_path, 'events')
         emails_path = os.path.join(project_path, 'email_details')
 
         available_events = InputReader.get_events(events_path)
-        event_key = input('Enter the event key identifier of the event: ')
+        if event_key is not None and event_key not in available_events:
+            raise FileNotFoundError(f'Error: Event key {event_key} not found')
+        if event_key is None:
+            event_key = input('Enter the event key identifier of the event: ')
         while event_key not in available_events:
             print('Invalid input, event key not found')
             print(f'\tAvailable event keys: {', '.join(available_events)}')
             event_key = input('Enter a valid event key identifier: ')
 
+        event_details = InputReader.read_event_details(events_path, event_key)
+        if on_event is not None:
+            on_event(event_details)
+
+        return event_details, InputReader.get_accounts_input(emails_path, accounts)
+
+    @staticmethod
+    def read_event_details(events_path: str, event_key: str) -> dict[str]:
+        """
+        :param events_path: Path of the events folder where all events should be defined
+        :param event_key: Event key identifier of an existing event
+        :return: Dictionary containing all the necessary details of the event, as defined in the event's yaml file, with
+            the optional fields filled in
+        """
         with open(os.path.join(events_path, event_key, event_key + '.yaml')) as file:
             event_details = yaml.safe_load(file)
 
-        available_accounts = InputReader.get_accounts(emails_path)
-        account = input(f'Enter the account from which you want to send: {', '.join(available_accounts)}: ')
-        while account not in available_accounts:
-            print('Invalid input, account not found')
-            print(f'\tAvailable accounts: {', '.join(available_accounts)}')
-            account = input('Enter a valid account: ')
-
         if 'table_name' not in event_details:
             event_details['table_name'] = event_key
         if 'email_sender' not in event_details:
@@ -56,5 +182,50 @@ class InputReader:
             event_details['grouping_requirement'] = None
         if 'attachment' not in event_details:
             event_details['attachment'] = None
+        if 'engine' not in event_details:
+            event_details['engine'] = None
+        return event_details
+
+    @staticmethod
+    def get_events_input(project_path: str, patterns: list[str]) -> dict[str, dict[str]]:
+        """
+        Reads the events of a batch run
+        :param project_path: Path of the project directory
+        :param patterns: Event key identifiers, or shell-style patterns such as 'freshers_*' matching several of them
+        :return: Event key identifier of every event matched, in the order of the patterns then alphabetical, to its
+            event details
+        """
+        events_path = os.path.join(project_path, 'events')
+        available_events = sorted(InputReader.get_events(events_path))
+
+        event_keys = []
+        for pattern in patterns:
+            matched = fnmatch.filter(available_events, pattern)
+            if not matched:
+                raise FileNotFoundError(f'Error: No event key matching {pattern} found')
+            event_keys += [event_key for event_key in matched if event_key not in event_keys]
+
+        return {event_key: InputReader.read_event_details(events_path, event_key) for event_key in event_keys}
+
+    @staticmethod
+    def get_accounts_input(emails_path: str, accounts: list[str] = None) -> list[str]:
+        """
+        Reads user inputs on the emails to send from
+        :param emails_path: Path of the email_details folder where all emails should be defined
+        :param accounts: Accounts given on the command line, or None to ask for them
+        :return: The email accounts where the emails are going to be sent from
+        """
+        available_accounts = InputReader.get_accounts(emails_path)
+        if accounts is not None:
+            for account in accounts:
+                if account not in available_accounts:
+                    raise FileNotFoundError(f'Error: Account {account} not found')
+        if accounts is None:
+            accounts = InputReader.split_names(input(f'Enter the accounts from which you want to send, separated by '
+                                                        f'commas: {', '.join(available_accounts)}: '))
+        while not accounts or not set(accounts) <= available_accounts:
+            print('Invalid input, account not found')
+            print(f'\tAvailable accounts: {', '.join(available_accounts)}')
+            accounts = InputReader.split_names(input('Enter valid accounts, separated by commas: '))
 
-        return event_details, account
+        return accounts
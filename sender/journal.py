@@ -0,0 +1,83 @@
+import sqlite3
+import threading
+from time import time
+
+
+class SendJournal:
+    """
+    Append-only on-disk record of every email sent, written as soon as each send finishes. Backed by SQLite in WAL mode,
+        so a record survives the process dying right after it's written, and a run can be resumed by skipping the rows
+        that were already delivered
+    """
+    def __init__(self, path: str, event_key: str):
+        """
+        :param path: Path of the SQLite database file, created if it doesn't exist
+        :param event_key: Identifier of the event, the name of its SQL table
+        """
+        self.event_key = event_key
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)  # Autocommit every record
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')  # Durable against crashes of the process without an fsync per email
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS deliveries (
+            event TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            email TEXT NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            finished_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            account TEXT,
+            PRIMARY KEY (event, row_id)
+        );''')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(deliveries);')}
+        if 'attempts' not in columns:  # Journal written before the number of attempts was recorded
+            self.conn.execute('ALTER TABLE deliveries ADD COLUMN attempts INTEGER NOT NULL DEFAULT 1;')
+        if 'account' not in columns:  # Journal written before the sending account was recorded
+            self.conn.execute('ALTER TABLE deliveries ADD COLUMN account TEXT;')
+
+    def record(self, row_id: int, email: str, status: str, attempts: int, error: str = None,
+               account: str = None) -> None:
+        """
+        Records the outcome of one email, replacing the outcome of a previous run for the same row
+        :param row_id: id of the SQL row the email was built from
+        :param email: Address of the recipient
+        :param status: 'sent' or 'failed'
+        :param attempts: Number of attempts made to send the email
+        :param error: Reason of the final failure, or None if the email was sent
+        :param account: Address the email was sent from, or None if it wasn't assigned to an account
+        :return: None
+        """
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO deliveries (event, row_id, email, status, error, finished_at, '
+                              'attempts, account) VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+                              (self.event_key, row_id, email, status, error, time(), attempts, account))
+
+    def delivered_row_ids(self, since: float = None) -> set[int]:
+        """
+        :param since: Unix time from which the emails are counted, or None for every email
+        :return: ids of the rows of the event whose email was sent successfully
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT row_id FROM deliveries WHERE event = ? AND status = 'sent' "
+                                     "AND finished_at >= ?;", (self.event_key, since or 0)).fetchall()
+        return {row[0] for row in rows}
+
+    def count_sent_since(self, account: str, since: float) -> int:
+        """
+        :param account: Address the emails were sent from
+        :param since: Unix time from which the emails are counted
+        :return: Number of emails of any event sent successfully from the account since the given time
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT COUNT(*) FROM deliveries WHERE account = ? AND status = 'sent' "
+                                    "AND finished_at >= ?;", (account, since)).fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        """
+        Close the journal
+        :return: None
+        """
+        with self.lock:
+            self.conn.close()
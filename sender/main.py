@@ -1,77 +1,253 @@
-from time import time
+from time import perf_counter, time
+imports_start = perf_counter()
+
+import os
 import sys
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from typing import Callable
 
+from batch_run import run_batch
 from email_sender import EmailSender
 from database import Database
 from input_reader import InputReader
+from metrics import Metrics, MetricsExporter
+from pipeline import Pipeline
+from preflight import Preflight
+from run_setup import make_email_sender, open_journal, open_report, write_excel_reports
+from spool import SpoolReader, SpoolWriter
+from suppression import SuppressionIndex
 import utils
 
+imports_time = perf_counter() - imports_start
+
 project_path = '/Users/sihanyu/Documents/Programming/Github/EventManager'
 
 
-def main():
+def main(argv: list[str] = None, database_factory: Callable[..., Database] = Database):
+    """
+    Sends the emails of an event, or of several events together with --events
+    :param argv: Command line options, or None to read them from the command line
+    :param database_factory: Function opening the source of the rows, called with the arguments of Database. The
+        benchmark replaces it with a synthetic row source
+    :return: None
+    """
+    args = InputReader.get_args(argv)
+    event_project_path = args.project_path or project_path
+
+    # Addresses that bounced or opted out are never emailed again, and with --dedup the rows of an address but the first
+    suppression = SuppressionIndex(args.suppression_path or os.path.join(os.path.dirname(__file__), 'suppression.db'))
     try:
-        event_details, account = InputReader.get_input(project_path)
-    except FileNotFoundError as e:
+        for path in args.suppress:
+            print(f'{suppression.import_file(path)} new addresses of {path} added to the suppression index')
+    except (FileNotFoundError, ValueError) as e:
+        suppression.close()
         sys.exit(str(e))
+    suppressed = None if args.no_suppression else suppression.addresses()
 
-    utils.check_event_details_validity(event_details)
+    if args.events is not None:
+        try:
+            run_batch(args, event_project_path, suppression, suppressed, database_factory=database_factory)
+        finally:
+            suppression.close()
+        return
 
-    logger = utils.get_logger(event_details['name'])
-    db = None
+    itersize = 1000
 
-    try:
-        # Initialise database connection
-        db = Database(
+    # The database connection, the row count, the attachment and the SMTP logins are prepared in the background while
+    # the operator answers the prompts, so that sending starts as soon as it's confirmed
+    preflight = Preflight()
+    logger = None
+    get_logger = partial(utils.get_logger, log_path=args.log_file, log_format=args.log_format,
+                         success_sample_rate=args.log_success_sample_rate)
+
+    def on_event(event_details: dict[str]) -> None:
+        nonlocal logger
+        utils.check_event_details_validity(event_details)
+        logger = get_logger(event_details['name'])
+        preflight.start('database', lambda: database_factory(
             logger=logger,
             cols=event_details['cols'],
-            project_path=project_path,
+            project_path=event_project_path,
             table_name=event_details['table_name'],
-            grouping_requirement=event_details['grouping_requirement']
-        )
+            grouping_requirement=event_details['grouping_requirement'],
+            itersize=itersize,
+            suppressed=suppressed,
+            dedup=args.dedup
+        ))
+
+    prompts_start = perf_counter()
+    try:
+        if args.drain is not None:
+            # A spool is sent with the event and accounts it was rendered for, its emails stand in for the database
+            spool_metadata = SpoolReader.read_metadata(args.drain)
+            event_details, accounts = spool_metadata['event_details'], spool_metadata['accounts']
+            logger = get_logger(event_details['name'])
+            preflight.start('database', lambda: SpoolReader(args.drain))
+        else:
+            event_details, accounts = InputReader.get_input(event_project_path, on_event=on_event,
+                                                            event_key=args.event, accounts=args.accounts)
+    except FileNotFoundError as e:
+        preflight.shutdown()
+        suppression.close()
+        sys.exit(str(e))
+    prompts_time = perf_counter() - prompts_start
+
+    journal = None
+    report = None
+    executor = ThreadPoolExecutor(max_workers=args.max_workers)
+
+    try:
+        utils.check_body_validity(event_details)
+
+        # Every outcome is recorded as soon as it's known, so that a run that dies can be resumed
+        journal = open_journal(args, event_details['table_name'])
+        delivered_row_ids = set()
+        if args.resume:
+            delivered_row_ids = journal.delivered_row_ids()
+        elif args.drain is not None:
+            # Draining a spool again only sends the emails the previous drains of it didn't deliver
+            delivered_row_ids = journal.delivered_row_ids(since=spool_metadata['created_at'])
+
+        # The command line option takes precedence over the event's yaml file
+        engine = args.engine or event_details['engine'] or 'threaded'
+        progress_bar_len = 30
+        metrics = Metrics()
+        # The emails of a spool were grouped when they were rendered
+        max_recipients_per_message = (spool_metadata['max_recipients_per_message'] if args.drain is not None
+                                      else args.max_recipients_per_message)
+
+        def make_sender() -> EmailSender:
+            email_sender = make_email_sender(
+                args, engine, logger=logger, project_path=event_project_path, event_details=event_details,
+                accounts=accounts, total_emails=preflight.result('remaining emails'),
+                progress_bar_len=progress_bar_len, executor=executor, journal=journal, metrics=metrics,
+                suppression=suppression, max_recipients_per_message=max_recipients_per_message,
+                render=args.drain is None)
 
-        no_of_emails = db.length
-        if no_of_emails == 0:
+            # As many connections as the rate controllers start with are logged in before the first email, none are
+            # needed to spool
+            if args.spool is None:
+                preflight.start('smtp warm-up', email_sender.warm_up)
+            return email_sender
+
+        preflight.start('remaining emails', lambda: preflight.result('database').count_remaining(delivered_row_ids))
+        preflight.start('email sender', make_sender)
+        if args.render_processes > 0 and args.drain is None:
+            # Imported here so that the multiprocessing machinery is only loaded when it's used
+            from render_pool import make_render_pool
+            preflight.start('render processes', lambda: make_render_pool(args.render_processes))
+
+        wait_start = perf_counter()
+        db = preflight.result('database')
+        wait_time = perf_counter() - wait_start
+
+        no_of_emails = preflight.result('remaining emails')
+        if no_of_emails < db.length:
+            print(f'Resuming, {db.length - no_of_emails} emails already delivered will be skipped')
+            logger.info(f'Resuming, skipping {db.length - no_of_emails} already delivered emails')
+
+        if db.length == 0:
             raise AttributeError('Error: No emails found, table is empty')
+        if no_of_emails <= 0:
+            raise AttributeError('All emails have already been delivered')
 
         suffix = 's' if no_of_emails != 1 else ''
-        confirm = utils.get_confirmation(no_of_emails, suffix)
-        if confirm == 'yes':
-            # Use the corresponding email sender function
-            get_email_contents = utils.select_function(event_details['email_sender'])
 
+        # Rows stream in from a server-side cursor and are rendered ahead in a background thread, or in the render
+        # processes, so the workers keep sending while the next batches are fetched and rendered. The emails of a spool
+        # are already rendered and are only read back
+        get_email_contents = utils.select_function(event_details['email_sender'])
+        render = lambda data: get_email_contents(data, event_details['cols'], event_details['body'])
+        render_executor = None
+        queue_depth = args.queue_depth
+        if args.drain is not None:
+            render = db.render
+        elif args.render_processes > 0:
+            from render_pool import render_batch
+            render = partial(render_batch, event_details['email_sender'], event_details['cols'],
+                             event_details['body'])
+            render_executor = preflight.result('render processes')
+            queue_depth = max(queue_depth, 2 * args.render_processes)  # A batch ahead for every process
+        # The emails of suppressed and duplicate addresses the source couldn't leave out are skipped once rendered
+        filters_rows = db.filters_rows()
+        pipeline = Pipeline(
+            logger=logger,
+            batches=db.iter_batches(batch_size=args.batch_size),
+            render=render,
+            queue_depth=queue_depth,
+            skip_row_ids=delivered_row_ids,
+            metrics=metrics,
+            render_executor=render_executor,
+            suppressed=None if filters_rows else suppressed,
+            dedup=not filters_rows and args.dedup
+        )
+
+        if args.spool is not None:
+            # Nothing is sent, so there is nothing to confirm, the spool is confirmed when it's drained
+            print(f'Spooling {no_of_emails} email{suffix} to {args.spool}...')
+            logger.info(f'Spooling {no_of_emails} emails to {args.spool}')
+            start_time = time()
+            email_sender = preflight.result('email sender')
+            spool_metadata = {'event_details': event_details, 'accounts': accounts,
+                              'max_recipients_per_message': max_recipients_per_message}
+            with SpoolWriter(args.spool, spool_metadata) as spool, pipeline:
+                num_spooled = sum(email_sender.spool_emails(email_contents, spool) for email_contents in pipeline)
+
+            mins, secs = divmod(time() - start_time, 60)
+            mins, secs = int(mins), round(secs, 2)
+            print(f'{num_spooled} emails spooled in {spool.num_messages} messages, time taken: {mins} minutes and '
+                  f'{secs} seconds, send them with --drain {args.spool}')
+            logger.info(f'{num_spooled} emails spooled to {args.spool} in {spool.num_messages} messages, time taken: '
+                        f'{mins} minutes and {secs} seconds')
+            return
+
+        confirmation_start = perf_counter()
+        confirm = 'yes' if args.yes else utils.get_confirmation(no_of_emails, suffix)
+        confirmation_time = perf_counter() - confirmation_start
+        if confirm == 'yes':
             print('Sending emails...')
             logger.info('Starting email sending process')
+            logger.info(f'Using the {engine} sending engine')
             start_time = time()
 
-            max_workers = 5
-            batch_size = 40
+            wait_start = perf_counter()
+            email_sender = preflight.result('email sender')
+            wait_time += perf_counter() - wait_start
+            logger.info(f'Startup timings: imports {imports_time:.3f} s, event and account prompts {prompts_time:.3f} s, '
+                        f'confirmation prompt {confirmation_time:.3f} s, waited for preflight {wait_time:.3f} s')
 
             # Generate a live progress bar that shows the progress as a loading bar and the number of emails sent
-            progress_bar_len = 30
             print(f'\rBatch number 1, Progress: {'-' * progress_bar_len} 0/{no_of_emails} emails sent', end='')
 
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                with EmailSender(
-                    logger=logger,
-                    executor=executor,
-                    project_path=project_path,
-                    event_details=event_details,
-                    account=account,
-                    total_emails=no_of_emails,
-                    progress_bar_len=progress_bar_len
-                ) as email_sender:
-                    has_next = True
-                    while has_next:
-                        data, has_next = db.get_data(batch_size=batch_size)
-
-                        email_contents = get_email_contents(data, event_details['cols'], event_details['body'])
+            # One line is appended per result as it arrives, so the report is complete up to the last result even if
+            # the run dies. It's only created once sending is confirmed, so that an aborted run doesn't overwrite it
+            report = open_report(args)
+            email_sender.report = report
+            logger.info(f'Writing the delivery report to {report.path}')
+
+            # The exporter is exited after the sender, so that its last snapshot includes the closed connections
+            exporter = nullcontext()
+            if args.metrics_file is not None:
+                exporter = MetricsExporter(logger=logger, metrics=metrics, path=args.metrics_file,
+                                           export_format=args.metrics_format, interval=args.metrics_interval)
+                logger.info(f'Writing the metrics to {args.metrics_file} every {args.metrics_interval} seconds')
 
+            with exporter, email_sender:
+                with pipeline:
+                    for email_contents in pipeline:
                         email_sender.send_emails(email_contents=email_contents)
 
-                    num_batches = email_sender.batch_no
-                    num_successful_emails = email_sender.emails_sent
+                email_sender.wait()
+
+                num_batches = email_sender.batch_no
+                num_successful_emails = email_sender.emails_sent
+
+            report.close()
+            if args.excel_report != 'none':
+                write_excel_reports(args, report)
+                logger.info('Successfully written Excel email reports')
 
             mins, secs = divmod(time() - start_time, 60)
             mins, secs = int(mins), round(secs, 2)
@@ -88,11 +264,27 @@ def main():
         utils.terminate(logger, f'Error: {str(e)}')
 
     finally:
+        # Waits for the steps still running in the background, then closes whatever they opened
+        preflight.shutdown()
+        preflight.log_timings(logger)
+        email_sender = preflight.result_if_done('email sender')
+        if email_sender is not None:
+            email_sender.close()
+        executor.shutdown()
+        render_executor = preflight.result_if_done('render processes')
+        if render_executor is not None:
+            render_executor.shutdown(cancel_futures=True)
+        db = preflight.result_if_done('database')
         if db is not None:
             db.stop()
             logger.info('Database connection closed')
         else:
             logger.info("Database connection not disconnected as it didn't exist")
+        if journal is not None:
+            journal.close()
+        if report is not None:
+            report.close()
+        suppression.close()
         logger.info('Finished email sending process')
 
 
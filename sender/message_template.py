@@ -0,0 +1,105 @@
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.policy import compat32
+from functools import lru_cache
+import re
+
+from attachments import Attachment
+
+TO_PLACEHOLDER = 'to.placeholder@message.template'
+BODY_PLACEHOLDER = '<p>message template body placeholder</p>'
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'  # 'To' header of an email sent to several recipients as BCC
+HEADER_POLICY = compat32.clone(max_line_length=0)  # Message.as_string doesn't fold the headers
+
+Message = list[bytes | memoryview]  # Segments of an email as sent on the wire, see MessageTemplate.assemble
+
+
+def to_wire(text: str) -> bytes:
+    """
+    Converts a serialised email or part of it to what smtplib sends for it: CRLF line endings, ASCII encoded
+    :param text: Serialised email with any line endings
+    :return: Bytes as sent on the wire, before the leading dots are doubled
+    """
+    return re.sub(r'(?:\r\n|\n|\r(?!\n))', '\r\n', text).encode('ascii')
+
+
+@lru_cache(maxsize=256)
+def serialize_body(body: str) -> bytes:
+    """
+    Serialises the html part of an email, independently of the recipient and of the account it's sent from, so that it
+        can be done ahead in another process. Bodies shared by several emails, such as those of a family, are only
+        serialised once while they are recent
+    :param body: Personalised html body
+    :return: The html part, as sent on the wire
+    """
+    return to_wire(MIMEText(body, 'html').as_string())
+
+
+class MessageTemplate:
+    """
+    Pre-serialised skeleton of the emails of an event. The headers, the boundaries and the base64 encoded attachments
+        are the same for every recipient, so they are serialised once and only the 'To' header and the html part are
+        serialised per email. The result is the same as serialising a new MIMEMultipart for each email, but the
+        attachments are never copied into it, they are views of their memory mapped cache files
+    """
+    def __init__(self, from_addr: str, subject: str, attachments: list[Attachment]):
+        """
+        :param from_addr: Address the emails are sent from
+        :param subject: Subject of the emails
+        :param attachments: Files attached after the html body, in order
+        """
+        msg = MIMEMultipart()
+        msg['From'] = from_addr
+        msg['To'] = TO_PLACEHOLDER
+        msg['Subject'] = subject
+        msg.attach(MIMEText(BODY_PLACEHOLDER, 'html'))
+        placeholders = []
+        for i, attachment in enumerate(attachments):
+            # The part is serialised with a placeholder in place of its content, which is already base64 encoded
+            part = MIMEBase(*attachment.content_type.split('/', 1))
+            part['Content-Transfer-Encoding'] = 'base64'
+            if attachment.is_inline():
+                part.add_header('Content-ID', f'<{attachment.content_id}>')
+                part.add_header('Content-Disposition', 'inline', filename=attachment.filename)
+            else:
+                part.add_header('Content-Disposition', 'attachment', filename=attachment.filename)
+            placeholders.append(f'attachment.placeholder.{i}\n')
+            part.set_payload(placeholders[-1])
+            msg.attach(part)
+
+        # Serialising the placeholder email picks the boundary, which is then kept for every email
+        text = msg.as_string()
+        self.boundary = msg.get_boundary()
+
+        head, rest = text.split(HEADER_POLICY.fold('To', TO_PLACEHOLDER), 1)
+        middle, rest = rest.split(msg.get_payload(0).as_string(), 1)
+        self.head = to_wire(head)
+        self.middle = to_wire(middle)
+        self.tail = []  # The rest of the email, the attachments between the headers of their parts and the boundaries
+        for placeholder, attachment in zip(placeholders, attachments):
+            between, rest = rest.split(placeholder, 1)
+            self.tail += [to_wire(between), attachment.encoded]
+        self.tail.append(to_wire(rest))
+
+    def render(self, to_addr: str, body: str) -> Message:
+        """
+        :param to_addr: Address of the recipient
+        :param body: Personalised html body
+        :return: The full email as sent on the wire, in segments
+        """
+        return self.assemble(to_addr, serialize_body(body))
+
+    def assemble(self, to_addr: str, text_part: bytes) -> Message:
+        """
+        :param to_addr: Address of the recipient, or UNDISCLOSED_RECIPIENTS
+        :param text_part: The html part of the email, from serialize_body
+        :return: The full email as sent on the wire, in segments that each start at the beginning of a line: bytes for
+            the headers and the html part, and a memoryview of the cache file of every attachment, which is shared by
+            every email and only holds base64 lines
+        """
+        if self.boundary.encode('ascii') in text_part:  # Practically impossible, but must not appear in the content
+            raise ValueError(f'Email body for {to_addr} contains the MIME boundary')
+
+        to_header = to_wire(HEADER_POLICY.fold('To', to_addr))
+        return [self.head, to_header, self.middle, text_part, *self.tail]
@@ -0,0 +1,265 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+from logging import Logger
+import os
+import threading
+from time import perf_counter, time
+from typing import Callable, Iterator
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets, as in Prometheus: a value is counted in the first bucket whose
+        upper bound is greater than or equal to it, or in the last, unbounded bucket
+    """
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        """
+        :param buckets: Upper bounds of the buckets, in increasing order
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """
+        :param value: Observed value
+        :return: None
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> list[tuple[str, int]]:
+        """
+        :return: Upper bound of each bucket, '+Inf' for the last one, and the number of values lower than or equal to it
+        """
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        cumulative, total = [], 0
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of the sending process, any of which can have labels. Values kept elsewhere, such
+        as queue depths, are read by collectors when a snapshot is taken instead of being updated on the hot path
+    """
+    def __init__(self, prefix: str = 'email_sender'):
+        """
+        :param prefix: Prefix of every metric name in the exports
+        """
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) to value, labels being a sorted tuple of (label, value) pairs
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    @staticmethod
+    def key(name: str, labels: dict[str, str]) -> tuple[str, tuple[tuple[str, str], ...]]:
+        """
+        :param name: Name of the metric
+        :param labels: Labels of the metric
+        :return: Key of the metric in the dictionaries of values
+        """
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """
+        Increments a counter
+        :param name: Name of the counter, ending in '_total'
+        :param value: Increment
+        :param labels: Labels of the counter
+        :return: None
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_counter(self, name: str, value: float, **labels: str) -> None:
+        """
+        Sets a counter whose value is counted elsewhere, from a collector
+        :param name: Name of the counter, ending in '_total'
+        :param value: Current value
+        :param labels: Labels of the counter
+        :return: None
+        """
+        with self.lock:
+            self.counters[self.key(name, labels)] = value
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        """
+        :param name: Name of the gauge
+        :param value: Current value
+        :param labels: Labels of the gauge
+        :return: None
+        """
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """
+        Adds a value to a histogram, created with the latency buckets on its first value
+        :param name: Name of the histogram
+        :param value: Observed value
+        :param labels: Labels of the histogram
+        :return: None
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Observes the seconds the block took, even if it raised
+        :param name: Name of the histogram
+        :param labels: Labels of the histogram
+        :return: Context manager timing the block
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def add_collector(self, collect: Callable[['Metrics'], None]) -> None:
+        """
+        :param collect: Function called with the metrics before every snapshot, setting the values kept elsewhere
+        :return: None
+        """
+        self.collectors.append(collect)
+
+    def collect(self) -> None:
+        """
+        Runs every collector
+        :return: None
+        """
+        for collect in self.collectors:
+            collect(self)
+
+    def full_name(self, name: str, labels: tuple[tuple[str, str], ...], suffix: str = '',
+                  extra_label: tuple[str, str] = None) -> str:
+        """
+        :param name: Name of the metric
+        :param labels: Labels of the metric
+        :param suffix: Suffix of the name, such as '_bucket' for histograms
+        :param extra_label: Label added after the others, such as the upper bound of a bucket, or None
+        :return: Name of the metric with its prefix and labels, as written in the Prometheus text format
+        """
+        labels = labels + (extra_label,) if extra_label is not None else labels
+        label_text = ','.join(f'{label}="{value}"' for label, value in labels)
+        return f'{self.prefix}_{name}{suffix}' + (f'{{{label_text}}}' if label_text else '')
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        :return: Every metric after running the collectors, by type then by name with labels
+        """
+        self.collect()
+        with self.lock:
+            return {
+                'timestamp': time(),
+                'counters': {self.full_name(*key): value for key, value in self.counters.items()},
+                'gauges': {self.full_name(*key): value for key, value in self.gauges.items()},
+                'histograms': {
+                    self.full_name(*key): {'buckets': dict(histogram.cumulative_counts()), 'sum': histogram.sum,
+                                           'count': histogram.count}
+                    for key, histogram in self.histograms.items()
+                }
+            }
+
+    def to_json(self) -> str:
+        """
+        :return: Snapshot of every metric as JSON
+        """
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        :return: Snapshot of every metric in the Prometheus text exposition format
+        """
+        self.collect()
+        lines = []
+        with self.lock:
+            for metric_type, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {self.prefix}_{name} {metric_type}')
+                    lines += [f'{self.full_name(name, labels)} {value}'
+                              for (other_name, labels), value in values.items() if other_name == name]
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {self.prefix}_{name} histogram')
+                for (other_name, labels), histogram in self.histograms.items():
+                    if other_name != name:
+                        continue
+                    lines += [f'{self.full_name(name, labels, '_bucket', ('le', bound))} {count}'
+                              for bound, count in histogram.cumulative_counts()]
+                    lines.append(f'{self.full_name(name, labels, '_sum')} {histogram.sum}')
+                    lines.append(f'{self.full_name(name, labels, '_count')} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """
+    Writes a snapshot of the metrics to a file every 'interval' seconds in a background thread, and once more when it's
+        stopped. The file is replaced atomically, so a reader never sees a partial snapshot
+    """
+    def __init__(self, logger: Logger, metrics: Metrics, path: str, export_format: str = 'prometheus',
+                 interval: float = 10):
+        """
+        :param logger: Reuse the same configured logger
+        :param metrics: Metrics to export
+        :param path: Path of the file the snapshots are written to
+        :param export_format: 'prometheus' for the Prometheus text format or 'json'
+        :param interval: Seconds between two snapshots
+        """
+        if export_format not in ('prometheus', 'json'):
+            raise ValueError(f"Metrics format must be 'prometheus' or 'json', not '{export_format}'")
+
+        self.logger = logger
+        self.metrics = metrics
+        self.path = path
+        self.export_format = export_format
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='metrics-exporter', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def run(self) -> None:
+        """
+        Writes a snapshot every 'interval' seconds until the exporter is stopped
+        :return: None
+        """
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self) -> None:
+        """
+        Writes one snapshot, a failure is only logged as the metrics must never stop the sending
+        :return: None
+        """
+        try:
+            text = self.metrics.to_prometheus() if self.export_format == 'prometheus' else self.metrics.to_json()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                file.write(text)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.warning(f'Failed to write metrics to {self.path}: {e}')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
@@ -0,0 +1,157 @@
+from concurrent.futures import Executor, Future
+from logging import Logger
+import queue
+import threading
+from time import perf_counter
+from typing import Any, Callable, Collection, Iterable, Iterator
+
+from email_content import EmailContent
+from metrics import Metrics
+from suppression import normalise_address
+
+
+class Pipeline:
+    """
+    Producer stage of the sending process: fetches and renders batches in a background thread, keeping up to
+        'queue_depth' rendered batches ready so the email sender never waits on the database or the templating. With a
+        render executor, the batches are rendered in parallel by the executor instead, and are still sent in order
+    """
+    DONE = object()  # Sentinel put on the queue once every batch has been produced
+
+    def __init__(self, logger: Logger, batches: Iterable[list[tuple[Any, ...]]],
+                 render: Callable[[list[tuple[Any, ...]]], Iterable[EmailContent]], queue_depth: int,
+                 skip_row_ids: set[int] = None, metrics: Metrics = None, render_executor: Executor = None,
+                 suppressed: Collection[str] = None, dedup: bool = False):
+        """
+        :param logger: Reuse the same configured logger
+        :param batches: Batches of rows from the SQL table, for example Database.iter_batches
+        :param render: Function turning a batch of rows into EmailContent objects, picklable if the render executor is
+            a process pool
+        :param queue_depth: Maximum number of rendered batches waiting to be sent
+        :param skip_row_ids: ids of the rows whose email must not be sent again, for example because it was already
+            delivered by a previous run. They are still rendered, as the emails of other rows may depend on them
+        :param metrics: Metrics the fetch and render timings and the queue depth are recorded in, or None
+        :param render_executor: Executor the batches are rendered in, such as a pool of render processes, or None to
+            render them in the producer thread. Up to 'queue_depth' batches are rendered at the same time
+        :param suppressed: Normalised addresses whose emails are skipped, for sources that can't leave out their rows,
+            such as a spool or a table with a grouping requirement, or None
+        :param dedup: Whether to skip the emails to an address that was already emailed in the run, kept in memory
+        """
+        self.logger = logger
+        self.batches = batches
+        self.render = render
+        self.render_executor = render_executor
+        self.skip_row_ids = skip_row_ids or set()
+        self.suppressed = set(suppressed or ())
+        self.dedup = dedup
+        self.seen_addresses = set()  # With dedup, every address emailed so far
+        self.num_suppressed = 0
+        self.num_duplicates = 0
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.stopped = threading.Event()
+        self.producer = threading.Thread(target=self.produce, name='pipeline-producer', daemon=True)
+
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.add_collector(lambda m: m.set_gauge('pipeline_queue_depth', self.queue.qsize()))
+
+    def __enter__(self):
+        self.producer.start()
+        return self
+
+    def __iter__(self) -> Iterator[list[EmailContent]]:
+        """
+        :return: Generator of the rendered batches, in the order they were read from the database
+        """
+        while True:
+            item = self.queue.get()
+            if item is Pipeline.DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            if isinstance(item, Future):
+                wait_start = perf_counter()
+                item = self.skip_sent(item.result())
+                self.metrics.observe('render_wait_seconds', perf_counter() - wait_start)
+            yield item
+
+    def skip_sent(self, email_contents: Iterable[EmailContent]) -> list[EmailContent]:
+        """
+        :param email_contents: Rendered batch
+        :return: The emails of the batch whose row isn't skipped, and whose address isn't suppressed nor, with dedup,
+            already emailed
+        """
+        if not self.suppressed and not self.dedup:
+            return [email_content for email_content in email_contents if email_content.row_id not in self.skip_row_ids]
+
+        kept = []
+        num_suppressed = num_duplicates = 0
+        for email_content in email_contents:
+            address = normalise_address(email_content.email) if email_content.email else None
+            if email_content.row_id not in self.skip_row_ids:
+                if address in self.suppressed:
+                    num_suppressed += 1
+                    continue
+                if address in self.seen_addresses:
+                    num_duplicates += 1
+                    continue
+                kept.append(email_content)
+            if self.dedup and address is not None:  # Also the addresses delivered by a previous run
+                self.seen_addresses.add(address)
+        if num_suppressed:
+            self.num_suppressed += num_suppressed
+            self.metrics.inc('emails_suppressed_total', num_suppressed, reason='suppressed')
+        if num_duplicates:
+            self.num_duplicates += num_duplicates
+            self.metrics.inc('emails_suppressed_total', num_duplicates, reason='duplicate')
+        return kept
+
+    def produce(self) -> None:
+        """
+        Fetches and renders every batch, blocking while the queue is full. With a render executor, the future of the
+            rendered batch is queued instead. Exceptions are passed on to the consumer
+        :return: None
+        """
+        try:
+            batches = iter(self.batches)
+            while True:
+                fetch_start = perf_counter()
+                data = next(batches, None)
+                if data is None:
+                    break
+                render_start = perf_counter()
+                self.metrics.observe('db_fetch_seconds', render_start - fetch_start)
+                self.metrics.inc('rows_fetched_total', len(data))
+                if self.render_executor is not None:
+                    email_contents = self.render_executor.submit(self.render, data)
+                else:
+                    email_contents = self.skip_sent(self.render(data))
+                    self.metrics.observe('render_seconds', perf_counter() - render_start)
+
+                if not self.put(email_contents):
+                    return
+            self.put(Pipeline.DONE)
+        except Exception as e:
+            self.logger.error(f'Failed to produce batch: {e}')
+            self.put(e)
+
+    def put(self, item: Any) -> bool:
+        """
+        Puts an item on the queue, giving up if the pipeline is stopped while waiting for space
+        :param item: Rendered batch, exception or sentinel
+        :return: True if the item was queued, False if the pipeline was stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.producer.join()
+        if self.num_suppressed:
+            self.logger.info(f'Skipped {self.num_suppressed} emails to suppressed addresses')
+        if self.num_duplicates:
+            self.logger.info(f'Skipped {self.num_duplicates} emails to addresses emailed from an earlier row')
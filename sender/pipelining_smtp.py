@@ -0,0 +1,135 @@
+import smtplib
+
+from message_template import Message
+from smtp_protocol import STAGE_ENVELOPE, STAGE_MAIL, STAGE_SENT, check_envelope, encode_envelope, iter_data
+
+
+class PipeliningSMTP(smtplib.SMTP):
+    """
+    smtplib.SMTP that sends the envelope of a message in one write when the server advertises the PIPELINING extension
+        (RFC 2920): MAIL FROM, every RCPT TO and DATA cost one round trip, and the message a second one, instead of one
+        round trip per command. Servers without the extension are sent the commands one at a time, as by smtplib. A
+        message in segments is written in chunks, so that its attachments aren't copied. 'stage' tells how far the
+        transaction of the last message got
+    """
+    stage = STAGE_MAIL
+
+    def sendmail(self, from_addr: str, to_addrs: str | list[str], msg: str | bytes | Message, mail_options=(),
+                 rcpt_options=()) -> dict[str, tuple[int, bytes]]:
+        """
+        :param from_addr: Envelope sender
+        :param to_addrs: Envelope recipient or recipients
+        :param msg: The message, either a string of ASCII characters, bytes, or segments from MessageTemplate.assemble
+        :param mail_options: Options of MAIL FROM, only supported without pipelining
+        :param rcpt_options: Options of RCPT TO, only supported without pipelining
+        :return: Reply of the server to every recipient it refused, as smtplib.SMTP.sendmail. If it refused all of them,
+            SMTPRecipientsRefused is raised instead
+        """
+        self.stage = STAGE_MAIL
+        self.ehlo_or_helo_if_needed()
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if not self.has_extn('pipelining') or mail_options or rcpt_options:
+            return self.send_unpipelined(from_addr, to_addrs, msg, mail_options, rcpt_options)
+
+        self.send(encode_envelope(from_addr, to_addrs))
+        replies = []
+        for _ in range(len(to_addrs) + 2):
+            replies.append(self.getreply())
+            if len(replies) == 1 and replies[0][0] == 250:
+                self.stage = STAGE_ENVELOPE
+
+        error, refused = check_envelope(from_addr, to_addrs, replies)
+        if error is not None:
+            if replies[-1][0] == 354:  # The server accepted DATA although the envelope failed, end the empty message
+                self.send(b'.\r\n')
+                self.getreply()
+            self.abort_transaction(replies)
+            raise error
+
+        self.send_data(msg)
+        code, resp = self.getreply()
+        if code != 250:
+            self.abort_transaction([(code, resp)])
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def send_unpipelined(self, from_addr: str, to_addrs: list[str], msg: str | bytes | Message, mail_options=(),
+                         rcpt_options=()) -> dict[str, tuple[int, bytes]]:
+        """
+        The commands of smtplib.SMTP.sendmail one at a time, also for a message in segments, whose SIZE smtplib would
+            take to be the number of segments
+        :param from_addr: Envelope sender
+        :param to_addrs: Envelope recipients
+        :param msg: The message, either a string of ASCII characters, bytes, or segments from MessageTemplate.assemble
+        :param mail_options: Options of MAIL FROM
+        :param rcpt_options: Options of RCPT TO
+        :return: Reply of the server to every recipient it refused, as smtplib.SMTP.sendmail
+        """
+        if isinstance(msg, str):
+            msg = msg.encode('ascii')
+        esmtp_opts = []
+        if self.does_esmtp and self.has_extn('size'):
+            size = len(msg) if isinstance(msg, bytes) else sum(len(segment) for segment in msg)
+            esmtp_opts.append(f'size={size}')
+        code, resp = self.mail(from_addr, esmtp_opts + list(mail_options))
+        if code != 250:
+            self.abort_transaction([(code, resp)])
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        self.stage = STAGE_ENVELOPE
+
+        refused = {}
+        for to_addr in to_addrs:
+            code, resp = self.rcpt(to_addr, rcpt_options)
+            if code not in (250, 251):
+                refused[to_addr] = (code, resp)
+            if code == 421:
+                self.close()
+                raise smtplib.SMTPRecipientsRefused(refused)
+        if len(refused) == len(to_addrs):
+            self.abort_transaction([])
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = self.data(msg)
+        if code != 250:
+            self.abort_transaction([(code, resp)])
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def data(self, msg: str | bytes | Message) -> tuple[int, bytes]:
+        """
+        DATA command of smtplib.SMTP, extended to messages in segments
+        :param msg: The message, either a string of ASCII characters, bytes, or segments from MessageTemplate.assemble
+        :return: Reply of the server to the message
+        """
+        self.putcmd('data')
+        code, resp = self.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        self.send_data(msg)
+        return self.getreply()
+
+    def send_data(self, msg: str | bytes | Message) -> None:
+        """
+        Writes a message after the server accepted DATA, a chunk at a time
+        :param msg: The message, either a string of ASCII characters, bytes, or segments from MessageTemplate.assemble
+        :return: None
+        """
+        for chunk in iter_data(msg):
+            self.send(chunk)
+        self.stage = STAGE_SENT
+
+    def abort_transaction(self, replies: list[tuple[int, bytes]]) -> None:
+        """
+        Closes the connection if the server is shutting it down, otherwise resets the transaction so that the connection
+            can be reused, as smtplib does
+        :param replies: Replies of the server to the failed transaction
+        :return: None
+        """
+        if any(code == 421 for code, _ in replies):
+            self.close()
+            return
+        try:
+            self.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
@@ -0,0 +1,70 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from logging import Logger
+from time import perf_counter
+from typing import Any, Callable
+
+
+class Preflight:
+    """
+    Runs the slow steps of the startup, such as connecting to the database or logging in to the SMTP server, in
+        background threads while the operator is answering the prompts, and times each of them
+    """
+    def __init__(self, max_workers: int = 4):
+        """
+        :param max_workers: Maximum number of steps running at the same time
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='preflight')
+        self.steps = {}  # Name of each started step to its future
+        self.timings = {}  # Name of each finished step to the seconds it took
+
+    def start(self, name: str, step: Callable[[], Any]) -> Future:
+        """
+        :param name: Name of the step, used to wait for it and in the timings
+        :param step: Function running the step, it can wait for the result of steps started before it
+        :return: Future of the result of the step
+        """
+        def run() -> Any:
+            start = perf_counter()
+            try:
+                return step()
+            finally:
+                self.timings[name] = perf_counter() - start
+
+        self.steps[name] = self.executor.submit(run)
+        return self.steps[name]
+
+    def result(self, name: str) -> Any:
+        """
+        Waits for a step to finish
+        :param name: Name of the step
+        :return: Result of the step, the exception it failed with is raised
+        """
+        return self.steps[name].result()
+
+    def result_if_done(self, name: str) -> Any:
+        """
+        :param name: Name of the step
+        :return: Result of the step if it was started and finished successfully, None otherwise
+        """
+        future = self.steps.get(name)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def log_timings(self, logger: Logger) -> None:
+        """
+        :param logger: Reuse the same configured logger
+        :return: None
+        """
+        timings = ', '.join(f'{name} {seconds:.3f} s' for name, seconds in self.timings.items())
+        logger.info(f'Preflight timings: {timings}')
+
+    def shutdown(self) -> None:
+        """
+        Waits for every step to finish, including the ones started by other steps while waiting, and stops the
+            background threads
+        :return: None
+        """
+        while not all(future.done() for future in list(self.steps.values())):
+            wait(list(self.steps.values()))
+        self.executor.shutdown(wait=True)
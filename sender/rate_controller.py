@@ -0,0 +1,132 @@
+import asyncio
+from logging import Logger
+import smtplib
+import threading
+from time import monotonic
+
+THROTTLE_CODES = {421, 450, 454}  # Replies with which the server asks to slow down and try again later
+
+
+def get_smtp_code(e: Exception) -> int | None:
+    """
+    :param e: Exception raised while sending an email
+    :return: SMTP reply code of the exception, or None if the server didn't reply
+    """
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code
+    if isinstance(e, smtplib.SMTPRecipientsRefused) and e.recipients:
+        return next(iter(e.recipients.values()))[0]
+    return None
+
+
+def is_throttled(e: Exception) -> bool:
+    """
+    :param e: Exception raised while sending an email
+    :return: Whether the server refused the email because it's sending too fast
+    """
+    return get_smtp_code(e) in THROTTLE_CODES
+
+
+class RateController:
+    """
+    Adaptive sending rate and concurrency. A token bucket limits the number of emails started per second, and the number
+        of emails in flight is limited by a concurrency window. Both double every round until the server first throttles
+        (slow start), then grow additively while emails are accepted and are halved when the server throttles (AIMD),
+        which also pauses sending with an exponential backoff
+    """
+    def __init__(self, logger: Logger, initial_rate: float, max_concurrency: int, initial_concurrency: int = 5,
+                 max_rate: float = 100, max_backoff: float = 60):
+        """
+        :param logger: Reuse the same configured logger
+        :param initial_rate: Emails started per second at the beginning
+        :param max_concurrency: Upper bound of the concurrency window, the number of workers or connections
+        :param initial_concurrency: Emails in flight allowed at the beginning
+        :param max_rate: Upper bound of the rate
+        :param max_backoff: Upper bound in seconds of the pause after consecutive throttling replies
+        """
+        self.logger = logger
+        self.rate = initial_rate
+        self.max_rate = max_rate
+        self.concurrency = float(min(initial_concurrency, max_concurrency))
+        self.max_concurrency = max_concurrency
+        self.max_backoff = max_backoff
+
+        self.tokens = 1.0  # The bucket holds at most one second worth of tokens
+        self.last_refill = monotonic()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.consecutive_throttles = 0
+        self.num_throttles = 0
+        self.slow_start = True
+        self.cond = threading.Condition()
+
+    def try_acquire(self) -> float:
+        """
+        Takes a token and a concurrency slot if both are available
+        :return: 0 if the email can be sent now, otherwise the number of seconds to wait before trying again
+        """
+        with self.cond:
+            now = monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.in_flight >= int(self.concurrency):
+                return 0.05  # Woken up earlier by release in the threaded engine
+
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+
+            self.tokens -= 1
+            self.in_flight += 1
+            return 0
+
+    def acquire(self) -> None:
+        """
+        Blocks the calling thread until the email can be sent
+        :return: None
+        """
+        while (delay := self.try_acquire()) > 0:
+            with self.cond:
+                self.cond.wait(delay)
+
+    async def acquire_async(self) -> None:
+        """
+        Suspends the calling coroutine until the email can be sent
+        :return: None
+        """
+        while (delay := self.try_acquire()) > 0:
+            await asyncio.sleep(delay)
+
+    def release(self, throttled: bool) -> None:
+        """
+        Gives back the concurrency slot and adapts the rate and concurrency to the outcome of the email
+        :param throttled: Whether the server replied with a throttling code
+        :return: None
+        """
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.num_throttles += 1
+                self.slow_start = False
+                if monotonic() < self.paused_until:  # Emails throttled while already backing off are the same event
+                    self.cond.notify_all()
+                    return
+                self.consecutive_throttles += 1
+                self.rate = max(self.rate / 2, 0.1)
+                self.concurrency = max(self.concurrency / 2, 1.0)
+                backoff = min(2 ** (self.consecutive_throttles - 1), self.max_backoff)
+                self.paused_until = max(self.paused_until, monotonic() + backoff)
+                self.logger.warning(f'Throttled by the SMTP server, pausing for {backoff} seconds, rate reduced to '
+                                    f'{self.rate:.2f} emails/second and concurrency to {int(self.concurrency)}')
+            else:
+                self.consecutive_throttles = 0
+                rate_increase = 1 if self.slow_start else 1 / self.rate
+                concurrency_increase = 1 if self.slow_start else 1 / self.concurrency
+                self.rate = min(self.rate + rate_increase, self.max_rate)
+                self.concurrency = min(self.concurrency + concurrency_increase, self.max_concurrency)
+            self.cond.notify_all()
+
+    def __str__(self):
+        return (f'rate: {self.rate:.2f} emails/second, concurrency: {int(self.concurrency)}, '
+                f'throttling replies: {self.num_throttles}')
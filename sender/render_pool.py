@@ -0,0 +1,40 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from typing import Any
+
+from email_content import EmailContent
+from message_template import serialize_body
+import utils
+
+
+def make_render_pool(processes: int) -> ProcessPoolExecutor:
+    """
+    Starts the processes that render and serialise the emails. They are spawned rather than forked, as the sender
+        already runs threads, and they are all started by the first task, so that they are ready before sending starts
+    :param processes: Number of processes, usually the number of cores
+    :return: The process pool, to be passed to Pipeline
+    """
+    executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+    executor.submit(int).result()
+    return executor
+
+
+def render_batch(email_sender_type: str | None, cols: list[str], body: str,
+                 data: list[tuple[Any, ...]]) -> list[EmailContent]:
+    """
+    Renders a batch of rows in a render process, and serialises the html part of every email, so that the templating
+        and the MIME serialisation of different batches use all the cores instead of competing for the GIL with the
+        sending threads. The serialised part is sent back instead of the body, only the headers are added to it when
+        the email is sent
+    :param email_sender_type: The 'get_email_contents' function type defined in the event's yaml file
+    :param cols: Columns of the SQL data
+    :param body: Email template of the event
+    :param data: Batch of rows, a whole batch is one task so that the cost of sending it to the process stays small
+    :return: The EmailContent objects of the batch, with 'part' set and without 'body'
+    """
+    get_email_contents = utils.select_function(email_sender_type)
+    email_contents = list(get_email_contents(data, cols, body))
+    for email_content in email_contents:
+        email_content.part = serialize_body(email_content.body)
+        email_content.body = None
+    return email_contents
@@ -0,0 +1,94 @@
+import heapq
+from itertools import count
+from logging import Logger
+import random
+import smtplib
+import threading
+from time import monotonic
+from typing import Callable
+
+from rate_controller import get_smtp_code
+
+
+def is_transient(e: Exception) -> bool:
+    """
+    :param e: Exception an attempt to send an email failed with
+    :return: Whether trying again later may succeed: 4xx replies, disconnections and timeouts. 5xx replies and errors
+        in the email itself are permanent
+    """
+    code = get_smtp_code(e)
+    if code is not None:
+        return 400 <= code < 500
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(e, smtplib.SMTPException):
+        return False
+    return isinstance(e, OSError)  # Includes timeouts and refused or reset connections
+
+
+def backoff_delay(attempts: int, base_delay: float, max_delay: float) -> float:
+    """
+    Exponential backoff with jitter, so that emails that failed together aren't all retried at the same moment
+    :param attempts: Number of attempts made so far, at least 1
+    :param base_delay: Delay after the first attempt, before the jitter
+    :param max_delay: Upper bound of the delay
+    :return: Seconds to wait before the next attempt, between half and all of the exponential delay
+    """
+    delay = min(base_delay * 2 ** (attempts - 1), max_delay)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RetryQueue:
+    """
+    Runs callbacks after a delay on a single background thread, used to resubmit emails that failed transiently
+        without holding a worker while they wait
+    """
+    def __init__(self, logger: Logger):
+        """
+        :param logger: Reuse the same configured logger
+        """
+        self.logger = logger
+        self.heap = []  # (due time, sequence number, callback), the sequence number breaks ties between callbacks
+        self.sequence = count()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='retry-queue', daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> None:
+        """
+        :param delay: Seconds to wait before running the callback
+        :param callback: Function to run, it must not block for long
+        :return: None
+        """
+        with self.cond:
+            heapq.heappush(self.heap, (monotonic() + delay, next(self.sequence), callback))
+            self.cond.notify()
+
+    def run(self) -> None:
+        """
+        Runs every callback once it's due, until the queue is stopped. A callback that raises is logged and the queue
+            goes on with the others
+        :return: None
+        """
+        while True:
+            with self.cond:
+                while not self.stopped and (not self.heap or self.heap[0][0] > monotonic()):
+                    self.cond.wait(self.heap[0][0] - monotonic() if self.heap else None)
+                if self.stopped:
+                    return
+                _, _, callback = heapq.heappop(self.heap)
+            try:
+                callback()
+            except Exception:
+                self.logger.exception('Retry callback failed')
+
+    def stop(self) -> None:
+        """
+        Stops the background thread, dropping the callbacks that aren't due yet
+        :return: None
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
@@ -0,0 +1,130 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from typing import Callable
+
+from async_email_sender import AsyncEmailSender
+from delivery_report import DeliveryReport
+from email_sender import EmailSender
+from journal import SendJournal
+from metrics import Metrics
+from rate_controller import RateController
+from suppression import SuppressionIndex
+
+
+def event_path(path: str, event_key: str | None) -> str:
+    """
+    :param path: Path of an output file of a single event run, such as 'metrics.prom'
+    :param event_key: Event key identifier of an event of a batch run, or None for a single event run
+    :return: Path of the file of the event, such as 'metrics_freshers.prom'
+    """
+    if event_key is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}_{event_key}{ext}'
+
+
+def open_journal(args: argparse.Namespace, table_name: str) -> SendJournal:
+    """
+    :param args: Command line options, from InputReader.get_args
+    :param table_name: Name of the SQL table of the event
+    :return: Journal the outcomes of the event are recorded in as soon as they are known, so that a run that dies can be
+        resumed
+    """
+    journal_path = args.journal_path or os.path.join(os.path.dirname(__file__), 'send_journal.db')
+    return SendJournal(journal_path, table_name)
+
+
+def make_email_sender(args: argparse.Namespace, engine: str, logger: Logger, project_path: str,
+                      event_details: dict[str], accounts: list[str], total_emails: int, progress_bar_len: int,
+                      executor: ThreadPoolExecutor, journal: SendJournal, metrics: Metrics,
+                      suppression: SuppressionIndex, max_recipients_per_message: int, rate_logger: Logger = None,
+                      share_with: EmailSender = None, draw_progress: Callable[[], None] = None,
+                      render: bool = True) -> EmailSender:
+    """
+    Makes the sender of an event with the sending options of the command line
+    :param args: Command line options, from InputReader.get_args
+    :param engine: 'threaded' or 'async'
+    :param logger: Logger of the event
+    :param project_path: Path of the project directory
+    :param event_details: Dictionary of all necessary details of the event
+    :param accounts: Email accounts where the emails are going to be sent from
+    :param total_emails: Total number of emails to be sent, used in progress bar
+    :param progress_bar_len: Number of characters in the live progress bar
+    :param executor: ThreadPoolExecutor of the threaded engine, unused by the async engine
+    :param journal: Journal the outcome of every email is recorded in, or None
+    :param metrics: Metrics the sending process is recorded in
+    :param suppression: Index the recipients refused permanently are added to, or None
+    :param max_recipients_per_message: Maximum number of emails with the same body sent in one SMTP transaction
+    :param rate_logger: Logger of the rate controllers of the accounts, or None to use the logger of the event
+    :param share_with: Sender of another event whose accounts are used instead of new ones, or None
+    :param draw_progress: Function drawing one progress bar for every event sent together, or None
+    :param render: Whether the sender builds the emails it sends, False to send the emails of a spool as written
+    :return: AsyncEmailSender with the async engine, EmailSender otherwise
+    """
+    # The number of workers or connections is only the ceiling, the rate controller of each account finds the actual
+    # rate and concurrency the SMTP server accepts from it
+    max_concurrency = args.max_connections if engine == 'async' else args.max_workers
+
+    def make_rate_controller() -> RateController:
+        return RateController(logger=rate_logger or logger, initial_rate=args.initial_rate,
+                              max_concurrency=max_concurrency, max_rate=args.max_rate)
+
+    sender_args = dict(
+        logger=logger,
+        project_path=project_path,
+        event_details=event_details,
+        accounts=accounts,
+        total_emails=total_emails,
+        progress_bar_len=progress_bar_len,
+        make_rate_controller=make_rate_controller,
+        max_messages_per_connection=args.max_messages_per_connection,
+        journal=journal,
+        max_attempts=args.max_attempts,
+        metrics=metrics,
+        smtp_host=args.smtp_host,
+        smtp_port=args.smtp_port,
+        smtp_starttls=False if args.no_starttls else None,
+        max_recipients_per_message=max_recipients_per_message,
+        share_with=share_with,
+        draw_progress=draw_progress,
+        suppression=suppression,
+        render=render
+    )
+    if engine == 'async':
+        return AsyncEmailSender(
+            max_in_flight=2 * args.max_connections * len(accounts) * max_recipients_per_message,
+            max_connections=args.max_connections, **sender_args)
+    return EmailSender(executor=executor, max_in_flight=2 * args.max_workers * max_recipients_per_message,
+                       **sender_args)
+
+
+def open_report(args: argparse.Namespace, event_key: str = None) -> DeliveryReport:
+    """
+    :param args: Command line options, from InputReader.get_args
+    :param event_key: Event key identifier of an event of a batch run, or None for a single event run
+    :return: Report the outcome of every email is appended to, overwriting the report of the previous run
+    """
+    return DeliveryReport(event_path(f'delivery_report.{args.report_format}', event_key),
+                          report_format=args.report_format)
+
+
+def write_excel_reports(args: argparse.Namespace, report: DeliveryReport, event_key: str = None) -> None:
+    """
+    Converts the closed delivery report to the Excel files chosen with --excel-report
+    :param args: Command line options, from InputReader.get_args
+    :param report: Delivery report of the event
+    :param event_key: Event key identifier of an event of a batch run, or None for a single event run
+    :return: None
+    """
+    if args.excel_report == 'none':
+        return
+    try:
+        if args.excel_report == 'full':
+            report.write_excel(event_path('delivery_report.xlsx', event_key))
+        else:
+            report.write_legacy_excel(prefix='' if event_key is None else f'{event_key}_')
+    except Exception as e:
+        of_event = '' if event_key is None else f' for {event_key}'
+        raise RuntimeError(f'Error: Excel report writing unsuccessful{of_event}: {e}')
@@ -0,0 +1,83 @@
+from typing import Any
+
+from rate_controller import RateController
+
+
+class SendingAccount:
+    """
+    One of the accounts the emails of an event are sent from, with its own SMTP connections and rate limit, since the
+        SMTP server limits both per account. 'weight' and 'daily_quota' are read from the optional keys of the same
+        name of its email_details yaml file. It can be shared by the senders of several events
+    """
+    def __init__(self, name: str, email_details: dict[str, Any], rate_controller: RateController, sent_today: int = 0):
+        """
+        :param name: Name of the account, as in its email_details_<name>.yaml file
+        :param email_details: Dictionary of the account's address and password, and optionally its weight and quota
+        :param rate_controller: Adaptive rate and concurrency limiter of the account
+        :param sent_today: Number of emails the account sent in the last 24 hours, counted against its daily quota
+        """
+        self.name = name
+        self.address = email_details['email']
+        self.password = email_details['password']
+        self.weight = email_details.get('weight', 1)
+        self.daily_quota = email_details.get('daily_quota')
+        self.remaining_quota = None if self.daily_quota is None else max(self.daily_quota - sent_today, 0)
+        self.rate_controller = rate_controller
+        self.current_weight = 0  # State of the smooth weighted round robin of pick_account
+        self.num_assigned = 0
+        self.pool = None  # SMTP connections of the account, set by the sending engine
+
+    def has_quota(self, num_emails: int = 1) -> bool:
+        """
+        :param num_emails: Number of emails to be assigned
+        :return: Whether the account can be assigned the emails today
+        """
+        return self.remaining_quota is None or self.remaining_quota >= num_emails
+
+    def assign(self, num_emails: int = 1) -> None:
+        """
+        Assigns emails to the account, using up its quota
+        :param num_emails: Number of emails sent together
+        :return: None
+        """
+        if not self.has_quota(num_emails):
+            raise QuotaExceededError(f'Account {self.address} has reached its daily quota')
+        self.num_assigned += num_emails
+        if self.remaining_quota is not None:
+            self.remaining_quota -= num_emails
+
+
+class QuotaExceededError(Exception):
+    """
+    Raised for an email that can't be assigned to an account because it has reached its daily quota, or to any account
+        because they all have
+    """
+
+
+def pick_account(accounts: list[SendingAccount], num_emails: int = 1, use_quota: bool = True) -> SendingAccount:
+    """
+    Assigns emails sent together to an account by smooth weighted round robin over the accounts with enough quota left:
+        over any run of emails, each account gets a share proportional to its weight, and the accounts are interleaved
+        rather than taking turns in blocks. The round robin is weighted by the number of emails, so that the shares are
+        in emails rather than in SMTP transactions
+    :param accounts: Accounts of the event
+    :param num_emails: Number of emails sent together
+    :param use_quota: Whether the quotas are checked and used up, False when the emails are only spooled and the quotas
+        are checked once they are drained
+    :return: The account the emails are sent from, its quota is used up by the emails
+    """
+    available = [account for account in accounts if not use_quota or account.has_quota(num_emails)]
+    if not available:
+        raise QuotaExceededError('Every account has reached its daily quota')
+
+    total_weight = sum(account.weight for account in available)
+    for account in available:
+        account.current_weight += account.weight * num_emails
+    account = max(available, key=lambda account: account.current_weight)
+    account.current_weight -= total_weight * num_emails
+
+    if use_quota:
+        account.assign(num_emails)
+    else:
+        account.num_assigned += num_emails
+    return account
@@ -0,0 +1,188 @@
+from collections import deque
+from itertools import count
+from logging import Logger
+import smtplib
+import threading
+from time import time
+from typing import Any, Callable
+
+MAX_IDLE_TIME = 30  # Seconds a connection can be unused before it's checked with a NOOP, servers drop idle ones
+
+
+class PoolStats:
+    """
+    Thread safe counters of the SMTP connections of a run
+    """
+    def __init__(self):
+        self.created = 0  # Connections opened and logged in
+        self.recycled = 0  # Healthy connections closed after reaching the maximum number of messages
+        self.failed = 0  # Connections found dead or broken, and replaced
+        self.live = 0  # Connections currently open
+        self.lock = threading.Lock()
+
+    def on_created(self) -> int:
+        """
+        :return: Number of live connections, including the new one
+        """
+        with self.lock:
+            self.created += 1
+            self.live += 1
+            return self.live
+
+    def on_closed(self, recycled: bool = False, failed: bool = False) -> int:
+        """
+        :param recycled: Whether the connection was closed because it reached the maximum number of messages
+        :param failed: Whether the connection was closed because it was found dead or broken
+        :return: Number of remaining live connections
+        """
+        with self.lock:
+            self.recycled += recycled
+            self.failed += failed
+            self.live -= 1
+            return self.live
+
+    def __str__(self):
+        return f'created: {self.created}, recycled: {self.recycled}, failed: {self.failed}'
+
+
+class PooledSMTP:
+    """
+    An SMTP connection with the information the pool needs to health check and recycle it
+    """
+    ids = count(1)
+
+    def __init__(self, smtp: Any):
+        """
+        :param smtp: Logged in connection, smtplib.SMTP or AsyncSMTP
+        """
+        self.smtp = smtp
+        self.conn_id = next(PooledSMTP.ids)
+        self.last_used = time()
+        self.num_messages = 0
+
+
+class SMTPPool:
+    """
+    Pool of SMTP connections that any worker thread can check out and return. Instead of a NOOP before every message,
+        a connection is only checked when it has been idle for longer than 'max_idle_time', and it's recycled after
+        'max_messages' messages
+    """
+    def __init__(self, logger: Logger, connect: Callable[[], smtplib.SMTP], max_messages: int,
+                 max_idle_time: float = MAX_IDLE_TIME, stats: PoolStats = None):
+        """
+        :param logger: Reuse the same configured logger
+        :param connect: Function opening and logging in a new connection
+        :param max_messages: Number of messages sent over a connection before it's replaced by a new one
+        :param max_idle_time: Seconds a connection can be unused before it's checked with a NOOP when checked out
+        :param stats: Counters shared with other pools, or None for counters of this pool only
+        """
+        self.logger = logger
+        self.connect = connect
+        self.max_messages = max_messages
+        self.max_idle_time = max_idle_time
+        self.stats = stats if stats is not None else PoolStats()
+        self.idle = deque()  # Most recently used connections are on the right
+        self.checked_out = set()
+        self.closed = False  # Once set, connections checked in are closed instead of kept idle
+        self.lock = threading.Lock()
+
+    def checkout(self) -> PooledSMTP:
+        """
+        Takes the most recently used idle connection, checking it with a NOOP if it has been idle for too long, or opens
+            a new one if there is no usable idle connection
+        :return: Connection owned by the caller until it's checked in or discarded
+        """
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+                if conn is not None:
+                    self.checked_out.add(conn)
+            if conn is None:
+                break
+            if time() - conn.last_used <= self.max_idle_time:
+                return conn
+            try:
+                if conn.smtp.noop()[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, OSError):  # Closed by the server, or a half-dead socket
+                pass
+            self.discard(conn, failed=True)
+
+        conn = PooledSMTP(self.connect())
+        with self.lock:
+            self.checked_out.add(conn)
+        live = self.stats.on_created()
+        self.logger.info(f'SMTP connection with id {conn.conn_id} started, number of live connections: {live}',
+                         extra={'smtp_id': conn.conn_id})
+        return conn
+
+    def checkin(self, conn: PooledSMTP, sent: bool = True) -> None:
+        """
+        Returns a usable connection to the pool, or recycles it if it has sent its maximum number of messages
+        :param conn: Connection owned by the caller
+        :param sent: Whether a message was sent while it was checked out
+        :return: None
+        """
+        conn.last_used = time()
+        conn.num_messages += sent
+        if conn.num_messages >= self.max_messages:
+            self.close(conn, recycled=True)
+            return
+
+        with self.lock:
+            closed = self.closed
+            if not closed:
+                self.checked_out.discard(conn)
+                self.idle.append(conn)
+        if closed:
+            self.close(conn)
+
+    def discard(self, conn: PooledSMTP, failed: bool = True) -> None:
+        """
+        Closes a broken connection instead of returning it to the pool
+        :param conn: Connection owned by the caller
+        :param failed: Whether to count the connection as failed
+        :return: None
+        """
+        try:
+            conn.smtp.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.checked_out.discard(conn)
+        live = self.stats.on_closed(failed=failed)
+        self.logger.info(f'Disconnected SMTP connection with id {conn.conn_id} stopped, remaining: {live}',
+                         extra={'smtp_id': conn.conn_id})
+
+    def close(self, conn: PooledSMTP, recycled: bool = False) -> None:
+        """
+        Quits a healthy connection
+        :param conn: Connection owned by the caller or idle
+        :param recycled: Whether the connection is closed because it reached the maximum number of messages
+        :return: None
+        """
+        with self.lock:
+            self.checked_out.discard(conn)
+        try:
+            conn.smtp.quit()
+            live = self.stats.on_closed(recycled=recycled)
+            self.logger.info(f'SMTP connection with id {conn.conn_id} stopped, remaining: {live}',
+                             extra={'smtp_id': conn.conn_id})
+        except (smtplib.SMTPServerDisconnected, OSError):
+            conn.smtp.close()
+            live = self.stats.on_closed(failed=True)
+            self.logger.error(f"SMTP server connection with id {conn.conn_id} doesn't exist when trying to stop the "
+                              f"connection, remaining: {live}", extra={'smtp_id': conn.conn_id})
+
+    def close_all(self) -> None:
+        """
+        Quits every idle connection of the pool. Connections still checked out are used by another thread, they are
+            quit when they are checked in, or closed when they are discarded
+        :return: None
+        """
+        with self.lock:
+            self.closed = True
+            conns = list(self.idle)
+            self.idle.clear()
+        for conn in conns:
+            self.close(conn)
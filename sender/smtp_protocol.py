@@ -0,0 +1,96 @@
+import re
+import smtplib
+from typing import Iterator
+
+Reply = tuple[int, bytes]  # Reply code and message of the server
+DATA_CHUNK_SIZE = 64 * 1024  # Bytes of an attachment written to the socket at once
+
+# How far the transaction of a message got, kept in 'stage' by both SMTP clients, to know what a lost connection means
+STAGE_MAIL = 'mail'  # MAIL FROM not accepted yet, nothing of the message has reached the server
+STAGE_ENVELOPE = 'envelope'  # MAIL FROM accepted, the message isn't complete, so the server can't have accepted it
+STAGE_SENT = 'sent'  # The whole message was written, the server may have accepted it before the connection was lost
+
+
+class DeliveryUnknownError(smtplib.SMTPException):
+    """
+    The connection was lost after the whole message was written and before the server replied, so the server may have
+        accepted it. It's a permanent failure, so that the recipients don't get the message twice
+    """
+
+
+def encode_data(msg: str | bytes) -> bytes:
+    """
+    Prepares a message for the DATA command the same way smtplib does: CRLF line endings, leading dots doubled and
+        the terminating '.' line appended
+    :param msg: The message, either a string of ASCII characters or bytes
+    :return: Bytes to be written after the server accepts DATA
+    """
+    if isinstance(msg, str):
+        msg = msg.encode('ascii')
+    data = re.sub(br'(?:\r\n|\n|\r(?!\n))', b'\r\n', msg)
+    data = re.sub(br'(?m)^\.', b'..', data)
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+def iter_data(msg: str | bytes | list[bytes | memoryview], terminate: bool = True) -> Iterator[bytes | memoryview]:
+    """
+    Prepares a message for the DATA command in chunks, so that it's written to the socket without being copied whole.
+        A message in segments, from MessageTemplate.assemble, is already in CRLF and ends with a line ending, and only
+        its bytes segments can have leading dots. Its memoryview segments are already prepared, such as the base64
+        lines of an attachment or a message read back from a spool, and are written as they are
+    :param msg: The message, either a string of ASCII characters, bytes, or segments that each start a line
+    :param terminate: Whether the '.' line terminating the message is the last chunk
+    :return: Generator of the chunks to be written after the server accepts DATA
+    """
+    if isinstance(msg, (str, bytes)):
+        data = encode_data(msg)
+        yield data if terminate else data[:-3]
+        return
+
+    for segment in msg:
+        if isinstance(segment, memoryview):
+            for start in range(0, len(segment), DATA_CHUNK_SIZE):
+                yield segment[start:start + DATA_CHUNK_SIZE]
+        else:
+            yield re.sub(br'(?m)^\.', b'..', segment)
+    if terminate:
+        yield b'.\r\n'
+
+
+def encode_envelope(from_addr: str, to_addrs: list[str]) -> bytes:
+    """
+    Prepares the MAIL FROM, RCPT TO and DATA commands of a message to be written at once, for a server that advertises
+        the PIPELINING extension (RFC 2920), so that the whole envelope costs one round trip instead of one per command
+    :param from_addr: Envelope sender
+    :param to_addrs: Envelope recipients
+    :return: Bytes of the commands, to be followed by reading one reply per command, in order
+    """
+    lines = [f'MAIL FROM:<{from_addr}>'] + [f'RCPT TO:<{to_addr}>' for to_addr in to_addrs] + ['DATA']
+    return ''.join(line + '\r\n' for line in lines).encode('ascii')
+
+
+def check_envelope(from_addr: str, to_addrs: list[str],
+                   replies: list[Reply]) -> tuple[smtplib.SMTPException | None, dict[str, Reply]]:
+    """
+    Checks the replies to the pipelined envelope of a message, with the same outcomes smtplib.SMTP.sendmail has when it
+        sends the commands one at a time
+    :param from_addr: Envelope sender
+    :param to_addrs: Envelope recipients
+    :param replies: Replies to MAIL FROM, to every RCPT TO and to DATA, in order
+    :return: The exception the message fails with, or None if the server is waiting for the message, and the reply to
+        every recipient the server refused
+    """
+    code, resp = replies[0]
+    if code != 250:
+        return smtplib.SMTPSenderRefused(code, resp, from_addr), {}
+
+    refused = {to_addr: reply for to_addr, reply in zip(to_addrs, replies[1:-1]) if reply[0] not in (250, 251)}
+    if len(refused) == len(to_addrs):
+        return smtplib.SMTPRecipientsRefused(refused), refused
+
+    code, resp = replies[-1]
+    if code != 354:
+        return smtplib.SMTPDataError(code, resp), refused
+    return None, refused
@@ -0,0 +1,177 @@
+import json
+import mmap
+import os
+from time import time
+from typing import Any, Collection, Iterator
+
+from email_content import EmailContent
+from message_template import Message
+from smtp_protocol import iter_data
+
+MESSAGES_FILE = 'messages.eml'  # Every email as written after DATA, dot-stuffed, one after the other
+INDEX_FILE = 'index.jsonl'  # One line per email: offset and length in the messages file, account and recipients
+METADATA_FILE = 'spool.json'  # Event details, accounts and sending options the emails were rendered with
+
+
+class SpoolWriter:
+    """
+    Append-only spool of fully rendered emails, so that an event can be rendered ahead of time, inspected, and sent
+        later with --drain without any templating or MIME work. The spool is a directory with the emails one after the
+        other in one file, an index of their offsets with their account and recipients, and the metadata of the event.
+        The metadata is only written once every email has been appended, so an incomplete spool can't be drained
+    """
+    def __init__(self, path: str, metadata: dict[str, Any]):
+        """
+        :param path: Directory of the spool, created, it must not already contain a spool
+        :param metadata: Event details, accounts and sending options, read back by SpoolReader
+        """
+        os.makedirs(path, exist_ok=True)
+        if any(os.path.exists(os.path.join(path, file)) for file in (MESSAGES_FILE, INDEX_FILE, METADATA_FILE)):
+            raise FileExistsError(f'Error: {path} already contains a spool')
+
+        self.path = path
+        self.metadata = metadata
+        self.messages = open(os.path.join(path, MESSAGES_FILE), 'wb')
+        self.index = open(os.path.join(path, INDEX_FILE), 'w', encoding='utf-8')
+        self.offset = 0
+        self.num_messages = 0
+        self.num_emails = 0
+
+    def __enter__(self):
+        return self
+
+    def append(self, message: bytes | Message, account: str, email_contents: list[EmailContent]) -> None:
+        """
+        :param message: The full email as sent on the wire, as bytes or in segments. It's written as it's sent after
+            DATA, so that it's sent from the spool without being processed again
+        :param account: Name of the account the email is sent from
+        :param email_contents: EmailContent objects of the recipients of the email
+        :return: None
+        """
+        length = 0
+        for chunk in iter_data(message, terminate=False):
+            self.messages.write(chunk)
+            length += len(chunk)
+        recipients = [[email_content.row_id, email_content.email] for email_content in email_contents]
+        self.index.write(json.dumps({'offset': self.offset, 'length': length, 'account': account,
+                                     'recipients': recipients}) + '\n')
+        self.offset += length
+        self.num_messages += 1
+        self.num_emails += len(email_contents)
+
+    def close(self) -> None:
+        """
+        Closes the files and writes the metadata, which completes the spool
+        :return: None
+        """
+        self.messages.close()
+        self.index.close()
+        metadata = self.metadata | {'num_messages': self.num_messages, 'num_emails': self.num_emails,
+                                    'created_at': time()}
+        with open(os.path.join(self.path, METADATA_FILE), 'w', encoding='utf-8') as file:
+            json.dump(metadata, file, indent=2, default=str)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:  # Left without metadata, so that the incomplete spool isn't drained
+            self.messages.close()
+            self.index.close()
+
+
+class SpoolReader:
+    """
+    Reads a spool written by SpoolWriter in place of the database: provides 'length', count_remaining, iter_batches,
+        filters_rows and stop like Database, and render turns a batch of index entries into EmailContent objects
+        carrying the emails as written. The messages file is memory mapped and the emails are views of it, written to
+        the SMTP socket in chunks without being copied
+    """
+    def __init__(self, path: str):
+        """
+        :param path: Directory of the spool
+        """
+        self.path = path
+        self.metadata = SpoolReader.read_metadata(path)
+        self.length = self.metadata['num_emails']
+
+        self.file = open(os.path.join(path, MESSAGES_FILE), 'rb')
+        self.messages = None  # An empty file can't be mapped, but then the index is empty too
+        self.view = memoryview(b'')
+        if self.metadata['num_messages']:
+            self.messages = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.messages)
+
+    @staticmethod
+    def read_metadata(path: str) -> dict[str, Any]:
+        """
+        :param path: Directory of the spool
+        :return: Event details, accounts and sending options the emails were rendered with
+        """
+        try:
+            with open(os.path.join(path, METADATA_FILE), encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            raise FileNotFoundError(f'Error: No complete spool found in {path}')
+
+    def iter_batches(self, batch_size: int) -> Iterator[list[dict[str, Any]]]:
+        """
+        :param batch_size: Minimum number of emails per batch, the recipients of one email are never split
+        :return: Generator of the batches of index entries, in the order the emails were rendered
+        """
+        batch, num_emails = [], 0
+        with open(os.path.join(self.path, INDEX_FILE), encoding='utf-8') as file:
+            for line in file:
+                entry = json.loads(line)
+                batch.append(entry)
+                num_emails += len(entry['recipients'])
+                if num_emails >= batch_size:
+                    yield batch
+                    batch, num_emails = [], 0
+        if batch:
+            yield batch
+
+    def count_remaining(self, skip_row_ids: Collection[int]) -> int:
+        """
+        :param skip_row_ids: ids of the rows whose email must not be sent again, such as those already delivered
+        :return: Number of emails of the spool to be sent without those rows. The journal of the event may hold rows
+            that aren't in the spool, so only the recipients of the spool are counted
+        """
+        if not skip_row_ids:
+            return self.length
+        return sum(row_id not in skip_row_ids for batch in self.iter_batches(self.length)
+                   for entry in batch for row_id, _ in entry['recipients'])
+
+    def render(self, entries: list[dict[str, Any]]) -> list[EmailContent]:
+        """
+        :param entries: Batch of index entries
+        :return: EmailContent object of every recipient, those of the same email share its view
+        """
+        email_contents = []
+        for entry in entries:
+            message = [self.view[entry['offset']:entry['offset'] + entry['length']]]
+            for row_id, email in entry['recipients']:
+                email_content = EmailContent(email=email, row_id=row_id)
+                email_content.message = message
+                email_content.spool_account = entry['account']
+                email_contents.append(email_content)
+        return email_contents
+
+    def filters_rows(self) -> bool:
+        """
+        :return: False, the emails of addresses suppressed since the spool was written are skipped by the Pipeline
+        """
+        return False
+
+    def stop(self) -> None:
+        """
+        Unmaps and closes the messages file. If emails that weren't sent still hold views of it, such as when sending
+            failed, it's unmapped once they are freed instead
+        :return: None
+        """
+        try:
+            self.view.release()
+            if self.messages is not None:
+                self.messages.close()
+        except BufferError:
+            pass
+        self.file.close()
@@ -0,0 +1,131 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+
+# Attributes given in 'extra' by the sender, written as their own fields by JsonFormatter
+FIELDS = ('recipient', 'smtp_id', 'latency', 'outcome', 'attempts', 'account')
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line, with the structured fields of the record as their own keys
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        :param record: Record to format
+        :return: The JSON line, without the line ending
+        """
+        line = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                'level': record.levelname, 'event': record.event, 'message': record.getMessage()}
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                line[field] = round(value, 4) if isinstance(value, float) else value
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line)
+
+
+class EventName(logging.Filter):
+    """
+    Sets the name of the event a record is about, as its 'event' attribute, unless a filter of the logger it was logged
+        with already did. Added to the handler with the name of the run, and to the logger of each event of a batch run
+    """
+    def __init__(self, event_name: str):
+        """
+        :param event_name: Name of the event
+        """
+        super().__init__()
+        self.event_name = event_name
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'event'):
+            record.event = self.event_name
+        return True
+
+
+class SuccessSampler(logging.Filter):
+    """
+    Keeps only a fraction of the lines of emails sent successfully, chosen at random, and every other line, so that the
+        log of a large run stays small but still has every failure
+    """
+    def __init__(self, rate: float):
+        """
+        :param rate: Fraction of the lines with outcome 'sent' that are kept, from 0 to 1
+        """
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return getattr(record, 'outcome', None) != 'sent' or random.random() < self.rate
+
+
+class LogWriter(logging.handlers.QueueListener):
+    """
+    Background thread writing the queued records, which also sets the events queued by BackgroundHandler.flush once
+        every record before them is written
+    """
+    def handle(self, record: logging.LogRecord | threading.Event) -> None:
+        if isinstance(record, threading.Event):
+            record.set()
+            return
+        super().handle(record)
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """
+    Handler that only puts the records on a queue, so that the threads logging never wait on the log file. A background
+        thread formats and writes them with the target handler. Records are queued as they are: the lines of the sender
+        are either already formatted or only have immutable arguments
+    """
+    def __init__(self, target: logging.Handler):
+        """
+        :param target: Handler the records are written with, by the background thread
+        """
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self.writer = LogWriter(self.queue, target, respect_handler_level=True)
+        self.writer.start()
+        self.running = True
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def flush(self) -> None:
+        """
+        Blocks until every record queued so far is written, and keeps the background thread running for the next ones
+        :return: None
+        """
+        if not self.running:
+            return
+        written = threading.Event()
+        self.queue.put(written)
+        written.wait()
+        self.target.flush()
+
+    def close(self) -> None:
+        """
+        Writes every queued record and stops the background thread, called by logging at exit
+        :return: None
+        """
+        if self.running:
+            self.running = False
+            self.writer.stop()
+        self.target.close()
+        super().close()
+
+
+def flush_logs(logger: logging.Logger) -> None:
+    """
+    Writes every record logged so far by the handlers the logger's records reach
+    :param logger: Logger of the sender
+    :return: None
+    """
+    while logger is not None:
+        for handler in logger.handlers:
+            handler.flush()
+        logger = logger.parent if logger.propagate else None
@@ -0,0 +1,117 @@
+import os
+import smtplib
+import sqlite3
+import threading
+from time import time
+from typing import Iterable
+
+from rate_controller import get_smtp_code
+
+BOUNCE_CODES = {550, 551, 552, 553}  # Replies to RCPT TO refusing the recipient permanently, such as an unknown mailbox
+
+
+def normalise_address(email: str) -> str:
+    """
+    :param email: Email address as written in a table or a file
+    :return: The address as it's compared against the suppression index and the other rows: stripped and lower case,
+        the same as lower(trim(email)) in the queries of Database
+    """
+    return email.strip().lower()
+
+
+def is_bounce(e: Exception) -> bool:
+    """
+    :param e: Exception the last attempt to send an email failed with
+    :return: Whether the server refused the recipient permanently, such as a mailbox that doesn't exist. Other permanent
+        failures, such as a rejected message or a policy reply to RCPT TO, say nothing about the address
+    """
+    return isinstance(e, smtplib.SMTPRecipientsRefused) and get_smtp_code(e) in BOUNCE_CODES
+
+
+class SuppressionIndex:
+    """
+    Persistent index of the addresses that must not be emailed again by any event: recipients refused permanently by
+        the server, recorded as soon as they bounce, and addresses imported from opt-out lists and the reports of
+        previous runs. Backed by SQLite in WAL mode like the send journal, so that concurrent runs share it
+    """
+    def __init__(self, path: str):
+        """
+        :param path: Path of the SQLite database file, created if it doesn't exist
+        """
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)  # Autocommit every record
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS suppressions (
+            email TEXT PRIMARY KEY,
+            reason TEXT NOT NULL,
+            source TEXT,
+            added_at REAL NOT NULL
+        );''')
+
+    def add(self, emails: Iterable[str], reason: str, source: str = None) -> int:
+        """
+        Adds addresses to the index, an address already in it keeps its first reason
+        :param emails: Addresses to suppress
+        :param reason: Why they are suppressed: 'bounce' or 'opt-out'
+        :param source: Event or file the addresses come from, or None
+        :return: Number of addresses that weren't already in the index
+        """
+        rows = [(normalise_address(email), reason, source, time()) for email in emails if email and email.strip()]
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.execute('BEGIN;')
+            self.conn.executemany('INSERT OR IGNORE INTO suppressions (email, reason, source, added_at) '
+                                  'VALUES (?, ?, ?, ?);', rows)
+            self.conn.execute('COMMIT;')
+            return self.conn.total_changes - before
+
+    def import_file(self, path: str) -> int:
+        """
+        Adds the addresses of a file to the index. A text file is an opt-out list with one address per line, lines
+            starting with '#' are ignored. A delivery report, in csv, jsonl or Excel, adds the recipients the server
+            refused permanently, as is_bounce. Other files, such as the failed_emails.xlsx of the legacy report, don't
+            tell why an email failed, so they are refused
+        :param path: Path of the file
+        :return: Number of addresses that weren't already in the index
+        """
+        source = os.path.basename(path)
+        if path.endswith('.txt'):
+            with open(path, encoding='utf-8') as file:
+                emails = [line for line in file if line.strip() and not line.lstrip().startswith('#')]
+            return self.add(emails, 'opt-out', source)
+
+        import pandas as pd  # Only imported when a report is imported, importing it is slow
+
+        if path.endswith('.csv'):
+            report = pd.read_csv(path)
+        elif path.endswith('.jsonl'):
+            report = pd.read_json(path, lines=True)
+        elif path.endswith('.xlsx'):
+            report = pd.read_excel(path)
+        else:
+            raise ValueError(f'Error: Can not import suppressions from {path}, expected a .txt, .csv, .jsonl or '
+                             f'.xlsx file')
+
+        if not {'email', 'status', 'smtp_code', 'phase'} <= set(report.columns):
+            raise ValueError(f'Error: {path} is not a delivery report with the phase of every failure, only the '
+                             f'opt-out lists and the delivery reports of this version can be imported')
+        bounced = report[(report['status'] == 'failed') & (report['phase'] == 'rcpt')
+                         & report['smtp_code'].isin(BOUNCE_CODES)]
+        return self.add(bounced['email'].dropna().astype(str), 'bounce', source)
+
+    def addresses(self) -> set[str]:
+        """
+        :return: Every suppressed address, normalised
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT email FROM suppressions;').fetchall()
+        return {row[0] for row in rows}
+
+    def close(self) -> None:
+        """
+        Close the index
+        :return: None
+        """
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,59 @@
+from functools import partial
+import logging
+import os
+import sys
+from typing import Callable
+
+import pytest
+import yaml
+
+# The modules of the sender import each other by their flat names, as when main.py is run from the sender directory
+SENDER_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SENDER_PATH)
+
+PNG = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                    '1f15c4890000000d4944415478da63f8ffff3f0005fe02fea7d6a4a60000000049454e44ae426082')
+
+
+@pytest.fixture
+def logger() -> logging.Logger:
+    return logging.getLogger('tests')
+
+
+@pytest.fixture
+def project_path(tmp_path) -> str:
+    """
+    :return: Project directory with two accounts, 'first' and 'second', and an image and a PDF in its attachments folder
+    """
+    os.makedirs(tmp_path / 'email_details')
+    for name in ('first', 'second'):
+        with open(tmp_path / 'email_details' / f'email_details_{name}.yaml', 'w') as file:
+            yaml.safe_dump({'email': f'{name}@example.com', 'password': name}, file)
+
+    os.makedirs(tmp_path / 'attachments')
+    (tmp_path / 'attachments' / 'logo.png').write_bytes(PNG)
+    (tmp_path / 'attachments' / 'schedule.pdf').write_bytes(b'%PDF-1.4\n' + bytes(range(256)) * 40)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def run_main(tmp_path, monkeypatch) -> Callable[..., None]:
+    """
+    :return: Function running main.py end to end in tmp_path, as the benchmark does, with the benchmark event of a
+        project made by benchmark.run, a synthetic row source and the fake SMTP server on the given port. The journal,
+        suppression index and delivery report of the runs are kept in tmp_path
+    """
+    from benchmark.row_source import SyntheticDatabase
+    from benchmark.run import make_project
+    import main
+
+    make_project(str(tmp_path / 'project'))
+    monkeypatch.chdir(tmp_path)
+
+    def run(argv: list[str], smtp_port: int, rows: int = 50) -> None:
+        main.main(argv + ['--project-path', str(tmp_path / 'project'), '--event', 'benchmark', '--accounts',
+                          'benchmark', '--yes', '--journal-path', 'send_journal.db', '--suppression-path',
+                          'suppression.db', '--smtp-host', '127.0.0.1', '--smtp-port', str(smtp_port),
+                          '--no-starttls', '--initial-rate', '1000', '--max-rate', '1000'],
+                  database_factory=partial(SyntheticDatabase, num_rows=rows))
+    return run
@@ -0,0 +1,37 @@
+from datetime import date
+
+import pytest
+
+from body_template import BodyTemplate, compile_body
+
+NAMES = ['first_name', 'email', 'amount', 'day']
+ROW = ('Alice', 'alice@example.com', 12.5, date(2024, 10, 1))
+
+
+@pytest.mark.parametrize('body', [
+    '<p>Dear {first_name},</p>',
+    '{first_name}{email}',
+    '<p>No placeholders</p>',
+    '',
+    '{{literal braces}} around {first_name} and {{{email}}}',
+    '{amount:.2f} {amount:>8} {first_name!r} {first_name!s:^10}',
+    '{day.year}-{day.month:02d} {first_name[0]}',
+    '{first_name} and {first_name} again',
+])
+def test_renders_as_str_format(body):
+    template = BodyTemplate(body, NAMES)
+
+    assert template.render(ROW) == body.format(**dict(zip(NAMES, ROW)))
+
+
+def test_lists_the_placeholders():
+    assert BodyTemplate('{first_name} {day.year} {first_name}', NAMES).placeholders == {'first_name', 'day'}
+
+
+def test_refuses_a_placeholder_that_is_not_a_column():
+    with pytest.raises(ValueError, match='last_name'):
+        BodyTemplate('Dear {first_name} {last_name}', NAMES)
+
+
+def test_compiles_a_body_only_once():
+    assert compile_body('Dear {first_name}', tuple(NAMES)) is compile_body('Dear {first_name}', tuple(NAMES))
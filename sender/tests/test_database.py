@@ -0,0 +1,179 @@
+from typing import Any, Callable
+
+import pytest
+
+from database import Database
+
+
+class FakeCursor:
+    """
+    Cursor recording the queries run through it in its connection, and answering them with what the connection gives
+    """
+    def __init__(self, connection: 'FakeConnection', name: str = None):
+        self.connection = connection
+        self.name = name
+        self.itersize = None
+        self.rows = []
+
+    def execute(self, query: str | bytes, params: tuple[Any, ...] = None) -> None:
+        query = query.decode() if isinstance(query, bytes) else query
+        self.connection.queries.append((query, params))
+        self.rows = self.connection.answer(query, params)
+
+    def mogrify(self, template: bytes, args: tuple[Any, ...]) -> bytes:
+        return template % tuple(f"'{arg}'".encode() for arg in args)
+
+    def fetchall(self) -> list[tuple[Any, ...]]:
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self) -> None:
+        pass
+
+
+class FakeConnection:
+    encoding = 'UTF8'
+
+    def __init__(self, answer: Callable[[str, tuple[Any, ...]], list[tuple[Any, ...]]]):
+        self.answer = answer
+        self.queries = []
+
+    def cursor(self, name: str = None) -> FakeCursor:
+        return FakeCursor(self, name)
+
+
+@pytest.fixture
+def make_database(logger) -> Callable[..., tuple[Database, FakeConnection]]:
+    """
+    :return: Function making a Database of the table 'guests' on a fake connection, whose counts are 'counts' and
+        which answers the other queries with no rows
+    """
+    def make(counts: tuple[int, ...] = (10, 10), cols: list[str] = None, grouping_requirement: str = None,
+             **kwargs) -> tuple[Database, FakeConnection]:
+        conn = FakeConnection(lambda query, params: [counts] if query.startswith('SELECT COUNT') else [])
+        db = Database(logger, ['email', 'name'] if cols is None else cols, '', 'guests', grouping_requirement,
+                      conn=conn, **kwargs)
+        return db, conn
+    return make
+
+
+def test_copies_the_suppressed_addresses_into_a_temporary_table(make_database):
+    db, conn = make_database(suppressed={'alice@example.com', 'bob@example.com'})
+
+    queries = [query for query, _ in conn.queries]
+    assert queries[0] == 'CREATE TEMPORARY TABLE IF NOT EXISTS suppressed_emails (email TEXT PRIMARY KEY);'
+    assert queries[1].startswith('INSERT INTO suppressed_emails (email) VALUES (')
+    assert queries[1].endswith(') ON CONFLICT DO NOTHING;')
+    assert "('alice@example.com')" in queries[1] and "('bob@example.com')" in queries[1]
+    assert queries[2] == 'ANALYZE suppressed_emails;'
+
+
+@pytest.mark.parametrize('cols, suppressed', [(['email', 'name'], None), (['email', 'name'], set()),
+                                              (['name'], {'alice@example.com'})])
+def test_leaves_the_table_as_it_is_without_addresses_to_leave_out(make_database, cols, suppressed):
+    db, conn = make_database(cols=cols, suppressed=suppressed, dedup=cols == ['name'])
+
+    assert db.filter_conditions() == {}
+    assert db.row_filter() == 'TRUE'
+    assert conn.queries == [('SELECT COUNT(*), COUNT(*) FILTER (WHERE TRUE) FROM guests AS r', None)]
+
+
+def test_counts_the_rows_left_out_by_each_filter(make_database, caplog):
+    caplog.set_level('INFO', logger='tests')
+    db, conn = make_database(counts=(10, 6, 2, 3), suppressed={'alice@example.com'}, dedup=True)
+
+    assert db.length == 6
+    (query, params), = conn.queries[3:]
+    assert params is None
+    assert query.startswith('SELECT COUNT(*), COUNT(*) FILTER (WHERE NOT EXISTS (SELECT 1 FROM suppressed_emails s '
+                            'WHERE s.email = lower(trim(r.email))) AND r.first_of_address), ')
+    assert 'COUNT(*) FILTER (WHERE NOT r.first_of_address)' in query
+    # The first row of each address is marked once over the whole table, not looked for again for every row
+    assert query.endswith(' FROM (SELECT *, row_number() OVER (PARTITION BY lower(trim(email)) ORDER BY id) = 1 '
+                          'AS first_of_address FROM guests) AS r')
+    assert query.count('guests') == 1
+    assert 'Leaving out 2 rows of guests with suppressed addresses' in caplog.text
+    assert 'Leaving out 3 rows of guests with duplicate addresses' in caplog.text
+    assert 'Leaving out 4 of the 10 rows of guests in total' in caplog.text
+
+
+def test_counts_the_emails_left_without_the_rows_skipped(make_database):
+    db, conn = make_database(counts=(10, 8, 2), dedup=True)
+    conn.answer = lambda query, params: [(2,)]
+
+    assert db.count_remaining(set()) == 8
+    assert len(conn.queries) == 1
+    assert db.count_remaining({3, 5, 12}) == 6
+    query, params = conn.queries[-1]
+    assert query == f'SELECT COUNT(*) FROM {db.source()} AS r WHERE id = ANY(%s) AND r.first_of_address'
+    assert sorted(params[0]) == [3, 5, 12]
+
+
+def test_reads_only_the_rows_left_without_a_grouping_requirement(make_database):
+    db, conn = make_database(suppressed={'alice@example.com'}, dedup=True)
+
+    assert db.read_filter() == db.row_filter() != 'TRUE'
+    assert db.filters_rows()
+    list(db.iter_rows())
+    query, params = conn.queries[-1]
+    assert query == f'SELECT email,name,id FROM {db.source()} AS r WHERE {db.row_filter()} ORDER BY id;'
+
+
+def test_hands_the_filtering_to_the_pipeline_with_a_grouping_requirement(make_database):
+    db, conn = make_database(grouping_requirement='family', suppressed={'alice@example.com'}, dedup=True)
+
+    # The other members of a group are emailed with the rows of the whole group, so every row is read
+    assert db.row_filter() != 'TRUE'
+    assert db.read_filter() == 'TRUE'
+    assert not db.filters_rows()
+    list(db.iter_rows(cols=['family', 'email', 'name', 'id']))
+    query, params = conn.queries[-1]
+    assert query == 'SELECT family,email,name,id FROM guests AS r WHERE TRUE ORDER BY family, id;'
+
+
+def test_filters_rows_when_there_is_nothing_to_leave_out(make_database):
+    db, conn = make_database(grouping_requirement='family')
+
+    assert db.read_filter() == 'TRUE'
+    assert db.filters_rows()
+
+
+def stub_rows(db: Database, rows: list[tuple[Any, ...]]) -> list[list[str] | None]:
+    """
+    :return: Columns iter_batches asks iter_rows for, once it has been called
+    """
+    requested = []
+
+    def iter_rows(itersize: int = None, cols: list[str] = None):
+        requested.append(cols)
+        yield from rows
+
+    db.iter_rows = iter_rows
+    return requested
+
+
+def test_cuts_batches_of_exactly_the_batch_size_without_a_grouping_requirement(make_database):
+    db, _ = make_database()
+    stub_rows(db, [(f'guest{i}@example.com', f'Guest {i}', i) for i in range(7)])
+
+    batches = list(db.iter_batches(batch_size=3))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [row[2] for batch in batches for row in batch] == list(range(7))
+
+
+def test_never_splits_a_group_between_batches(make_database):
+    db, _ = make_database(grouping_requirement='family')
+    families = ['a', 'a', 'a', 'b', 'c', 'c', 'd', 'd', 'd', 'd', 'e']
+    rows = [(family, f'guest{i}@example.com', f'Guest {i}', i) for i, family in enumerate(families)]
+    requested = stub_rows(db, rows)
+
+    batches = list(db.iter_batches(batch_size=2))
+    assert requested == [['family', 'email', 'name', 'id']]
+    # The group column is stripped, leaving the columns of the event followed by the id
+    assert [row for batch in batches for row in batch] == [row[1:] for row in rows]
+    batch_families = [{families[row[2]] for row in batch} for batch in batches]
+    assert batch_families == [{'a'}, {'b', 'c'}, {'d'}, {'e'}]
+    assert all(len(batch) >= 2 for batch in batches[:-1])
+    assert len(batches[-1]) == 1
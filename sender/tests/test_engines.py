@@ -0,0 +1,161 @@
+import csv
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+from typing import Callable
+
+import pytest
+
+from async_email_sender import AsyncEmailSender
+from benchmark.fake_smtp import FakeSMTPServer
+from delivery_report import DeliveryReport
+from email_content import EmailContent
+from email_sender import EmailSender
+from journal import SendJournal
+from rate_controller import RateController
+from suppression import SuppressionIndex
+
+ENGINES = ['threaded', 'async']
+EVENT_DETAILS = {'name': 'Test event', 'subject': 'Test event', 'attachment': ['logo.png', 'schedule.pdf'],
+                 'table_name': 'test_event'}
+NUM_EMAILS = 60
+
+
+def send(engine: str, logger, project_path: str, server: FakeSMTPServer, email_contents: list[EmailContent],
+         max_attempts: int = 5, max_recipients_per_message: int = 1,
+         prepare: Callable[[EmailSender], None] = None) -> tuple[EmailSender, list[dict[str, str]]]:
+    """
+    Sends the emails through the fake server, with the retries and backoffs shortened so that the tests run quickly
+    :param prepare: Function changing the sender before the emails are sent, or None
+    :return: The closed sender, and the rows of its delivery report
+    """
+    def make_rate_controller() -> RateController:
+        return RateController(logger=logger, initial_rate=1000, max_concurrency=4, max_rate=1000, max_backoff=0.05)
+
+    report = DeliveryReport(os.path.join(project_path, 'delivery_report.csv'))
+    sender_args = dict(logger=logger, project_path=project_path, event_details=EVENT_DETAILS,
+                       accounts=['first', 'second'], total_emails=len(email_contents), progress_bar_len=10,
+                       max_in_flight=16, make_rate_controller=make_rate_controller,
+                       journal=SendJournal(os.path.join(project_path, 'send_journal.db'), 'test_event'),
+                       max_attempts=max_attempts, report=report, smtp_host=server.host, smtp_port=server.port,
+                       smtp_starttls=False, max_recipients_per_message=max_recipients_per_message,
+                       suppression=SuppressionIndex(os.path.join(project_path, 'suppression.db')))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        if engine == 'async':
+            sender = AsyncEmailSender(max_connections=4, **sender_args)
+        else:
+            sender = EmailSender(executor=executor, **sender_args)
+        sender.retry_base_delay = 0.01
+        sender.retry_max_delay = 0.05
+        if prepare is not None:
+            prepare(sender)
+        with sender:
+            sender.send_emails(email_contents=email_contents)
+            sender.wait()
+    report.close()
+
+    with open(report.path, newline='', encoding='utf-8') as file:
+        return sender, list(csv.DictReader(file))
+
+
+def make_emails(num_emails: int = NUM_EMAILS, same_body: bool = False) -> list[EmailContent]:
+    return [EmailContent(email=f'recipient{i}@example.com', row_id=i,
+                         body='<p>Dear all,</p>' if same_body else f'<p>Dear recipient {i},</p>')
+            for i in range(num_emails)]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_sends_every_email(engine, logger, project_path):
+    with FakeSMTPServer() as server:
+        sender, rows = send(engine, logger, project_path, server, make_emails())
+
+    assert sender.emails_sent == NUM_EMAILS
+    assert server.stats()['messages'] == NUM_EMAILS
+    assert {row['status'] for row in rows} == {'sent'}
+    assert {row['account'] for row in rows} == {'first@example.com', 'second@example.com'}
+    assert sender.journal.delivered_row_ids() == set(range(NUM_EMAILS))
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_sends_emails_with_the_same_body_together(engine, logger, project_path):
+    with FakeSMTPServer() as server:
+        sender, rows = send(engine, logger, project_path, server, make_emails(same_body=True),
+                            max_recipients_per_message=5)
+
+    assert sender.emails_sent == NUM_EMAILS
+    assert server.stats()['recipients'] == NUM_EMAILS
+    assert server.stats()['messages'] == NUM_EMAILS // 5
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_retries_throttled_emails(engine, logger, project_path):
+    with FakeSMTPServer(throttle_rate=0.1, seed=1) as server:
+        sender, rows = send(engine, logger, project_path, server, make_emails(), max_attempts=20)
+
+    assert server.stats()['throttled'] > 0
+    assert sender.emails_sent == NUM_EMAILS
+    assert {row['status'] for row in rows} == {'sent'}
+    assert max(int(row['attempts']) for row in rows) > 1
+    assert sum(account.rate_controller.num_throttles for account in sender.accounts) > 0
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_fails_refused_recipients_without_retrying_and_suppresses_them(engine, logger, project_path):
+    with FakeSMTPServer(error_rate=0.2, seed=2) as server:
+        sender, rows = send(engine, logger, project_path, server, make_emails())
+
+    failed = [row for row in rows if row['status'] == 'failed']
+    assert len(failed) == server.stats()['errors'] > 0
+    assert sender.emails_sent == NUM_EMAILS - len(failed)
+    assert {(row['smtp_code'], row['phase'], row['attempts']) for row in failed} == {('550', 'rcpt', '1')}
+    assert sender.suppression.addresses() == {row['email'] for row in failed}
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_fails_disconnects_after_the_message_as_unknown_outcome(engine, logger, project_path):
+    with FakeSMTPServer(disconnect_rate=0.2, seed=3) as server:
+        sender, rows = send(engine, logger, project_path, server, make_emails())
+
+    failed = [row for row in rows if row['status'] == 'failed']
+    # The server may have accepted the emails it disconnected after, so none of them is sent twice
+    assert len(failed) == server.stats()['disconnects'] > 0
+    assert server.stats()['messages'] + server.stats()['disconnects'] == NUM_EMAILS
+    assert {(row['phase'], row['attempts']) for row in failed} == {('unknown', '1')}
+    assert all('may have been delivered' in row['error'] for row in failed)
+    assert sender.suppression.addresses() == set()
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_judges_each_recipient_of_a_refused_group_by_its_own_reply(engine, logger, project_path):
+    email_contents = make_emails(num_emails=2, same_body=True)
+    replies = {'recipient0@example.com': b'550 5.1.1 No such user', 'recipient1@example.com': b'450 4.2.1 Try later'}
+    with FakeSMTPServer(rcpt_replies=replies) as server:
+        sender, rows = send(engine, logger, project_path, server, email_contents, max_attempts=3,
+                            max_recipients_per_message=2)
+
+    outcomes = {row['email']: (row['status'], row['smtp_code'], row['phase'], row['attempts']) for row in rows}
+    # The unknown address bounces at once, the throttled one is retried and never suppressed
+    assert outcomes == {'recipient0@example.com': ('failed', '550', 'rcpt', '1'),
+                        'recipient1@example.com': ('failed', '450', 'rcpt', '3')}
+    assert sender.suppression.addresses() == {'recipient0@example.com'}
+    assert server.stats()['messages'] == 0
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_fails_the_emails_whose_retry_can_not_be_scheduled(engine, logger, project_path):
+    def break_retries(sender: EmailSender) -> None:
+        schedule_attempt = sender.schedule_attempt
+
+        def schedule_first_attempt(group: list[EmailContent], outcomes: list[Future]) -> None:
+            if group[0].attempts > 0:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            schedule_attempt(group, outcomes)
+        sender.schedule_attempt = schedule_first_attempt
+
+    with FakeSMTPServer(rcpt_replies={'recipient0@example.com': b'450 4.2.1 Try later'}) as server:
+        sender, rows = send(engine, logger, project_path, server, make_emails(num_emails=3), prepare=break_retries)
+
+    # Resolved rather than left in flight, which would block wait forever
+    outcomes = {row['email']: (row['status'], row['attempts']) for row in rows}
+    assert outcomes == {'recipient0@example.com': ('failed', '1'), 'recipient1@example.com': ('sent', '1'),
+                        'recipient2@example.com': ('sent', '1')}
+    assert sender.emails_sent == 2
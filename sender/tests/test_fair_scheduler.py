@@ -0,0 +1,41 @@
+from email_content import EmailContent
+from fair_scheduler import FairScheduler
+
+
+def make_batches(event_key: str, batch_sizes: list[int]) -> list[list[EmailContent]]:
+    return [[EmailContent(email=f'{event_key}{i}@example.com') for i in range(batch_size)]
+            for batch_size in batch_sizes]
+
+
+def test_alternates_between_events_with_batches_of_the_same_size():
+    scheduler = FairScheduler({'freshers': make_batches('freshers', [2, 2, 2]),
+                               'alumni': make_batches('alumni', [2, 2])})
+
+    assert [event_key for event_key, _ in scheduler] == ['freshers', 'alumni', 'freshers', 'alumni', 'freshers']
+
+
+def test_shares_the_emails_whatever_the_sizes_of_the_batches():
+    scheduler = FairScheduler({'freshers': make_batches('freshers', [4] * 5),
+                               'alumni': make_batches('alumni', [1] * 20)})
+
+    served = {'freshers': 0, 'alumni': 0}
+    for event_key, email_contents in scheduler:
+        served[event_key] += len(email_contents)
+        if served['freshers'] < 20 and served['alumni'] < 20:
+            assert abs(served['freshers'] - served['alumni']) <= 4
+    assert served == {'freshers': 20, 'alumni': 20}
+
+
+def test_keeps_the_order_of_the_batches_of_each_event():
+    batches = make_batches('freshers', [1, 2, 3])
+    scheduler = FairScheduler({'freshers': batches, 'alumni': make_batches('alumni', [10])})
+
+    assert [batch for event_key, batch in scheduler if event_key == 'freshers'] == batches
+
+
+def test_goes_on_with_the_other_events_once_one_runs_out():
+    scheduler = FairScheduler({'freshers': make_batches('freshers', [1]), 'alumni': make_batches('alumni', [1] * 3),
+                               'empty': []})
+
+    assert [event_key for event_key, _ in scheduler] == ['freshers', 'alumni', 'alumni', 'alumni']
+    assert scheduler.num_emails == {'freshers': 1, 'alumni': 3, 'empty': 0}
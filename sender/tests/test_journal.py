@@ -0,0 +1,94 @@
+import csv
+import sqlite3
+from time import time
+
+import pytest
+
+from benchmark.fake_smtp import FakeSMTPServer
+from journal import SendJournal
+
+
+@pytest.fixture
+def journal(tmp_path) -> SendJournal:
+    journal = SendJournal(str(tmp_path / 'send_journal.db'), 'freshers')
+    yield journal
+    journal.close()
+
+
+def test_lists_the_rows_delivered(journal):
+    journal.record(1, 'alice@example.com', 'sent', 1, account='first@example.com')
+    journal.record(2, 'bob@example.com', 'failed', 5, 'No such user', account='first@example.com')
+    journal.record(3, 'carol@example.com', 'sent', 2, account='second@example.com')
+
+    assert journal.delivered_row_ids() == {1, 3}
+
+
+def test_keeps_the_last_outcome_of_a_row(journal):
+    journal.record(1, 'alice@example.com', 'failed', 5, 'Connection lost')
+    journal.record(2, 'bob@example.com', 'sent', 1)
+    journal.record(1, 'alice@example.com', 'sent', 1)
+    journal.record(2, 'bob@example.com', 'failed', 1, 'Connection lost')
+
+    assert journal.delivered_row_ids() == {1}
+
+
+def test_lists_the_rows_delivered_since(journal):
+    journal.record(1, 'alice@example.com', 'sent', 1)
+    since = time()
+    journal.record(2, 'bob@example.com', 'sent', 1)
+
+    assert journal.delivered_row_ids(since=since) == {2}
+
+
+def test_keeps_the_events_apart(tmp_path, journal):
+    other = SendJournal(str(tmp_path / 'send_journal.db'), 'alumni')
+    other.record(1, 'alice@example.com', 'sent', 1, account='first@example.com')
+    other.close()
+    journal.record(2, 'bob@example.com', 'sent', 1, account='first@example.com')
+
+    assert journal.delivered_row_ids() == {2}
+    # The quotas of the accounts are shared by the events
+    assert journal.count_sent_since('first@example.com', time() - 60) == 2
+    assert journal.count_sent_since('second@example.com', time() - 60) == 0
+
+
+def test_survives_being_reopened(tmp_path, journal):
+    journal.record(1, 'alice@example.com', 'sent', 1)
+    reopened = SendJournal(str(tmp_path / 'send_journal.db'), 'freshers')
+
+    assert reopened.delivered_row_ids() == {1}
+    reopened.close()
+
+
+def test_upgrades_a_journal_without_attempts_and_accounts(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'old_journal.db')
+    conn.execute('CREATE TABLE deliveries (event TEXT NOT NULL, row_id INTEGER NOT NULL, email TEXT NOT NULL, '
+                 'status TEXT NOT NULL, error TEXT, finished_at REAL NOT NULL, PRIMARY KEY (event, row_id));')
+    conn.execute("INSERT INTO deliveries VALUES ('freshers', 1, 'alice@example.com', 'sent', NULL, 0);")
+    conn.commit()
+    conn.close()
+
+    journal = SendJournal(str(tmp_path / 'old_journal.db'), 'freshers')
+    journal.record(2, 'bob@example.com', 'sent', 3, account='first@example.com')
+
+    assert journal.delivered_row_ids() == {1, 2}
+    journal.close()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_resume_sends_only_the_emails_not_delivered(run_main, engine, tmp_path):
+    with FakeSMTPServer(disconnect_rate=0.3, seed=4) as server:
+        run_main(['--engine', engine], server.port)
+    num_failed = server.stats()['disconnects']
+    assert num_failed > 0
+
+    with FakeSMTPServer() as server:
+        run_main(['--engine', engine, '--resume'], server.port)
+    with open(tmp_path / 'delivery_report.csv', newline='') as file:
+        rows = list(csv.DictReader(file))
+    assert server.stats()['messages'] == len(rows) == num_failed
+    assert {row['status'] for row in rows} == {'sent'}
+
+    with FakeSMTPServer() as server, pytest.raises(SystemExit, match='All emails have already been delivered'):
+        run_main(['--engine', engine, '--resume'], server.port)
+    assert server.stats()['messages'] == 0
@@ -0,0 +1,66 @@
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import os
+
+import pytest
+
+from attachments import load_attachments
+from message_template import UNDISCLOSED_RECIPIENTS, MessageTemplate, serialize_body, to_wire
+
+BODIES = ['<p>Dear Alice,</p>\n<img src="cid:image">',
+          '<p>Chère Zoë,</p>\n<p>À bientôt à Cambridge</p>',
+          '.\n<p>A line starting with a dot</p>\n' + '<p>A long line</p>' * 40]
+
+
+def build_mime(from_addr: str, to_addr: str, subject: str, body: str, boundary: str, attachments_path: str,
+               filenames: list[str]) -> bytes:
+    """
+    :return: The email as built before MessageTemplate, serialised by MIMEMultipart for every email, as sent by smtplib
+    """
+    msg = MIMEMultipart(boundary=boundary)
+    msg['From'] = from_addr
+    msg['To'] = to_addr
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'html'))
+    for filename in filenames:
+        with open(os.path.join(attachments_path, filename), 'rb') as file:
+            content = file.read()
+        if filename.endswith('.png'):
+            part = MIMEImage(content)
+            part.add_header('Content-ID', '<image>')
+            part.add_header('Content-Disposition', 'inline', filename=filename)
+        else:
+            part = MIMEApplication(content, 'pdf')
+            part.add_header('Content-Disposition', 'attachment', filename=filename)
+        msg.attach(part)
+    return to_wire(msg.as_string())
+
+
+@pytest.mark.parametrize('filenames', [[], ['logo.png'], ['logo.png', 'schedule.pdf']])
+@pytest.mark.parametrize('body', BODIES)
+def test_renders_the_same_bytes_as_mime_multipart(project_path, filenames, body):
+    attachments_path = os.path.join(project_path, 'attachments')
+    template = MessageTemplate('sender@example.com', 'Invitation to the Example Event', load_attachments(
+        attachments_path, filenames or None))
+
+    rendered = b''.join(template.render('alice@example.com', body))
+    assert rendered == build_mime('sender@example.com', 'alice@example.com', 'Invitation to the Example Event', body,
+                                  template.boundary, attachments_path, filenames)
+
+
+def test_assembles_emails_to_several_recipients_with_an_undisclosed_to_header(project_path):
+    attachments_path = os.path.join(project_path, 'attachments')
+    template = MessageTemplate('sender@example.com', 'Subject', load_attachments(attachments_path, 'logo.png'))
+
+    assembled = b''.join(template.assemble(UNDISCLOSED_RECIPIENTS, serialize_body(BODIES[0])))
+    assert assembled == build_mime('sender@example.com', UNDISCLOSED_RECIPIENTS, 'Subject', BODIES[0],
+                                   template.boundary, attachments_path, ['logo.png'])
+
+
+def test_refuses_a_body_containing_the_boundary(project_path):
+    template = MessageTemplate('sender@example.com', 'Subject', [])
+
+    with pytest.raises(ValueError):
+        template.render('alice@example.com', f'<p>--{template.boundary}</p>')
@@ -0,0 +1,107 @@
+import smtplib
+from time import monotonic
+
+from rate_controller import RateController, is_throttled
+
+
+def make_controller(logger, **kwargs) -> RateController:
+    return RateController(logger=logger, **{'initial_rate': 10, 'max_concurrency': 20, 'initial_concurrency': 5,
+                                            'max_rate': 100, 'max_backoff': 60} | kwargs)
+
+
+def send(controller: RateController, throttled: bool) -> None:
+    controller.tokens = controller.rate  # Refilled, so that the tests don't wait for tokens
+    assert controller.try_acquire() == 0
+    controller.release(throttled)
+
+
+def test_grows_by_one_per_email_in_slow_start(logger):
+    controller = make_controller(logger)
+    for _ in range(5):
+        send(controller, throttled=False)
+
+    assert controller.slow_start
+    assert controller.rate == 15
+    assert controller.concurrency == 10
+
+
+def test_is_bounded_by_the_maximum_rate_and_concurrency(logger):
+    controller = make_controller(logger, max_rate=12, max_concurrency=7)
+    for _ in range(5):
+        send(controller, throttled=False)
+
+    assert controller.rate == 12
+    assert controller.concurrency == 7
+
+
+def test_halves_and_pauses_when_throttled(logger):
+    controller = make_controller(logger)
+    send(controller, throttled=True)
+
+    assert not controller.slow_start
+    assert controller.rate == 5
+    assert controller.concurrency == 2.5
+    assert 0.9 < controller.try_acquire() <= 1  # Paused for 2 ** 0 seconds
+
+
+def test_counts_emails_throttled_during_the_pause_once(logger):
+    controller = make_controller(logger)
+    for _ in range(3):
+        controller.try_acquire()
+    for _ in range(3):
+        controller.release(throttled=True)
+
+    assert controller.num_throttles == 3
+    assert controller.consecutive_throttles == 1
+    assert controller.rate == 5
+
+
+def test_backs_off_exponentially_up_to_the_maximum(logger):
+    controller = make_controller(logger, max_backoff=3)
+    backoffs = []
+    for _ in range(4):
+        controller.paused_until = 0  # The previous pause is over
+        send(controller, throttled=True)
+        backoffs.append(round(controller.paused_until - monotonic()))
+
+    assert backoffs == [1, 2, 3, 3]
+    assert controller.concurrency == 1
+
+
+def test_grows_additively_after_slow_start(logger):
+    controller = make_controller(logger)
+    send(controller, throttled=True)
+    controller.paused_until = 0
+    for _ in range(5):
+        send(controller, throttled=False)
+
+    # Each email adds 1/rate, so that the rate grows by about one per round of 'rate' emails
+    assert 5.9 < controller.rate < 6
+    assert 4 < controller.concurrency < 5
+    assert controller.consecutive_throttles == 0
+
+
+def test_limits_the_emails_in_flight_to_the_concurrency(logger):
+    controller = make_controller(logger, initial_rate=100, initial_concurrency=2)
+    controller.tokens = 100
+
+    assert controller.try_acquire() == 0
+    assert controller.try_acquire() == 0
+    assert controller.try_acquire() > 0
+    controller.release(throttled=False)
+    assert controller.try_acquire() == 0
+
+
+def test_limits_the_emails_started_per_second_to_the_rate(logger):
+    controller = make_controller(logger, initial_rate=2)
+    controller.tokens = 1
+
+    assert controller.try_acquire() == 0
+    assert 0.4 < controller.try_acquire() <= 0.5
+
+
+def test_recognises_throttling_replies():
+    assert is_throttled(smtplib.SMTPRecipientsRefused({'alice@example.com': (450, b'Rate limited')}))
+    assert is_throttled(smtplib.SMTPDataError(421, b'Try again later'))
+    assert not is_throttled(smtplib.SMTPRecipientsRefused({'alice@example.com': (550, b'No such user')}))
+    assert not is_throttled(smtplib.SMTPServerDisconnected('Connection unexpectedly closed'))
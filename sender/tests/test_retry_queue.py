@@ -0,0 +1,76 @@
+import smtplib
+import socket
+import threading
+from time import monotonic
+
+import pytest
+
+from retry_queue import RetryQueue, backoff_delay, is_transient
+
+
+@pytest.mark.parametrize('attempts, delay', [(1, 1), (2, 2), (3, 4), (6, 32), (7, 60), (20, 60)])
+def test_backoff_doubles_with_jitter_up_to_the_maximum(attempts, delay):
+    delays = [backoff_delay(attempts, base_delay=1, max_delay=60) for _ in range(200)]
+
+    assert all(delay / 2 <= d <= delay for d in delays)
+    assert len(set(delays)) > 1
+
+
+@pytest.mark.parametrize('e, transient', [
+    (smtplib.SMTPRecipientsRefused({'alice@example.com': (450, b'Rate limited')}), True),
+    (smtplib.SMTPRecipientsRefused({'alice@example.com': (550, b'No such user')}), False),
+    (smtplib.SMTPDataError(451, b'Local error'), True),
+    (smtplib.SMTPDataError(554, b'Message rejected'), False),
+    (smtplib.SMTPServerDisconnected('Connection unexpectedly closed'), True),
+    (smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server'), False),
+    (socket.timeout('timed out'), True),
+    (ConnectionRefusedError(), True),
+    (ValueError('Email body contains the MIME boundary'), False),
+])
+def test_classifies_transient_errors(e, transient):
+    assert is_transient(e) == transient
+
+
+def test_runs_the_callbacks_once_due_in_order(logger):
+    retry_queue = RetryQueue(logger)
+    calls = []
+    done = threading.Event()
+    start = monotonic()
+    try:
+        retry_queue.call_later(0.2, lambda: (calls.append(('late', monotonic() - start)), done.set()))
+        retry_queue.call_later(0.1, lambda: calls.append(('second', monotonic() - start)))
+        retry_queue.call_later(0, lambda: calls.append(('first', monotonic() - start)))
+        assert done.wait(5)
+    finally:
+        retry_queue.stop()
+
+    assert [name for name, _ in calls] == ['first', 'second', 'late']
+    assert calls[1][1] >= 0.1
+    assert calls[2][1] >= 0.2
+
+
+def test_drops_the_callbacks_not_due_when_stopped(logger):
+    retry_queue = RetryQueue(logger)
+    calls = []
+    retry_queue.call_later(60, lambda: calls.append('never'))
+    retry_queue.stop()
+
+    assert not retry_queue.thread.is_alive()
+    assert calls == []
+
+
+def test_goes_on_after_a_callback_raises(logger, caplog):
+    retry_queue = RetryQueue(logger)
+    done = threading.Event()
+
+    def fail() -> None:
+        raise RuntimeError('cannot schedule new futures after shutdown')
+
+    try:
+        retry_queue.call_later(0, fail)
+        retry_queue.call_later(0.05, done.set)
+        assert done.wait(5)
+    finally:
+        retry_queue.stop()
+
+    assert 'cannot schedule new futures after shutdown' in caplog.text
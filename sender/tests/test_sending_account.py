@@ -0,0 +1,72 @@
+from collections import Counter
+
+import pytest
+
+from sending_account import QuotaExceededError, SendingAccount, pick_account
+
+
+def make_account(name: str, weight: int = 1, daily_quota: int = None, sent_today: int = 0) -> SendingAccount:
+    email_details = {'email': f'{name}@example.com', 'password': name, 'weight': weight}
+    if daily_quota is not None:
+        email_details['daily_quota'] = daily_quota
+    return SendingAccount(name, email_details, rate_controller=None, sent_today=sent_today)
+
+
+def test_shares_the_emails_by_weight_interleaved():
+    accounts = [make_account('first', weight=3), make_account('second', weight=1)]
+    picks = [pick_account(accounts).name for _ in range(8)]
+
+    assert Counter(picks) == {'first': 6, 'second': 2}
+    assert picks[:4].count('second') == 1  # Interleaved rather than in blocks
+
+
+def test_shares_emails_sent_together_in_emails():
+    accounts = [make_account('first'), make_account('second')]
+    for num_emails in [5, 1, 1, 1, 1, 1, 5, 1, 1, 1, 1, 1]:
+        pick_account(accounts, num_emails)
+
+    assert [account.num_assigned for account in accounts] == [10, 10]
+
+
+def test_counts_the_emails_sent_today_against_the_quota():
+    account = make_account('first', daily_quota=10, sent_today=7)
+
+    assert account.remaining_quota == 3
+    assert account.has_quota(3)
+    assert not account.has_quota(4)
+    assert make_account('second', daily_quota=10, sent_today=12).remaining_quota == 0
+    assert make_account('third').has_quota(10 ** 6)
+
+
+def test_skips_the_accounts_out_of_quota():
+    accounts = [make_account('first', daily_quota=2), make_account('second')]
+    picks = [pick_account(accounts).name for _ in range(6)]
+
+    assert picks.count('first') == 2
+    assert accounts[0].remaining_quota == 0
+
+
+def test_raises_once_every_account_is_out_of_quota():
+    accounts = [make_account('first', daily_quota=1), make_account('second', daily_quota=2)]
+    for _ in range(3):
+        pick_account(accounts)
+
+    with pytest.raises(QuotaExceededError):
+        pick_account(accounts)
+
+
+def test_skips_an_account_without_quota_for_every_recipient():
+    accounts = [make_account('first', daily_quota=4), make_account('second', daily_quota=10)]
+
+    assert pick_account(accounts, 5).name == 'second'
+    with pytest.raises(QuotaExceededError):
+        accounts[0].assign(5)
+
+
+def test_leaves_the_quota_when_only_spooling():
+    accounts = [make_account('first', daily_quota=1)]
+    for _ in range(3):
+        pick_account(accounts, use_quota=False)
+
+    assert accounts[0].num_assigned == 3
+    assert accounts[0].remaining_quota == 1
@@ -0,0 +1,120 @@
+import csv
+import os
+
+import pytest
+
+from attachments import load_attachments
+from benchmark.fake_smtp import FakeSMTPServer
+from email_content import EmailContent
+from message_template import MessageTemplate
+from smtp_protocol import iter_data
+from spool import SpoolReader, SpoolWriter
+
+
+@pytest.fixture
+def messages(project_path) -> list[tuple[list, str, list[EmailContent]]]:
+    """
+    :return: Emails as sent, with their account and recipients, one of them to three recipients and one with a line
+        starting with a dot
+    """
+    template = MessageTemplate('first@example.com', 'Subject', load_attachments(
+        os.path.join(project_path, 'attachments'), ['logo.png', 'schedule.pdf']))
+    messages = []
+    for i in range(5):
+        recipients = [EmailContent(email=f'recipient{i}.{j}@example.com', row_id=10 * i + j)
+                      for j in range(3 if i == 2 else 1)]
+        body = f'.\n<p>Dear recipient {i},</p>' if i == 3 else f'<p>Dear recipient {i},</p>'
+        messages.append((template.render(recipients[0].email, body), 'first' if i % 2 else 'second', recipients))
+    return messages
+
+
+def write_spool(path: str, messages: list[tuple[list, str, list[EmailContent]]]) -> None:
+    with SpoolWriter(path, {'event_details': {'name': 'Test event'}, 'accounts': ['first', 'second']}) as spool:
+        for message, account, email_contents in messages:
+            spool.append(message, account, email_contents)
+
+
+def test_reads_back_the_emails_as_written(tmp_path, messages):
+    write_spool(str(tmp_path / 'spool'), messages)
+    reader = SpoolReader(str(tmp_path / 'spool'))
+
+    assert reader.metadata['event_details'] == {'name': 'Test event'}
+    assert reader.metadata['num_messages'] == 5
+    assert reader.length == reader.metadata['num_emails'] == 7
+
+    email_contents = [email_content for batch in reader.iter_batches(batch_size=2)
+                      for email_content in reader.render(batch)]
+    expected = [(email_content, message, account) for message, account, recipients in messages
+                for email_content in recipients]
+    assert len(email_contents) == len(expected)
+    for email_content, (original, message, account) in zip(email_contents, expected):
+        assert (email_content.email, email_content.row_id) == (original.email, original.row_id)
+        assert email_content.spool_account == account
+        # Written as sent after DATA, so that it's sent without being dot-stuffed again
+        assert b''.join(email_content.message) == b''.join(iter_data(message, terminate=False))
+        assert b''.join(iter_data(email_content.message)) == b''.join(iter_data(message))
+    del email_contents
+    reader.stop()
+
+
+def test_never_splits_the_recipients_of_an_email(tmp_path, messages):
+    write_spool(str(tmp_path / 'spool'), messages)
+    reader = SpoolReader(str(tmp_path / 'spool'))
+
+    batches = list(reader.iter_batches(batch_size=2))
+    assert [sum(len(entry['recipients']) for entry in batch) for batch in batches] == [2, 3, 2]
+    reader.stop()
+
+
+def test_counts_the_emails_left_without_the_rows_skipped(tmp_path, messages):
+    write_spool(str(tmp_path / 'spool'), messages)
+    reader = SpoolReader(str(tmp_path / 'spool'))
+
+    assert reader.count_remaining(set()) == 7
+    assert reader.count_remaining({0, 20, 21, 999}) == 4  # Rows that aren't in the spool aren't counted
+    reader.stop()
+
+
+def test_refuses_an_incomplete_spool(tmp_path, messages):
+    with pytest.raises(RuntimeError):
+        with SpoolWriter(str(tmp_path / 'spool'), {}) as spool:
+            spool.append(*messages[0])
+            raise RuntimeError('Rendering failed')
+
+    with pytest.raises(FileNotFoundError):
+        SpoolReader(str(tmp_path / 'spool'))
+    with pytest.raises(FileExistsError):
+        SpoolWriter(str(tmp_path / 'spool'), {})
+
+
+def test_reads_an_empty_spool(tmp_path):
+    write_spool(str(tmp_path / 'spool'), [])
+    reader = SpoolReader(str(tmp_path / 'spool'))
+
+    assert reader.length == 0
+    assert list(reader.iter_batches(batch_size=40)) == []
+    reader.stop()
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'async'])
+def test_drains_the_same_emails_as_sent_directly(run_main, engine, tmp_path):
+    with FakeSMTPServer() as server:
+        run_main(['--engine', engine], server.port)
+    num_bytes = server.stats()['bytes']
+
+    with FakeSMTPServer() as server:
+        run_main(['--spool', 'spool'], server.port)
+    assert server.stats()['messages'] == 0
+
+    with FakeSMTPServer() as server:
+        run_main(['--engine', engine, '--drain', 'spool'], server.port)
+    with open(tmp_path / 'delivery_report.csv', newline='') as file:
+        rows = list(csv.DictReader(file))
+    assert server.stats()['messages'] == len(rows) == 50
+    assert {row['status'] for row in rows} == {'sent'}
+    assert server.stats()['bytes'] == num_bytes  # The boundaries differ, but not in length
+
+    # Draining the spool again only sends what the previous drains didn't deliver
+    with FakeSMTPServer() as server, pytest.raises(SystemExit, match='All emails have already been delivered'):
+        run_main(['--engine', engine, '--drain', 'spool'], server.port)
+    assert server.stats()['messages'] == 0
@@ -0,0 +1,152 @@
+import csv
+import json
+import logging
+import smtplib
+
+import pytest
+
+from benchmark.fake_smtp import FakeSMTPServer
+from delivery_report import DeliveryReport
+from email_content import EmailContent
+from pipeline import Pipeline
+from smtp_protocol import DeliveryUnknownError
+from suppression import SuppressionIndex, is_bounce, normalise_address
+
+
+@pytest.fixture
+def suppression(tmp_path) -> SuppressionIndex:
+    suppression = SuppressionIndex(str(tmp_path / 'suppression.db'))
+    yield suppression
+    suppression.close()
+
+
+def test_normalises_addresses():
+    assert normalise_address('  Alice@Example.COM\n') == 'alice@example.com'
+
+
+@pytest.mark.parametrize('e, bounce', [
+    (smtplib.SMTPRecipientsRefused({'alice@example.com': (550, b'No such user')}), True),
+    (smtplib.SMTPRecipientsRefused({'alice@example.com': (553, b'Mailbox name not allowed')}), True),
+    (smtplib.SMTPRecipientsRefused({'alice@example.com': (554, b'Rejected by policy')}), False),
+    (smtplib.SMTPRecipientsRefused({'alice@example.com': (450, b'Rate limited')}), False),
+    (smtplib.SMTPDataError(550, b'Message rejected as spam'), False),
+    (smtplib.SMTPSenderRefused(550, b'Sender refused', 'first@example.com'), False),
+    (DeliveryUnknownError('Connection lost'), False),
+])
+def test_recognises_bounces(e, bounce):
+    assert is_bounce(e) == bounce
+
+
+def test_keeps_the_first_reason_of_an_address(suppression):
+    assert suppression.add(['alice@example.com', 'Bob@Example.com', ' '], 'bounce', 'freshers') == 2
+    assert suppression.add(['ALICE@example.com', 'carol@example.com'], 'opt-out') == 1
+
+    assert suppression.addresses() == {'alice@example.com', 'bob@example.com', 'carol@example.com'}
+    reason = suppression.conn.execute("SELECT reason FROM suppressions WHERE email = 'alice@example.com';").fetchone()
+    assert reason == ('bounce',)
+
+
+def test_imports_an_opt_out_list(tmp_path, suppression):
+    path = tmp_path / 'opt_out.txt'
+    path.write_text('# Replies asking to be removed\nalice@example.com\n\n  Bob@Example.com  \n')
+
+    assert suppression.import_file(str(path)) == 2
+    assert suppression.addresses() == {'alice@example.com', 'bob@example.com'}
+
+
+def write_report(path: str, report_format: str) -> DeliveryReport:
+    report = DeliveryReport(path, report_format=report_format)
+    report.record('sent@example.com', 'sent', 250, 0.1, 1, 1)
+    report.record('unknown@example.com', 'failed', 550, 0.1, 1, 1, 'rcpt', 'No such user')
+    report.record('full@example.com', 'failed', 552, 0.1, 1, 1, 'rcpt', 'Mailbox full')
+    report.record('policy@example.com', 'failed', 554, 0.1, 1, 1, 'rcpt', 'Rejected by policy')
+    report.record('throttled@example.com', 'failed', 450, 0.1, 1, 5, 'rcpt', 'Rate limited')
+    report.record('spam@example.com', 'failed', 550, 0.1, 1, 1, 'data', 'Message rejected as spam')
+    report.record('lost@example.com', 'failed', None, None, None, 1, 'unknown', 'Connection lost')
+    report.close()
+    return report
+
+
+@pytest.mark.parametrize('report_format', ['csv', 'jsonl'])
+def test_imports_only_the_recipients_refused_of_a_report(tmp_path, suppression, report_format):
+    path = str(tmp_path / f'delivery_report.{report_format}')
+    write_report(path, report_format)
+
+    assert suppression.import_file(path) == 2
+    assert suppression.addresses() == {'unknown@example.com', 'full@example.com'}
+
+
+def test_imports_a_report_converted_to_excel(tmp_path, suppression):
+    report = write_report(str(tmp_path / 'delivery_report.csv'), 'csv')
+    report.write_excel(str(tmp_path / 'delivery_report.xlsx'))
+
+    assert suppression.import_file(str(tmp_path / 'delivery_report.xlsx')) == 2
+
+
+def test_refuses_a_report_without_the_phase_of_the_failures(tmp_path, suppression):
+    path = tmp_path / 'old_report.jsonl'
+    path.write_text(json.dumps({'email': 'alice@example.com', 'status': 'failed', 'smtp_code': 550}) + '\n')
+
+    with pytest.raises(ValueError, match='phase'):
+        suppression.import_file(str(path))
+    with pytest.raises(ValueError):
+        suppression.import_file(str(tmp_path / 'failed_emails.pdf'))
+    assert suppression.addresses() == set()
+
+
+def run_pipeline(email_contents: list[EmailContent], **kwargs) -> tuple[Pipeline, list[EmailContent]]:
+    batches = [email_contents[i:i + 3] for i in range(0, len(email_contents), 3)]
+    with Pipeline(logger=logging.getLogger('tests'), batches=batches, render=list, queue_depth=2,
+                  **kwargs) as pipeline:
+        return pipeline, [email_content for batch in pipeline for email_content in batch]
+
+
+def make_emails(addresses: list[str]) -> list[EmailContent]:
+    return [EmailContent(email=address, body='', row_id=row_id) for row_id, address in enumerate(addresses)]
+
+
+def test_pipeline_skips_the_suppressed_addresses():
+    email_contents = make_emails(['alice@example.com', ' ALICE@example.com', 'bob@example.com', 'carol@example.com'])
+    pipeline, sent = run_pipeline(email_contents, suppressed={'alice@example.com'})
+
+    assert [email_content.row_id for email_content in sent] == [2, 3]
+    assert (pipeline.num_suppressed, pipeline.num_duplicates) == (2, 0)
+
+
+def test_pipeline_skips_the_addresses_already_emailed_with_dedup():
+    addresses = ['alice@example.com', 'bob@example.com', 'Alice@Example.com', 'carol@example.com', 'bob@example.com']
+
+    pipeline, sent = run_pipeline(make_emails(addresses))
+    assert len(sent) == 5
+
+    pipeline, sent = run_pipeline(make_emails(addresses), dedup=True)
+    assert [email_content.row_id for email_content in sent] == [0, 1, 3]
+    assert (pipeline.num_suppressed, pipeline.num_duplicates) == (0, 2)
+    counter = pipeline.metrics.full_name('emails_suppressed_total', (('reason', 'duplicate'),))
+    assert pipeline.metrics.snapshot()['counters'][counter] == 2
+
+
+def test_pipeline_counts_the_addresses_delivered_by_a_previous_run_with_dedup():
+    addresses = ['alice@example.com', 'alice@example.com', 'bob@example.com']
+    pipeline, sent = run_pipeline(make_emails(addresses), skip_row_ids={0}, dedup=True)
+
+    assert [email_content.row_id for email_content in sent] == [2]
+    assert pipeline.num_duplicates == 1
+
+
+def test_never_emails_the_addresses_suppressed_again(run_main, tmp_path):
+    (tmp_path / 'opt_out.txt').write_text('recipient1@example.com\nrecipient2@example.com\n')
+    with FakeSMTPServer(error_rate=0.2, seed=5) as server:
+        run_main(['--suppress', 'opt_out.txt'], server.port)
+    num_bounced = server.stats()['errors']
+    assert num_bounced > 0
+    assert server.stats()['messages'] == 48 - num_bounced
+
+    with open(tmp_path / 'delivery_report.csv', newline='') as file:
+        bounced = {row['email'] for row in csv.DictReader(file) if row['status'] == 'failed'}
+    with FakeSMTPServer() as server:
+        run_main([], server.port)
+    with open(tmp_path / 'delivery_report.csv', newline='') as file:
+        sent = {row['email'] for row in csv.DictReader(file)}
+    assert server.stats()['messages'] == len(sent) == 48 - num_bounced
+    assert not sent & (bounced | {'recipient1@example.com', 'recipient2@example.com'})
@@ -1,27 +1,55 @@
 import logging
 import os
 import sys
-from typing import Callable, Any
+from typing import Callable, Any, Iterable
 
+from body_template import compile_body
 import email_contents_getters
+from structured_log import BackgroundHandler, EventName, JsonFormatter, SuccessSampler
 
 
-def get_logger(event_name: str):
+def get_logger(event_name: str, log_path: str = None, log_format: str = 'text', success_sample_rate: float = 1.0):
     """
-    Initialise logger
-    :param event_name:
+    Initialise logger. The log file is written by a background thread, so that logging never blocks the sending threads
+    :param event_name: Name of the event, written in every line
+    :param log_path: Path of the log file, appended to, or None for email_sender.log next to this file
+    :param log_format: 'text' for the original lines, or 'json' for one JSON object per line with the recipient, SMTP
+        id, latency and outcome of the emails as their own fields
+    :param success_sample_rate: Fraction of the lines of emails sent successfully that are written, failures are always
+        written
     :return: Logger object that is to be used in the whole program
     """
     logger = logging.getLogger('logger')
-    logging.basicConfig(
-        filename=os.path.join(os.path.dirname(__file__), 'email_sender.log'),
-        filemode='a',
-        format=f'%(asctime)s - %(levelname)s - {event_name} - %(message)s',
-        level=logging.DEBUG
-    )
+    if logging.getLogger().handlers:  # Already configured, as logging.basicConfig would leave it
+        return logger
+
+    file_handler = logging.FileHandler(log_path or os.path.join(os.path.dirname(__file__), 'email_sender.log'), 'a')
+    if log_format == 'json':
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(event)s - %(message)s'))
+    handler = BackgroundHandler(file_handler)
+    handler.addFilter(EventName(event_name))
+    if success_sample_rate < 1:
+        handler.addFilter(SuccessSampler(success_sample_rate))
+
+    logging.basicConfig(handlers=[handler], level=logging.DEBUG)
     return logger
 
 
+def get_event_logger(logger: logging.Logger, event_key: str, event_name: str) -> logging.Logger:
+    """
+    :param logger: Logger of the run, from get_logger
+    :param event_key: Event key identifier of one of the events of a batch run
+    :param event_name: Name of the event
+    :return: Logger whose lines are written with the name of the event instead of the name of the run
+    """
+    event_logger = logger.getChild(event_key)
+    if not event_logger.filters:
+        event_logger.addFilter(EventName(event_name))
+    return event_logger
+
+
 def terminate(logger: logging.Logger, error_msg: str):
     logger.error(error_msg)
     sys.exit('\n' + error_msg)
@@ -34,12 +62,31 @@ def check_event_details_validity(event_details: dict[str]) -> None:
     :return: None
     """
     required_keys = {'name', 'table_name', 'email_sender', 'subject', 'attachment', 'cols', 'grouping_requirement',
-                     'body'}
+                     'body', 'engine'}
     if set(event_details.keys()) != required_keys or len(event_details.keys()) != len(required_keys):
         sys.exit('Error: Format of event yaml file not correct')
 
 
-def select_function(email_sender_type: str) -> Callable[[list[tuple[Any, ...]], list[str], str], Any] | Any:
+def check_body_validity(event_details: dict[str]) -> None:
+    """
+    Compiles the body of events using the default or the families getter, so that an unknown placeholder fails before
+        any email is sent rather than halfway through the run. Families emails also need their rows ordered by family
+    :param event_details: Dictionary of all necessary details of the event
+    :return: None
+    """
+    if event_details['email_sender'] == 'families':
+        if event_details['grouping_requirement'] != 'family_id':
+            raise ValueError("Families emails require 'grouping_requirement: family_id'")
+        compile_body(event_details['body'], email_contents_getters.FAMILIES_BODY_NAMES)
+        return
+    if event_details['email_sender'] not in [None, 'default']:
+        return
+    if 'email' not in event_details['cols']:
+        raise ValueError("Event cols must contain 'email'")
+    compile_body(event_details['body'], tuple(event_details['cols']))
+
+
+def select_function(email_sender_type: str) -> Callable[[Iterable[tuple[Any, ...]], list[str], str], Any] | Any:
     """
     :param email_sender_type: The 'get_email_contents' function type defined in the event's yaml file
     :return: The corresponding 'get_email_contents' function associated with this specific event